@@ -38,6 +38,9 @@ setup(
         'treq==0.2.1',
         'confmodel>=0.2.0',
     ],
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
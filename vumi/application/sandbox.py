@@ -31,6 +31,7 @@ from vumi.config import ConfigText, ConfigInt, ConfigList, ConfigDict
 from vumi.application.base import ApplicationWorker
 from vumi.message import Message
 from vumi.errors import ConfigError
+from vumi.persist.redis_base import RedisScript
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.utils import (
     load_class_by_string, HttpDataLimitError)
@@ -276,6 +277,31 @@ class SandboxResource(object):
         api.sandbox_kill()  # it's a harsh world
 
 
+def _fake_check_keys(call, keys, args):
+    key, count_key = keys
+    soft_limit, hard_limit = int(args[0]), int(args[1])
+    if call('exists', key):
+        return 0
+    key_count = call('incr', count_key, 1)
+    if key_count > soft_limit and key_count >= hard_limit:
+        call('incr', count_key, -1)
+    return key_count
+
+
+# Returns 0 if the key already exists. Otherwise, this counts the new key and
+# returns the new count, but takes it back again if it is over both limits.
+CHECK_KEYS_SCRIPT = RedisScript("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local key_count = redis.call('INCR', KEYS[2])
+if key_count > tonumber(ARGV[1]) and key_count >= tonumber(ARGV[2]) then
+    redis.call('DECR', KEYS[2])
+end
+return key_count
+""", fake_func=_fake_check_keys)
+
+
 class RedisResource(SandboxResource):
     """
     Resource that provides access to a simple key-value store.
@@ -319,10 +345,9 @@ class RedisResource(SandboxResource):
 
     @inlineCallbacks
     def check_keys(self, api, key):
-        if (yield self.redis.exists(key)):
-            returnValue(True)
-        count_key = self._count_key(api.sandbox_id)
-        key_count = yield self.redis.incr(count_key, 1)
+        key_count = yield self.redis.run_script(
+            CHECK_KEYS_SCRIPT, [key, self._count_key(api.sandbox_id)],
+            [self.keys_per_user_soft, self.keys_per_user_hard])
         if key_count > self.keys_per_user_soft:
             if key_count < self.keys_per_user_hard:
                 api.log('Redis soft limit of %s keys reached for sandbox %s. '
@@ -338,7 +363,6 @@ class RedisResource(SandboxResource):
                             api.sandbox_id,
                             self.keys_per_user_hard),
                         logging.ERROR)
-                yield self.redis.incr(count_key, -1)
                 returnValue(False)
         returnValue(True)
 
@@ -1166,9 +1190,14 @@ class Sandbox(ApplicationWorker):
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        sandbox_id = self.sandbox_id_for_message(msg)
+
+        def get_config_data():
+            config = self.config.copy()
+            config['sandbox_id'] = sandbox_id
+            return config
+
+        return succeed(self.get_cached_config(sandbox_id, get_config_data))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
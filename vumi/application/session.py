@@ -57,7 +57,7 @@ class SessionManager(object):
                 sessions_to_expire.append(user_id)
 
         # clear empty ones
-        for user_ids in sessions_to_expire:
+        for user_id in sessions_to_expire:
             self.r_server.srem(skey, user_id)
 
     def r_key(self, *args):
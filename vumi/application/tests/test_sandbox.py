@@ -97,6 +97,19 @@ class TestSandbox(SandboxTestCaseBase):
         [kill_err] = self.flushLoggedErrors(ProcessTerminated)
         self.assertTrue('process ended by signal' in str(kill_err.value))
 
+    @inlineCallbacks
+    def test_get_config_cached_per_sandbox(self):
+        app = yield self.setup_app("")
+        config1 = yield app.get_config(
+            self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+        config2 = yield app.get_config(
+            self.app_helper.make_inbound("bar", sandbox_id='sandbox1'))
+        config3 = yield app.get_config(
+            self.app_helper.make_inbound("baz", sandbox_id='sandbox2'))
+        self.assertTrue(config1 is config2)
+        self.assertEqual(config1.sandbox_id, 'sandbox1')
+        self.assertEqual(config3.sandbox_id, 'sandbox2')
+
     @inlineCallbacks
     def test_stderr_from_sandbox(self):
         app = yield self.setup_app(
@@ -55,3 +55,14 @@ class TestSessionManager(VumiTestCase):
     def test_lazy_clearing(self):
         self.sm.save_session('user_id', {})
         self.assertEqual(list(self.sm.active_sessions()), [])
+
+    def test_lazy_clearing_several_sessions(self):
+        for user_id in ['u1', 'u2', 'u3']:
+            self.sm.create_session(user_id)
+        # The session data for u1 and u2 expires.
+        self.fake_redis.delete(self.sm.r_key('session', 'u1'))
+        self.fake_redis.delete(self.sm.r_key('session', 'u2'))
+        self.assertEqual([s[0] for s in self.sm.active_sessions()], ['u3'])
+        self.assertEqual(
+            self.fake_redis.smembers(self.sm.r_key('active_sessions')),
+            set(['u3']))
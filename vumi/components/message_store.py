@@ -98,10 +98,24 @@ class MessageStore(object):
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
+
+    :param manager:
+        The Riak manager to store models with.
+    :param redis:
+        The Redis manager for the message store cache.
+    :param float object_cache_ttl:
+        If set, batches, tag records and outbound messages are kept in the
+        Riak manager's object cache for this many seconds, so that adding
+        messages and events doesn't need to fetch them from Riak again.
+        See :meth:`vumi.persist.model.Manager.cache_models`.
     """
 
-    def __init__(self, manager, redis):
+    def __init__(self, manager, redis, object_cache_ttl=None):
         self.manager = manager
+        if object_cache_ttl:
+            manager.cache_models(
+                dict((modelcls, object_cache_ttl)
+                     for modelcls in (Batch, CurrentTag, OutboundMessage)))
         self.batches = manager.proxy(Batch)
         self.outbound_messages = manager.proxy(OutboundMessage)
         self.events = manager.proxy(Event)
@@ -144,24 +158,26 @@ class MessageStore(object):
 
     @Manager.calls_manager
     def reconcile_inbound_cache(self, batch_id):
-        inbound_keys = yield self.batch_inbound_keys(batch_id)
-        for key in inbound_keys:
-            try:
-                msg = yield self.get_inbound_message(key)
-                yield self.cache.add_inbound_message(batch_id, msg)
-            except Exception:
-                log.err()
+        for keys_page in self.batch_inbound_keys_pages(batch_id):
+            inbound_keys = yield keys_page
+            for key in inbound_keys:
+                try:
+                    msg = yield self.get_inbound_message(key)
+                    yield self.cache.add_inbound_message(batch_id, msg)
+                except Exception:
+                    log.err()
 
     @Manager.calls_manager
     def reconcile_outbound_cache(self, batch_id):
-        outbound_keys = yield self.batch_outbound_keys(batch_id)
-        for key in outbound_keys:
-            try:
-                msg = yield self.get_outbound_message(key)
-                yield self.cache.add_outbound_message(batch_id, msg)
-                yield self.reconcile_event_cache(batch_id, key)
-            except Exception:
-                log.err()
+        for keys_page in self.batch_outbound_keys_pages(batch_id):
+            outbound_keys = yield keys_page
+            for key in outbound_keys:
+                try:
+                    msg = yield self.get_outbound_message(key)
+                    yield self.cache.add_outbound_message(batch_id, msg)
+                    yield self.reconcile_event_cache(batch_id, key)
+                except Exception:
+                    log.err()
 
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
@@ -193,10 +209,16 @@ class MessageStore(object):
     def batch_done(self, batch_id):
         batch = yield self.batches.load(batch_id)
         tag_keys = yield batch.backlinks.currenttags()
-        for tags_bunch in self.manager.load_all_bunches(CurrentTag, tag_keys):
-            for tag in (yield tags_bunch):
+        tags_bunches = self.manager.load_all_bunches(
+            CurrentTag, tag_keys, ordered=False)
+        for tags_bunch in tags_bunches:
+            tags = yield tags_bunch
+            for tag in tags:
                 tag.current_batch.set(None)
-                yield tag.save()
+            results = yield self.current_tags.store_many(tags)
+            for success, result in results:
+                if not success:
+                    result.raiseException()
 
     @Manager.calls_manager
     def add_outbound_message(self, msg, tag=None, batch_id=None, batch_ids=()):
@@ -302,6 +324,14 @@ class MessageStore(object):
     def batch_outbound_keys(self, batch_id):
         return self.outbound_messages.index_keys('batches', batch_id)
 
+    def batch_outbound_keys_pages(self, batch_id, page_size=None):
+        """
+        Return an iterator over (possibly deferred) pages of outbound message
+        keys for ``batch_id``.
+        """
+        return self.outbound_messages.index_keys_pages(
+            'batches', batch_id, page_size=page_size)
+
     def batch_outbound_keys_matching(self, batch_id, query):
         mr = self.outbound_messages.index_match(query, 'batches', batch_id)
         return mr.get_keys()
@@ -309,6 +339,14 @@ class MessageStore(object):
     def batch_inbound_keys(self, batch_id):
         return self.inbound_messages.index_keys('batches', batch_id)
 
+    def batch_inbound_keys_pages(self, batch_id, page_size=None):
+        """
+        Return an iterator over (possibly deferred) pages of inbound message
+        keys for ``batch_id``.
+        """
+        return self.inbound_messages.index_keys_pages(
+            'batches', batch_id, page_size=page_size)
+
     def batch_inbound_keys_matching(self, batch_id, query):
         mr = self.inbound_messages.index_match(query, 'batches', batch_id)
         return mr.get_keys()
@@ -318,13 +356,19 @@ class MessageStore(object):
 
     @Manager.calls_manager
     def batch_inbound_count(self, batch_id):
-        keys = yield self.batch_inbound_keys(batch_id)
-        returnValue(len(keys))
+        count = 0
+        for keys_page in self.batch_inbound_keys_pages(batch_id):
+            keys = yield keys_page
+            count += len(keys)
+        returnValue(count)
 
     @Manager.calls_manager
     def batch_outbound_count(self, batch_id):
-        keys = yield self.batch_outbound_keys(batch_id)
-        returnValue(len(keys))
+        count = 0
+        for keys_page in self.batch_outbound_keys_pages(batch_id):
+            keys = yield keys_page
+            count += len(keys)
+        returnValue(count)
 
     @inlineCallbacks
     def find_inbound_keys_matching(self, batch_id, query, ttl=None,
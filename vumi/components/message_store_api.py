@@ -107,7 +107,9 @@ class MatchResource(resource.Resource):
             request.write(json.dumps(keys))
         else:
             messages = []
-            for bunch in self._load_bunches_cb(keys):
+            # The messages are sorted below, so we take bunches in whatever
+            # order they load.
+            for bunch in self._load_bunches_cb(keys, ordered=False):
                 # inbound & outbound messages have a `.msg` attribute which
                 # is the actual message stored, they share the same message_id
                 # as the key.
@@ -49,24 +49,29 @@ class MessageStoreProxyResource(Resource):
         else:
             concurrency = self.default_concurrency
 
-        d = self.get_keys(self.message_store, self.batch_id)
-        d.addCallback(lambda keys: list(chunks(keys, chunk_size)))
-        d.addCallback(self.fetch_chunks, concurrency, request)
+        self.fetch_pages(chunk_size, concurrency, request)
         return NOT_DONE_YET
 
-    def get_keys(self, message_store, batch_id):
+    def get_key_pages(self, message_store, batch_id):
         raise NotImplementedError('To be implemented by sub-class.')
 
     def get_message(self, message_store, message_id):
         raise NotImplementedError('To be implemented by sub-class.')
 
+    @inlineCallbacks
+    def fetch_pages(self, chunk_size, concurrency, request):
+        for keys_page in self.get_key_pages(self.message_store, self.batch_id):
+            keys = yield keys_page
+            yield self.fetch_chunks(
+                list(chunks(keys, chunk_size)), concurrency, request)
+        request.finish()
+
     @inlineCallbacks
     def fetch_chunks(self, chunked_keys, concurrency, request):
         while chunked_keys:
             block, chunked_keys = (
                 chunked_keys[:concurrency], chunked_keys[concurrency:])
             yield self.handle_chunks(block, request)
-        request.finish()
 
     def handle_chunks(self, chunks, request):
         return DeferredList([
@@ -88,8 +93,8 @@ class MessageStoreProxyResource(Resource):
 
 class InboundResource(MessageStoreProxyResource):
 
-    def get_keys(self, message_store, batch_id):
-        return message_store.batch_inbound_keys(batch_id)
+    def get_key_pages(self, message_store, batch_id):
+        return message_store.batch_inbound_keys_pages(batch_id)
 
     def get_message(self, message_store, message_id):
         return message_store.get_inbound_message(message_id)
@@ -97,8 +102,8 @@ class InboundResource(MessageStoreProxyResource):
 
 class OutboundResource(MessageStoreProxyResource):
 
-    def get_keys(self, message_store, batch_id):
-        return message_store.batch_outbound_keys(batch_id)
+    def get_key_pages(self, message_store, batch_id):
+        return message_store.batch_outbound_keys_pages(batch_id)
 
     def get_message(self, message_store, message_id):
         return message_store.get_outbound_message(message_id)
@@ -46,14 +46,26 @@ class SessionManager(object):
     def active_sessions(self):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        Scans redis for keys starting with the session key prefix and loads
+        the sessions for each batch of keys in a single pipeline. The scan
+        doesn't block redis, but it still walks over every key, so try not
+        to hit this too often.
         """
-        keys = yield self.redis.keys('session:*')
         sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
+        seen = set()
+        for keys_d in self.redis.scan_batches('session:*'):
+            keys = [key for key in (yield keys_d) if key not in seen]
+            if not keys:
+                continue
+            seen.update(keys)
+            pipe = self.redis.pipeline()
+            for key in keys:
+                pipe.hgetall(key)
+            results = yield pipe.execute()
+            for key, session in zip(keys, results):
+                if session:
+                    # Sessions that expired since the scan come back empty.
+                    sessions.append((key.split(':', 1)[1], session))
 
         returnValue(sessions)
 
@@ -83,16 +95,20 @@ class SessionManager(object):
         """
         Create a new session using the given user_id
         """
-        yield self.clear_session(user_id)
+        ukey = "%s:%s" % ('session', user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        pipe = self.redis.pipeline()
+        pipe.delete(ukey)
+        for s_key, s_value in defaults.items():
+            pipe.hset(ukey, s_key, s_value)
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            pipe.expire(ukey, int(self.max_session_length))
+        pipe.hgetall(ukey)
+        results = yield pipe.execute()
+        returnValue(results[-1])
 
     def clear_session(self, user_id):
         ukey = "%s:%s" % ('session', user_id)
@@ -113,6 +129,8 @@ class SessionManager(object):
 
         """
         ukey = "%s:%s" % ('session', user_id)
+        pipe = self.redis.pipeline()
         for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+            pipe.hset(ukey, s_key, s_value)
+        yield pipe.execute()
         returnValue(session)
@@ -9,7 +9,27 @@ import time
 from twisted.internet.defer import returnValue
 
 from vumi.errors import VumiError
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisScript
+from vumi.persist.redis_cache import CachedRedisManager
+
+
+def _fake_acquire_tag(call, keys, args):
+    free_list_key, free_set_key, inuse_set_key = keys
+    tag = call('lpop', free_list_key)
+    if tag is not None:
+        call('smove', free_set_key, inuse_set_key, tag)
+    return tag
+
+
+# Moves the next free tag to the in-use set in one step, so a tag can't be
+# lost from both sets if we fail half way.
+ACQUIRE_TAG_SCRIPT = RedisScript("""
+local tag = redis.call('LPOP', KEYS[1])
+if tag then
+    redis.call('SMOVE', KEYS[2], KEYS[3], tag)
+end
+return tag
+""", fake_func=_fake_acquire_tag)
 
 
 class TagpoolError(VumiError):
@@ -21,14 +41,31 @@ class TagpoolManager(object):
 
     :param redis:
         An instance of :class:`vumi.persist.redis_base.Manager`.
+    :param float metadata_cache_ttl:
+        If set, pool metadata is cached in memory for this many seconds.
+        Metadata changed by other processes is only seen once the cached
+        copy expires.
+    :param bool hash_tag_keys:
+        If set, the pool name in each pool's keys is a hash tag (see
+        :func:`vumi.persist.redis_sharding.hash_tag`), so all of a pool's
+        keys are on the same shard of a sharded redis manager. Acquiring and
+        releasing tags moves them between a pool's keys, which a sharded
+        manager can only do on a single shard. This changes the key names
+        from ``tagpools:<pool>:...`` to ``tagpools:{<pool>}:...``, so
+        existing pools must be renamed to the new keys before turning it on.
     """
 
     encoding = "UTF-8"
 
-    def __init__(self, redis):
+    def __init__(self, redis, metadata_cache_ttl=None, hash_tag_keys=False):
         self.redis = redis
+        self.hash_tag_keys = hash_tag_keys
         self.manager = redis  # TODO: This is a bit of a hack to make the
                               #       the calls_manager decorator work
+        self.metadata_redis = redis
+        if metadata_cache_ttl:
+            self.metadata_redis = CachedRedisManager(
+                redis, metadata_cache_ttl, cached_calls=['hgetall'])
 
     def _encode(self, unicode_text):
         return unicode_text.encode(self.encoding)
@@ -67,7 +104,7 @@ class TagpoolManager(object):
     @Manager.calls_manager
     def get_metadata(self, pool):
         metadata_key = self._tag_pool_metadata_key(pool)
-        metadata = yield self.redis.hgetall(metadata_key)
+        metadata = yield self.metadata_redis.hgetall(metadata_key)
         metadata = dict((self._decode(k), json.loads(v))
                         for k, v in metadata.iteritems())
         returnValue(metadata)
@@ -78,8 +115,8 @@ class TagpoolManager(object):
         metadata = dict((self._encode(k), json.dumps(v))
                         for k, v in metadata.iteritems())
         yield self._register_pool(pool)
-        yield self.redis.delete(metadata_key)
-        yield self.redis.hmset(metadata_key, metadata)
+        yield self.metadata_redis.delete(metadata_key)
+        yield self.metadata_redis.hmset(metadata_key, metadata)
 
     @Manager.calls_manager
     def purge_pool(self, pool):
@@ -93,7 +130,7 @@ class TagpoolManager(object):
             yield self.redis.delete(free_set_key)
             yield self.redis.delete(free_list_key)
             yield self.redis.delete(inuse_set_key)
-            yield self.redis.delete(metadata_key)
+            yield self.metadata_redis.delete(metadata_key)
             yield self._unregister_pool(pool)
 
     @Manager.calls_manager
@@ -152,21 +189,26 @@ class TagpoolManager(object):
         pool_list_key = self._pool_list_key()
         yield self.redis.srem(pool_list_key, pool)
 
-    def _tag_pool_keys(self, pool):
+    def _pool_key_part(self, pool):
         pool = self._encode(pool)
+        if self.hash_tag_keys:
+            return "{%s}" % (pool,)
+        return pool
+
+    def _tag_pool_keys(self, pool):
+        pool = self._pool_key_part(pool)
         return tuple(":".join(["tagpools", pool, state])
                      for state in ("free:list", "free:set", "inuse:set"))
 
     def _tag_pool_metadata_key(self, pool):
-        pool = self._encode(pool)
+        pool = self._pool_key_part(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
     @Manager.calls_manager
     def _acquire_tag(self, pool, owner, reason):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
+        tag = yield self.redis.run_script(
+            ACQUIRE_TAG_SCRIPT, self._tag_pool_keys(pool))
         if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
             yield self._store_reason(pool, tag, owner, reason)
         returnValue(self._decode(tag) if tag is not None else None)
 
@@ -195,12 +237,14 @@ class TagpoolManager(object):
         new_tags = set(self._encode(tag) for tag in local_tags)
         old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
         old_tags = set(old_tags)
+        pipe = self.redis.pipeline()
         for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+            pipe.sadd(free_set_key, tag)
+            pipe.rpush(free_list_key, tag)
+        yield pipe.execute()
 
     def _tag_pool_reason_key(self, pool):
-        pool = self._encode(pool)
+        pool = self._pool_key_part(pool)
         return ":".join(["tagpools", pool, "reason:hash"])
 
     def _owner_tag_list_key(self, owner):
@@ -216,10 +260,12 @@ class TagpoolManager(object):
         reason['timestamp'] = time.time()
         reason['owner'] = owner
         reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
         owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
+        pipe = self.redis.pipeline()
+        pipe.hset(reason_hash_key, local_tag, json.dumps(reason))
+        pipe.sadd(owner_tag_list_key,
+                  json.dumps([pool, self._decode(local_tag)]))
+        yield pipe.execute()
 
     @Manager.calls_manager
     def _remove_reason(self, pool, local_tag):
@@ -226,6 +226,23 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual(event_keys, [ack_id])
         self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
 
+    @inlineCallbacks
+    def test_add_ack_event_with_object_cache(self):
+        from vumi.components.message_store import (
+            MessageStore, OutboundMessage)
+        self.store = MessageStore(
+            self.manager, self.redis, object_cache_ttl=10)
+        self.assertTrue(self.manager._object_cache.caches(OutboundMessage))
+
+        msg_id, msg, batch_id = yield self._create_outbound()
+        ack = self.msg_helper.make_ack(msg)
+        yield self.store.add_event(ack)
+
+        stored_ack = yield self.store.get_event(ack['event_id'])
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(stored_ack, ack)
+        self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
+
     @inlineCallbacks
     def test_add_ack_event_again(self):
         msg_id, msg, batch_id = yield self._create_outbound()
@@ -375,6 +392,30 @@ class TestMessageStore(TestMessageStoreBase):
             self.msg_helper.make_outbound("foo"), batch_id=batch_id)
         self.assertEqual(2, (yield self.store.batch_outbound_count(batch_id)))
 
+    @inlineCallbacks
+    def test_inbound_keys_pages(self):
+        msg_id, _msg, batch_id = yield self._create_inbound(by_batch=True)
+        msg = self.msg_helper.make_inbound("foo")
+        yield self.store.add_inbound_message(msg, batch_id=batch_id)
+        pages = []
+        for keys_page in self.store.batch_inbound_keys_pages(
+                batch_id, page_size=1):
+            pages.append((yield keys_page))
+        self.assertEqual(
+            sorted(pages), sorted([[msg_id], [msg['message_id']]]))
+
+    @inlineCallbacks
+    def test_outbound_keys_pages(self):
+        msg_id, _msg, batch_id = yield self._create_outbound(by_batch=True)
+        msg = self.msg_helper.make_outbound("foo")
+        yield self.store.add_outbound_message(msg, batch_id=batch_id)
+        pages = []
+        for keys_page in self.store.batch_outbound_keys_pages(
+                batch_id, page_size=1):
+            pages.append((yield keys_page))
+        self.assertEqual(
+            sorted(pages), sorted([[msg_id], [msg['message_id']]]))
+
     @inlineCallbacks
     def test_inbound_keys_matching(self):
         msg_id, msg, batch_id = yield self._create_inbound(content='hello')
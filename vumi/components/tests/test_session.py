@@ -35,6 +35,16 @@ class TestSessionManager(VumiTestCase):
         s1, s2 = yield get_sessions()
         self.assertTrue(s1[1]['created_at'] < s2[1]['created_at'])
 
+    @inlineCallbacks
+    def test_active_sessions_many_batches(self):
+        user_ids = ["u%d" % i for i in range(25)]
+        for user_id in user_ids:
+            yield self.sm.create_session(user_id, foo="bar")
+        yield self.sm.redis.set("other", "value")
+        sessions = yield self.sm.active_sessions()
+        self.assertEqual(sorted(s[0] for s in sessions), sorted(user_ids))
+        self.assertEqual(set(s[1]['foo'] for s in sessions), set(["bar"]))
+
     @inlineCallbacks
     def test_schedule_session_expiry(self):
         self.sm.max_session_length = 60.0
@@ -7,6 +7,8 @@ import json
 from twisted.internet.defer import inlineCallbacks
 
 from vumi.components.tagpool import TagpoolManager, TagpoolError
+from vumi.persist.redis_sharding import CrossShardError
+from vumi.persist.txredis_manager import ShardedTxRedisManager
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
@@ -174,6 +176,19 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.set_metadata("poolA", short_md)
         self.assertEqual((yield self.tpm.get_metadata("poolA")), short_md)
 
+    @inlineCallbacks
+    def test_metadata_cache(self):
+        tpm = TagpoolManager(self.redis, metadata_cache_ttl=60)
+        mkey = self.pool_key_generator("poolA")("metadata")
+        yield tpm.set_metadata("poolA", {"foo": "bar"})
+        self.assertEqual((yield tpm.get_metadata("poolA")), {"foo": "bar"})
+        # Changes made elsewhere aren't seen until the cached copy expires.
+        yield self.redis.hset(mkey, "foo", json.dumps("baz"))
+        self.assertEqual((yield tpm.get_metadata("poolA")), {"foo": "bar"})
+        # Changes made through the tagpool manager are seen immediately.
+        yield tpm.set_metadata("poolA", {"foo": "quux"})
+        self.assertEqual((yield tpm.get_metadata("poolA")), {"foo": "quux"})
+
     @inlineCallbacks
     def test_metadata_for_unicode_pool_name(self):
         pool = u"poöl"
@@ -275,6 +290,85 @@ class TestTxTagpoolManager(VumiTestCase):
         my_tags = yield self.tpm.owned_tags(u"me")
         self.assertEqual(my_tags, [tags[0]])
 
+    @inlineCallbacks
+    def test_hash_tag_keys(self):
+        tpm = TagpoolManager(self.redis, hash_tag_keys=True)
+        tkey = self.pool_key_generator("{poolA}")
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield tpm.declare_tags([tag1, tag2])
+        yield tpm.set_metadata("poolA", {"foo": "bar"})
+        self.assertEqual((yield tpm.acquire_tag("poolA")), tag1)
+        redis = self.redis
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag2"])
+        self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
+                         set(["tag1"]))
+        self.assertEqual((yield redis.hgetall(tkey("metadata"))),
+                         {"foo": '"bar"'})
+        self.assertNotEqual((yield redis.hget(tkey("reason:hash"), "tag1")),
+                            None)
+        yield tpm.release_tag(tag1)
+        self.assertEqual(sorted((yield tpm.free_tags("poolA"))),
+                         [tag1, tag2])
+
 
 class TestTagpoolManager(TestTxTagpoolManager):
     sync_persistence = True
+
+
+class TestShardedTagpoolManager(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield ShardedTxRedisManager.from_config({
+            'FAKE_REDIS': 'yes',
+            'key_prefix': 'tagpooltest',
+            'shards': [{}, {}],
+        })
+        self.add_cleanup(self.redis.close_manager)
+        self.tpm = TagpoolManager(self.redis, hash_tag_keys=True)
+
+    def split_pool(self):
+        """
+        Return a pool name whose unhashed free and in-use sets are on
+        different shards.
+        """
+        tpm = TagpoolManager(self.redis)
+        for i in range(100):
+            pool = "pool%d" % (i,)
+            _, free_set_key, inuse_set_key = tpm._tag_pool_keys(pool)
+            keys = [self.redis._key(free_set_key),
+                    self.redis._key(inuse_set_key)]
+            if len(self.redis._shard_indexes(keys)) > 1:
+                return pool
+
+    @inlineCallbacks
+    def test_acquire_and_release_tags(self):
+        tags = [("pool%d" % (i,), "tag") for i in range(10)]
+        yield self.tpm.declare_tags(tags)
+        for tag in tags:
+            self.assertEqual((yield self.tpm.acquire_tag(tag[0])), tag)
+            self.assertEqual((yield self.tpm.acquire_tag(tag[0])), None)
+            yield self.tpm.release_tag(tag)
+            self.assertEqual((yield self.tpm.free_tags(tag[0])), [tag])
+        # The pools are spread over both shards.
+        self.assertTrue(all(shard._client._data
+                            for shard in self.redis._shards))
+
+    @inlineCallbacks
+    def test_acquire_specific_tag(self):
+        pool = self.split_pool()
+        tag1, tag2 = (pool, "tag1"), (pool, "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        self.assertEqual((yield self.tpm.acquire_specific_tag(tag2)), tag2)
+        self.assertEqual((yield self.tpm.inuse_tags(pool)), [tag2])
+        self.assertEqual((yield self.tpm.acquire_tag(pool)), tag1)
+
+    @inlineCallbacks
+    def test_unhashed_keys_cross_shards(self):
+        tpm = TagpoolManager(self.redis)
+        pool = self.split_pool()
+        yield tpm.declare_tags([(pool, "tag1")])
+        yield self.assertFailure(tpm.acquire_tag(pool), CrossShardError)
+        yield self.assertFailure(
+            tpm.acquire_specific_tag((pool, "tag1")), CrossShardError)
@@ -2,6 +2,8 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
+from vumi.persist.redis_sharding import CrossShardError
+from vumi.persist.txredis_manager import ShardedTxRedisManager
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
@@ -103,6 +105,18 @@ class TestWindowManager(VumiTestCase):
             (yield self.wm.get_internal_id(self.window_id, "external_id")),
             None)
 
+    def test_hash_tag_keys(self):
+        wm = WindowManager(self.redis, hash_tag_keys=True)
+        self.add_cleanup(wm.stop)
+        self.assertEqual(wm.window_key(), 'windows')
+        self.assertEqual(wm.window_key('w1'), 'windows:{w1}')
+        self.assertEqual(wm.window_key('w1', 'k'), 'windows:{w1}:k')
+        self.assertEqual(wm.flight_key('w1'), 'windows:inflight:{w1}')
+        self.assertEqual(
+            wm.stats_key('w1', 'k'), 'windows:flightstats:{w1}:k')
+        self.assertEqual(wm.map_key('w1', 'internal', 'x'),
+                         'windows:keymap:{w1}:internal:x')
+
     @inlineCallbacks
     def assert_count_waiting(self, window_id, amount):
         self.assertEqual((yield self.wm.count_waiting(window_id)), amount)
@@ -250,3 +264,64 @@ class TestConcurrentWindowManager(VumiTestCase):
         yield self.wm.add(self.window_id, 2)
         yield self.wm._monitor_windows(lambda *a: True, True)
         self.assertEqual((yield self.wm.get_next_key(self.window_id)), None)
+
+
+class TestShardedWindowManager(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.redis = yield ShardedTxRedisManager.from_config({
+            'FAKE_REDIS': 'yes',
+            'key_prefix': 'windowtest',
+            'shards': [{}, {}],
+        })
+        self.add_cleanup(self.redis.close_manager)
+        self.clock = Clock()
+        self.patch(WindowManager, 'get_clock', lambda _: self.clock)
+
+    def mk_window_manager(self, **kw):
+        wm = WindowManager(self.redis, window_size=2, flight_lifetime=10, **kw)
+        self.add_cleanup(wm.stop)
+        return wm
+
+    def split_window_id(self, wm):
+        """
+        Return a window id whose waiting and in-flight lists are on
+        different shards.
+        """
+        for i in range(100):
+            window_id = "window%d" % (i,)
+            keys = [self.redis._key(wm.window_key(window_id)),
+                    self.redis._key(wm.flight_key(window_id))]
+            if len(self.redis._shard_indexes(keys)) > 1:
+                return window_id
+
+    @inlineCallbacks
+    def test_windows(self):
+        wm = self.mk_window_manager(hash_tag_keys=True)
+        window_ids = ["window%d" % (i,) for i in range(10)]
+        for window_id in window_ids:
+            yield wm.create_window(window_id)
+            yield wm.add(window_id, window_id)
+            yield wm.add(window_id, window_id)
+            yield wm.add(window_id, window_id)
+            key1 = yield wm.get_next_key(window_id)
+            key2 = yield wm.get_next_key(window_id)
+            self.assertEqual((yield wm.get_next_key(window_id)), None)
+            self.assertEqual((yield wm.get_data(window_id, key1)), window_id)
+            yield wm.remove_key(window_id, key1)
+            yield wm.remove_key(window_id, key2)
+            self.assertEqual((yield wm.count_in_flight(window_id)), 0)
+            self.assertEqual((yield wm.count_waiting(window_id)), 1)
+        self.assertEqual(sorted((yield wm.get_windows())), window_ids)
+        # The windows are spread over both shards.
+        self.assertTrue(all(shard._client._data
+                            for shard in self.redis._shards))
+
+    @inlineCallbacks
+    def test_unhashed_keys_cross_shards(self):
+        wm = self.mk_window_manager()
+        window_id = self.split_window_id(wm)
+        yield wm.create_window(window_id)
+        yield wm.add(window_id, 1)
+        yield self.assertFailure(wm.get_next_key(window_id), CrossShardError)
@@ -7,6 +7,31 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
+
+
+def _fake_get_next_key(call, keys, args):
+    window_key, inflight_key, stats_key = keys
+    if call('llen', inflight_key) >= int(args[0]):
+        return None
+    next_key = call('rpoplpush', window_key, inflight_key)
+    if next_key:
+        call('zadd', stats_key, **{next_key: float(args[1])})
+    return next_key
+
+
+# Moves the next waiting key into the flight if there's room and records
+# when it was sent.
+GET_NEXT_KEY_SCRIPT = RedisScript("""
+if redis.call('LLEN', KEYS[2]) >= tonumber(ARGV[1]) then
+    return nil
+end
+local next_key = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if next_key then
+    redis.call('ZADD', KEYS[3], ARGV[2], next_key)
+end
+return next_key
+""", fake_func=_fake_get_next_key)
 
 
 class WindowException(Exception):
@@ -14,6 +39,20 @@ class WindowException(Exception):
 
 
 class WindowManager(object):
+    """
+    Manages windows of keys waiting to be sent, limiting how many are in
+    flight at once.
+
+    If ``hash_tag_keys`` is set, the window id in each window's keys is a
+    hash tag (see :func:`vumi.persist.redis_sharding.hash_tag`), so all of a
+    window's keys are on the same shard of a sharded redis manager. Moving
+    keys into flight uses several of a window's keys at once, which a
+    sharded manager can only do on a single shard. This changes the key
+    names from ``windows:<window_id>...`` to ``windows:{<window_id>}...``
+    (and likewise for the in-flight, stats and map keys), so existing
+    windows must be emptied or renamed to the new keys before turning it
+    on.
+    """
 
     WINDOW_KEY = 'windows'
     FLIGHT_KEY = 'inflight'
@@ -21,7 +60,8 @@ class WindowManager(object):
     MAP_KEY = 'keymap'
 
     def __init__(self, redis, window_size=100, flight_lifetime=None,
-                gc_interval=10):
+                gc_interval=10, hash_tag_keys=False):
+        self.hash_tag_keys = hash_tag_keys
         self.window_size = window_size
         self.flight_lifetime = flight_lifetime or (gc_interval * window_size)
         self.redis = redis
@@ -51,17 +91,27 @@ class WindowManager(object):
             returnValue(True)
         returnValue(False)
 
+    def _key_parts(self, keys):
+        # The first part is the window id.
+        parts = map(unicode, keys)
+        if parts and self.hash_tag_keys:
+            parts[0] = u'{%s}' % (parts[0],)
+        return parts
+
     def window_key(self, *keys):
-        return ':'.join([self.WINDOW_KEY] + map(unicode, keys))
+        return ':'.join([self.WINDOW_KEY] + self._key_parts(keys))
 
     def flight_key(self, *keys):
-        return self.window_key(self.FLIGHT_KEY, *keys)
+        return ':'.join(
+            [self.WINDOW_KEY, self.FLIGHT_KEY] + self._key_parts(keys))
 
     def stats_key(self, *keys):
-        return self.window_key(self.FLIGHT_STATS_KEY, *keys)
+        return ':'.join(
+            [self.WINDOW_KEY, self.FLIGHT_STATS_KEY] + self._key_parts(keys))
 
     def map_key(self, *keys):
-        return self.window_key(self.MAP_KEY, *keys)
+        return ':'.join(
+            [self.WINDOW_KEY, self.MAP_KEY] + self._key_parts(keys))
 
     def get_clock(self):
         return reactor
@@ -99,32 +149,16 @@ class WindowManager(object):
 
     @inlineCallbacks
     def get_next_key(self, window_id):
-
         window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
-
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
-
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
-
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
-
-    def _clear_timestamp(self, window_id, flight_key):
-        return self.redis.zrem(self.stats_key(window_id), flight_key)
+        next_key = yield self.redis.run_script(GET_NEXT_KEY_SCRIPT, [
+            window_key,
+            self.flight_key(window_id),
+            self.stats_key(window_id),
+        ], [self.window_size, self.get_clocktime()])
+        if next_key:
+            log.debug('Moved %s from window %s to flight' % (
+                next_key, window_key))
+            returnValue(next_key)
 
     def count_waiting(self, window_id):
         window_key = self.window_key(window_id)
@@ -153,11 +187,16 @@ class WindowManager(object):
 
     @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        external_id = yield self.get_external_id(window_id, key)
+        pipe = self.redis.pipeline()
+        pipe.lrem(self.flight_key(window_id), key, 1)
+        pipe.delete(self.window_key(window_id, key))
+        pipe.delete(self.stats_key(window_id, key))
+        if external_id:
+            pipe.delete(self.map_key(window_id, 'external', key))
+            pipe.delete(self.map_key(window_id, 'internal', external_id))
+        pipe.zrem(self.stats_key(window_id), key)
+        yield pipe.execute()
 
     @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
@@ -94,6 +94,95 @@ class ConfigContext(object):
             setattr(self, k, v)
 
 
+class ConfigCache(object):
+    """A keyed cache for config objects with LRU and TTL eviction.
+
+    Building a config object validates every field, which is too expensive
+    to do for every message. Workers keep the config objects they build here,
+    keyed by whatever the per-message config depends on.
+
+    :param int max_size:
+        The maximum number of config objects to keep. The least recently used
+        object is dropped when this is exceeded.
+    :param float ttl:
+        The number of seconds to keep a config object for, or `None` to keep
+        it until it is evicted or invalidated.
+    :param clock:
+        An :class:`IReactorTime` provider. Defaults to the reactor.
+    """
+
+    # Indexes into the linked list entries.
+    PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, max_size=1000, ttl=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _unlink(self, entry):
+        prev_entry, next_entry = entry[self.PREV], entry[self.NEXT]
+        prev_entry[self.NEXT] = next_entry
+        next_entry[self.PREV] = prev_entry
+
+    def _link_last(self, entry):
+        root = self._root
+        last = root[self.PREV]
+        entry[self.PREV], entry[self.NEXT] = last, root
+        last[self.NEXT] = root[self.PREV] = entry
+
+    def get(self, key):
+        """Return the config object for `key` or `None` if there isn't one.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires = entry[self.EXPIRES]
+        if expires is not None and expires <= self.clock.seconds():
+            self.invalidate(key)
+            return None
+        self._unlink(entry)
+        self._link_last(entry)
+        return entry[self.VALUE]
+
+    def set(self, key, config):
+        """Store the config object for `key`."""
+        self.invalidate(key)
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock.seconds() + self.ttl
+        entry = [None, None, key, config, expires]
+        self._link_last(entry)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            self.invalidate(self._root[self.NEXT][self.KEY])
+
+    def invalidate(self, key):
+        """Drop the config object for `key`, if there is one.
+
+        `None` is a key like any other and only drops its own object. Use
+        :meth:`clear` to drop everything.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry)
+
+    def clear(self):
+        """Drop all config objects."""
+        self._root = root = [None, None, None, None, None]
+        root[self.PREV] = root[self.NEXT] = root
+        self._entries = {}
+
+
 # Re-export these for compatibility.
 from confmodel import Config
 from confmodel.errors import ConfigError
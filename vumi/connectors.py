@@ -1,14 +1,24 @@
 from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
 
 from vumi import log
-from vumi.message import TransportMessage, TransportEvent, TransportUserMessage
+from vumi.blinkenlights.metrics import Metric, LAST
+from vumi.message import (
+    TransportMessage, TransportEvent, TransportUserMessage, LazyTransportEvent,
+    LazyTransportUserMessage)
 from vumi.middleware import MiddlewareStack
+from vumi.service import WeightedConsumeSlots
 
 
 class IgnoreMessage(Exception):
     pass
 
 
+LAZY_MESSAGE_CLASSES = {
+    TransportUserMessage: LazyTransportUserMessage,
+    TransportEvent: LazyTransportEvent,
+}
+
+
 class BaseConnector(object):
     """Base class for 'connector' objects.
 
@@ -17,7 +27,12 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, concurrency=None, publisher_confirms=False,
+                 ack_batch_size=None, ack_batch_time=None,
+                 prefetch_min=None, prefetch_max=None,
+                 prefetch_target_latency=None, lazy_messages=False,
+                 content_type=None, priority_lanes=None,
+                 session_priority_lane=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -25,6 +40,18 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._concurrency = concurrency
+        self._publisher_confirms = publisher_confirms
+        self._ack_batch_size = ack_batch_size
+        self._ack_batch_time = ack_batch_time
+        self._prefetch_min = prefetch_min
+        self._prefetch_max = prefetch_max
+        self._prefetch_target_latency = prefetch_target_latency
+        self.prefetch_metrics = {}
+        self._priority_lanes = priority_lanes or {}
+        self._session_priority_lane = session_priority_lane
+        self._lazy_messages = lazy_messages
+        self._content_type = content_type
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -53,23 +80,64 @@ class BaseConnector(object):
         for consumer in self._consumers.values():
             consumer.unpause()
 
+    def _lane_key(self, mtype, lane):
+        if lane is None:
+            return mtype
+        return '%s.%s' % (mtype, lane)
+
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
-        self._publishers[mtype] = publisher
-        returnValue(publisher)
+        lanes = [None] + sorted(self._priority_lanes)
+        publishers = yield gatherResults([
+            self.worker.publish_to(
+                self._rkey(self._lane_key(mtype, lane)),
+                publisher_confirms=self._publisher_confirms,
+                content_type=self._content_type)
+            for lane in lanes])
+        for lane, publisher in zip(lanes, publishers):
+            self._publishers[self._lane_key(mtype, lane)] = publisher
+        returnValue(self._publishers[mtype])
 
     @inlineCallbacks
     def _setup_consumer(self, mtype, msg_class, default_handler):
         def handler(msg):
             return self._consume_message(mtype, msg)
 
-        consumer = yield self.worker.consume(
-            self._rkey(mtype), handler, message_class=msg_class, paused=True,
-            prefetch_count=self._prefetch_count)
-        self._consumers[mtype] = consumer
+        if self._lazy_messages:
+            msg_class = LAZY_MESSAGE_CLASSES.get(msg_class, msg_class)
+        lanes = [(None, 1)] + sorted(self._priority_lanes.items())
+        consume_slots = None
+        if self._priority_lanes:
+            consume_slots = WeightedConsumeSlots(self._concurrency or 1)
+        consumers = yield gatherResults([
+            self._start_consumer(
+                self._lane_key(mtype, lane), msg_class, handler,
+                consume_slots and consume_slots.lane(weight))
+            for lane, weight in lanes])
+        for (lane, _weight), consumer in zip(lanes, consumers):
+            self._consumers[self._lane_key(mtype, lane)] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
-        returnValue(consumer)
+        returnValue(self._consumers[mtype])
+
+    def _start_consumer(self, key, msg_class, handler, consume_slots):
+        prefetch_metric = None
+        if self._prefetch_max is not None:
+            # This is only updated once it is registered with a
+            # MetricManager, which the worker is responsible for.
+            prefetch_metric = Metric(
+                '%s.prefetch_window' % (self._rkey(key),), [LAST])
+            self.prefetch_metrics[key] = prefetch_metric
+        return self.worker.consume(
+            self._rkey(key), handler, message_class=msg_class, paused=True,
+            prefetch_count=self._prefetch_count,
+            concurrency=self._concurrency,
+            ack_batch_size=self._ack_batch_size,
+            ack_batch_time=self._ack_batch_time,
+            prefetch_min=self._prefetch_min,
+            prefetch_max=self._prefetch_max,
+            prefetch_target_latency=self._prefetch_target_latency,
+            prefetch_metric=prefetch_metric,
+            consume_slots=consume_slots)
 
     def _set_endpoint_handler(self, mtype, handler, endpoint_name):
         if endpoint_name is None:
@@ -94,7 +162,27 @@ class BaseConnector(object):
         if endpoint_name is not None:
             msg.set_routing_endpoint(endpoint_name)
         d = self._middlewares.apply_publish(mtype, msg, self.name)
-        return d.addCallback(self._publishers[mtype].publish_message)
+        return d.addCallback(self._publish_to_lane, mtype)
+
+    def get_priority_lane(self, msg):
+        """
+        Return the name of the priority lane a message should be published
+        to, or `None` for the default lane.
+
+        The lane is taken from the `priority_lane` helper metadata field. If
+        that isn't set, messages that are part of a session use the session
+        priority lane. Lanes that aren't configured are ignored.
+        """
+        lane = msg.get('helper_metadata', {}).get('priority_lane')
+        if lane is None and msg.get('session_event') is not None:
+            lane = self._session_priority_lane
+        if lane not in self._priority_lanes:
+            return None
+        return lane
+
+    def _publish_to_lane(self, msg, mtype):
+        key = self._lane_key(mtype, self.get_priority_lane(msg))
+        return self._publishers[key].publish_message(msg)
 
     def _ignore_message(self, failure, msg):
         failure.trap(IgnoreMessage)
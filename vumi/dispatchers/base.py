@@ -5,15 +5,19 @@
 import re
 import functools
 
-from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults)
 
 from vumi.service import Worker
 from vumi.errors import ConfigError
-from vumi.message import TransportUserMessage, TransportEvent
+from vumi.message import (
+    TransportUserMessage, TransportEvent, LazyTransportUserMessage,
+    LazyTransportEvent)
 from vumi.utils import load_class_by_string, get_first_word
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
 from vumi.components.session import SessionManager
+from vumi.persist.redis_cache import CachedRedisManager
 from vumi.persist.txredis_manager import TxRedisManager
 
 
@@ -28,6 +32,13 @@ class BaseDispatchWorker(Worker):
                 % (self.__class__.__name__, self.config))
 
         self.amqp_prefetch_count = self.config.get('amqp_prefetch_count', 20)
+        self.amqp_concurrency = self.config.get('amqp_concurrency', 1)
+        if self.config.get('lazy_message_decoding', False):
+            self.user_message_class = LazyTransportUserMessage
+            self.event_class = LazyTransportEvent
+        else:
+            self.user_message_class = TransportUserMessage
+            self.event_class = TransportEvent
         yield self.setup_endpoints()
         yield self.setup_middleware()
         yield self.setup_router()
@@ -70,49 +81,63 @@ class BaseDispatchWorker(Worker):
     @inlineCallbacks
     def setup_transport_publishers(self):
         self.transport_publisher = {}
-        for transport_name in self.transport_names:
-            self.transport_publisher[transport_name] = yield self.publish_to(
-                '%s.outbound' % (transport_name,))
+        publishers = yield gatherResults([
+            self.publish_to('%s.outbound' % (transport_name,))
+            for transport_name in self.transport_names])
+        self.transport_publisher.update(zip(self.transport_names, publishers))
 
     @inlineCallbacks
     def setup_transport_consumers(self):
         self.transport_consumer = {}
         self.transport_event_consumer = {}
-        for transport_name in self.transport_names:
-            self.transport_consumer[transport_name] = yield self.consume(
+        consumers = yield gatherResults([
+            self.consume(
                 '%s.inbound' % (transport_name,),
                 functools.partial(self.dispatch_inbound_message,
                                   transport_name),
-                message_class=TransportUserMessage, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
-        for transport_name in self.transport_names:
-            self.transport_event_consumer[transport_name] = yield self.consume(
+                message_class=self.user_message_class, paused=True,
+                prefetch_count=self.amqp_prefetch_count,
+                concurrency=self.amqp_concurrency)
+            for transport_name in self.transport_names])
+        self.transport_consumer.update(zip(self.transport_names, consumers))
+        consumers = yield gatherResults([
+            self.consume(
                 '%s.event' % (transport_name,),
                 functools.partial(self.dispatch_inbound_event, transport_name),
-                message_class=TransportEvent, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
+                message_class=self.event_class, paused=True,
+                prefetch_count=self.amqp_prefetch_count,
+                concurrency=self.amqp_concurrency)
+            for transport_name in self.transport_names])
+        self.transport_event_consumer.update(
+            zip(self.transport_names, consumers))
 
     @inlineCallbacks
     def setup_exposed_publishers(self):
         self.exposed_publisher = {}
         self.exposed_event_publisher = {}
-        for exposed_name in self.exposed_names:
-            self.exposed_publisher[exposed_name] = yield self.publish_to(
-                '%s.inbound' % (exposed_name,))
-        for exposed_name in self.exposed_names:
-            self.exposed_event_publisher[exposed_name] = yield self.publish_to(
-                '%s.event' % (exposed_name,))
+        publishers = yield gatherResults([
+            self.publish_to('%s.inbound' % (exposed_name,))
+            for exposed_name in self.exposed_names])
+        self.exposed_publisher.update(zip(self.exposed_names, publishers))
+        publishers = yield gatherResults([
+            self.publish_to('%s.event' % (exposed_name,))
+            for exposed_name in self.exposed_names])
+        self.exposed_event_publisher.update(
+            zip(self.exposed_names, publishers))
 
     @inlineCallbacks
     def setup_exposed_consumers(self):
         self.exposed_consumer = {}
-        for exposed_name in self.exposed_names:
-            self.exposed_consumer[exposed_name] = yield self.consume(
+        consumers = yield gatherResults([
+            self.consume(
                 '%s.outbound' % (exposed_name,),
                 functools.partial(self.dispatch_outbound_message,
                                   exposed_name),
-                message_class=TransportUserMessage, paused=True,
-                prefetch_count=self.amqp_prefetch_count)
+                message_class=self.user_message_class, paused=True,
+                prefetch_count=self.amqp_prefetch_count,
+                concurrency=self.amqp_concurrency)
+            for exposed_name in self.exposed_names])
+        self.exposed_consumer.update(zip(self.exposed_names, consumers))
 
     def dispatch_inbound_message(self, endpoint, msg):
         d = self._middlewares.apply_consume("inbound", msg, endpoint)
@@ -389,6 +414,10 @@ class UserGroupingRouter(SimpleDispatchRouter):
     :param str dispatcher_name:
         The name of the dispatcher, used internally as
         the prefix for Redis keys.
+
+    :param float user_group_cache_lifetime:
+        If set, user to group assignments are cached in
+        memory for this many seconds. Defaults to no caching.
     """
 
     def setup_routing(self):
@@ -404,6 +433,11 @@ class UserGroupingRouter(SimpleDispatchRouter):
 
     def _setup_redis(self, redis):
         self.redis = redis
+        self.user_redis = redis
+        cache_lifetime = self.config.get('user_group_cache_lifetime')
+        if cache_lifetime:
+            self.user_redis = CachedRedisManager(
+                redis, cache_lifetime, cached_calls=['get'])
 
     @inlineCallbacks
     def get_next_group(self):
@@ -416,10 +450,10 @@ class UserGroupingRouter(SimpleDispatchRouter):
     @inlineCallbacks
     def get_group_for_user(self, user_id):
         user_key = "user:%s" % (user_id,)
-        group = yield self.redis.get(user_key)
+        group = yield self.user_redis.get(user_key)
         if not group:
             group, transport_name = yield self.get_next_group()
-            yield self.redis.set(user_key, group)
+            yield self.user_redis.set(user_key, group)
         returnValue(group)
 
     @inlineCallbacks
@@ -419,6 +419,20 @@ class TestUserGroupingRouter(VumiTestCase):
             'group2',
         ])
 
+    @inlineCallbacks
+    def test_user_group_cache(self):
+        self.router.config['user_group_cache_lifetime'] = 60
+        self.router._setup_redis(self.redis)
+        group = yield self.router.get_group_for_user('user1')
+        # Storing the assignment clears the cached lookup, so it's cached on
+        # the next lookup and then used even if redis is changed elsewhere.
+        self.assertEqual(
+            (yield self.router.get_group_for_user('user1')), group)
+        yield self.redis.set('user:user1', 'group3')
+        self.assertEqual(
+            (yield self.router.get_group_for_user('user1')), group)
+        self.assertEqual((yield self.redis.get('user:user1')), 'group3')
+
     def make_inbound_from(self, from_addr):
         return self.disp_helper.make_inbound("foo", from_addr=from_addr)
 
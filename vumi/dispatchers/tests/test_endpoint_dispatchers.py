@@ -208,6 +208,38 @@ class TestRoutingTableDispatcher(VumiTestCase):
         self.assert_dispatched_endpoint(
             msg, 'ep1', self.ch('app1').get_dispatched_events())
 
+    @inlineCallbacks
+    def test_lazy_message_routing(self):
+        routed = []
+        process_inbound = RoutingTableDispatcher.process_inbound
+
+        def record_inbound(self, config, msg, connector_name):
+            routed.append((type(msg).__name__, msg.is_decoded))
+            return process_inbound(self, config, msg, connector_name)
+
+        self.patch(RoutingTableDispatcher, 'process_inbound', record_inbound)
+        yield self.get_dispatcher(lazy_message_decoding=True)
+
+        msg = yield self.ch("transport2").make_dispatch_inbound(
+            "inbound", endpoint='ep1')
+        self.assert_rkeys_used('transport2.inbound', 'app1.inbound')
+        self.assert_dispatched_endpoint(
+            msg, 'ep1', self.ch('app1').get_dispatched_inbound())
+        self.assertEqual(routed, [('LazyTransportUserMessage', False)])
+
+        self.disp_helper.clear_all_dispatched()
+        msg = yield self.ch('app1').make_dispatch_outbound(
+            "outbound", endpoint='ep2')
+        self.assert_rkeys_used('app1.outbound', 'transport2.outbound')
+        self.assert_dispatched_endpoint(
+            msg, 'default', self.ch('transport2').get_dispatched_outbound())
+
+        self.disp_helper.clear_all_dispatched()
+        msg = yield self.ch('transport2').make_dispatch_ack(endpoint='ep1')
+        self.assert_rkeys_used('transport2.event', 'app1.event')
+        self.assert_dispatched_endpoint(
+            msg, 'ep1', self.ch('app1').get_dispatched_events())
+
     def get_dispatcher_consumers(self, dispatcher):
         consumers = []
         for conn in dispatcher.connectors.values():
@@ -26,6 +26,17 @@ class InvalidEndpoint(VumiError):
     """Raised when attempting to send a message to an invalid endpoint."""
 
 
+class PublisherNackError(VumiError):
+    """Raised when the AMQP broker rejects a published message."""
+
+
+class PublisherConfirmLostError(VumiError):
+    """
+    Raised when the AMQP channel closes before a published message is
+    confirmed.
+    """
+
+
 # Re-export this for compatibility.
 from confmodel.errors import ConfigError
 
@@ -1,10 +1,12 @@
 # -*- test-case-name: vumi.tests.test_message -*-
 
 import json
+import re
+from copy import deepcopy
 from uuid import uuid4
 from datetime import datetime
 
-from errors import MissingMessageField, InvalidMessageField
+from errors import MissingMessageField, InvalidMessageField, VumiError
 
 from vumi.utils import to_kwargs
 
@@ -12,6 +14,16 @@ from vumi.utils import to_kwargs
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# AMQP content types for the message wire formats we support. Messages without
+# a content type are JSON.
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+WIRE_FORMAT_CONTENT_TYPES = {
+    'json': JSON_CONTENT_TYPE,
+    'msgpack': MSGPACK_CONTENT_TYPE,
+}
+
 
 def date_time_decoder(json_object):
     for key, value in json_object.items():
@@ -25,6 +37,27 @@ def date_time_decoder(json_object):
     return json_object
 
 
+def parse_vumi_date(value):
+    """
+    Parse a string in `VUMI_DATE_FORMAT` into a datetime.
+
+    Dates written by :class:`JSONMessageEncoder` always have the same layout,
+    so we slice those up directly and only fall back to the (much slower)
+    :meth:`datetime.strptime` for anything else.
+    """
+    if (len(value) == 26 and value[4] == '-' and value[7] == '-'
+            and value[10] == ' ' and value[13] == ':' and value[16] == ':'
+            and value[19] == '.'):
+        try:
+            return datetime(
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                int(value[20:26]))
+        except ValueError:
+            pass
+    return datetime.strptime(value, VUMI_DATE_FORMAT)
+
+
 class JSONMessageEncoder(json.JSONEncoder):
     """A JSON encoder that is able to serialize datetime"""
     def default(self, obj):
@@ -33,12 +66,175 @@ class JSONMessageEncoder(json.JSONEncoder):
         return super(JSONMessageEncoder, self).default(obj)
 
 
+# These are stateless, so we build them once instead of on every call. We use
+# the stdlib json module (and its C speedups) rather than a third-party
+# library because the output needs to be byte-for-byte the same.
+_json_encoder = JSONMessageEncoder()
+_json_decoder = json.JSONDecoder()
+
+# Matches JSON strings (so we can skip them) and the brackets that nest
+# objects and arrays.
+_JSON_NESTING_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+
+def _json_depth(json_string, pos):
+    """
+    Return how deeply nested in objects and arrays `pos` in `json_string` is.
+    """
+    depth = 0
+    for match in _JSON_NESTING_RE.finditer(json_string, 0, pos):
+        token = match.group()
+        if token in '{[':
+            depth += 1
+        elif token in '}]':
+            depth -= 1
+    return depth
+
+
 def from_json(json_string):
     return json.loads(json_string, object_hook=date_time_decoder)
 
 
 def to_json(obj):
-    return json.dumps(obj, cls=JSONMessageEncoder)
+    return _json_encoder.encode(obj)
+
+
+def _looks_like_vumi_date(value):
+    # Every string that :meth:`datetime.strptime` accepts for
+    # `VUMI_DATE_FORMAT` passes this check. We write 26 characters, but the
+    # month, day, time and microsecond parts may be shorter.
+    return (16 <= len(value) <= 26 and value[4] == '-' and ' ' in value
+            and '.' in value)
+
+
+def _decode_nested_dates(obj):
+    """
+    Convert date strings nested inside a decoded JSON value to datetimes.
+
+    This does the same job as :func:`date_time_decoder`, but it only calls
+    :func:`parse_vumi_date` on strings shaped like the dates we write.
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            if isinstance(value, basestring):
+                if _looks_like_vumi_date(value):
+                    try:
+                        obj[key] = parse_vumi_date(value)
+                    except ValueError:
+                        pass
+            elif isinstance(value, (dict, list)):
+                _decode_nested_dates(value)
+    elif isinstance(obj, list):
+        for item in obj:
+            if isinstance(item, (dict, list)):
+                _decode_nested_dates(item)
+
+
+def _decode_dates(obj, datetime_fields):
+    for key, value in obj.iteritems():
+        if isinstance(value, basestring):
+            if key in datetime_fields or _looks_like_vumi_date(value):
+                try:
+                    obj[key] = parse_vumi_date(value)
+                except ValueError:
+                    pass
+        elif isinstance(value, (dict, list)):
+            _decode_nested_dates(value)
+    return obj
+
+
+def from_json_with_dates(json_string, datetime_fields):
+    """
+    Decode a JSON object whose top-level datetime fields are known.
+
+    The named top-level fields are always converted to datetimes. Other
+    strings anywhere in the object are converted if they are dates, as
+    :func:`from_json` does, so extra datetime fields still round-trip.
+    """
+    return _decode_dates(_json_decoder.decode(json_string), datetime_fields)
+
+
+def copy_payload(value):
+    """
+    Make a deep copy of a message payload.
+
+    Payloads are made of dicts, lists and immutable values (strings, numbers,
+    datetimes, etc.), so we only need to copy the containers. This is much
+    cheaper than both :func:`copy.deepcopy` and a round trip through JSON.
+    Tuples become lists, as they would in JSON.
+    """
+    if isinstance(value, dict):
+        return dict((k, copy_payload(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [copy_payload(v) for v in value]
+    if isinstance(value, (basestring, int, long, float, datetime)):
+        return value
+    if value is None:
+        return value
+    return deepcopy(value)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return obj.strftime(VUMI_DATE_FORMAT)
+    raise TypeError("%r is not MessagePack serializable" % (obj,))
+
+
+def _get_msgpack():
+    # msgpack is optional, so it's only imported when it's used.
+    try:
+        import msgpack
+    except ImportError:
+        raise VumiError("The msgpack wire format requires the 'msgpack'"
+                        " package (version 0.5.2 or later).")
+    return msgpack
+
+
+def to_msgpack(obj):
+    """
+    Encode an object with MessagePack.
+
+    Datetimes are written as strings in `VUMI_DATE_FORMAT` and all strings
+    are written as (UTF-8) text, so a round trip gives the same result as
+    :func:`to_json` followed by :func:`from_json_with_dates`.
+    """
+    return _get_msgpack().packb(
+        obj, default=_msgpack_default, use_bin_type=False)
+
+
+def from_msgpack_with_dates(data, datetime_fields):
+    """
+    Decode a MessagePack object. Dates are converted in the same way as
+    :func:`from_json_with_dates` does it. If `datetime_fields` is `None`,
+    dates anywhere in the object are converted.
+    """
+    obj = _get_msgpack().unpackb(data, raw=False)
+    if datetime_fields is None:
+        _decode_nested_dates(obj)
+        return obj
+    return _decode_dates(obj, datetime_fields)
+
+
+# Marker for payload fields that are not set.
+_MISSING = object()
+
+# Marker for an empty dict field that has not been created yet. Most messages
+# have empty metadata dicts, so we only create them when they are used.
+_EMPTY_DICT = object()
+
+
+def _field_slots(fields):
+    """
+    Return the `__slots__` for a set of compact payload fields.
+    """
+    return tuple('_f_%s' % (field,) for field in fields)
+
+
+def _field_slot_map(fields):
+    """
+    Return a mapping from compact payload field names to their slots.
+    """
+    return dict(zip(fields, _field_slots(fields)))
 
 
 class Message(object):
@@ -49,14 +245,123 @@ class Message(object):
 
     scary transport format -> Vumi Tansport -> Unified Message -> Vumi Worker
 
+    Subclasses may list their standard payload fields in `COMPACT_FIELDS`.
+    These are stored in slots (with any other fields in an overflow dict)
+    rather than in a payload dict, which uses much less memory. Item access
+    works directly on the slots. The first time :attr:`payload` is used, a
+    payload dict is built and the message uses that from then on.
     """
 
+    __slots__ = ('_payload', '_extra')
+
+    # Top-level payload fields that hold datetimes. These are the only fields
+    # that are decoded as datetimes when the message is loaded from JSON. If
+    # this is `None`, we don't know what fields the message has and we try to
+    # decode every value in the payload (including nested ones) instead.
+    DATETIME_FIELDS = None
+
+    # Payload fields that are stored in slots. Subclasses that add to this
+    # must add the matching `__slots__` and `_FIELD_SLOTS`.
+    COMPACT_FIELDS = ()
+    _FIELD_SLOTS = {}
+    # Compact fields that are usually empty dicts. The dict is only created
+    # when the field is used.
+    LAZY_DICT_FIELDS = ()
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
+            lazy_dict_fields = [
+                f for f in self.LAZY_DICT_FIELDS if f not in kwargs]
             kwargs = self.process_fields(kwargs)
-        self.payload = kwargs
+        else:
+            # These fields come from a decoder or a copy, so nobody else has
+            # a reference to them.
+            lazy_dict_fields = self.LAZY_DICT_FIELDS
+        self._payload = None
+        self._extra = None
+        if self._FIELD_SLOTS:
+            self._set_fields(kwargs, lazy_dict_fields)
+        else:
+            self._payload = kwargs
         self.validate_fields()
 
+    def _set_fields(self, fields, lazy_dict_fields=()):
+        slots = self._FIELD_SLOTS
+        for key, value in fields.iteritems():
+            slot = slots.get(key)
+            if slot is None:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+                continue
+            if (key in lazy_dict_fields and type(value) is dict
+                    and not value):
+                value = _EMPTY_DICT
+            setattr(self, slot, value)
+
+    def _clear_fields(self):
+        for slot in self._FIELD_SLOTS.itervalues():
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                pass
+        self._extra = None
+
+    def _get_field(self, key, create=True):
+        slot = self._FIELD_SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                return _MISSING
+            return self._extra.get(key, _MISSING)
+        value = getattr(self, slot, _MISSING)
+        if value is _EMPTY_DICT and create:
+            value = {}
+            setattr(self, slot, value)
+        return value
+
+    def _set_field(self, key, value):
+        slot = self._FIELD_SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        else:
+            setattr(self, slot, value)
+
+    def _fields_dict(self):
+        """
+        Return the payload as a dict without switching to a payload dict.
+
+        Empty dict fields that haven't been created yet are returned as new
+        dicts, so the result should only be read.
+        """
+        if self._payload is not None:
+            return self._payload
+        fields = {}
+        for key, slot in self._FIELD_SLOTS.iteritems():
+            value = getattr(self, slot, _MISSING)
+            if value is _MISSING:
+                continue
+            if value is _EMPTY_DICT:
+                value = {}
+            fields[key] = value
+        if self._extra:
+            fields.update(self._extra)
+        return fields
+
+    def _get_payload(self):
+        if self._payload is None:
+            payload = self._fields_dict()
+            self._clear_fields()
+            self._payload = payload
+        return self._payload
+
+    def _set_payload(self, payload):
+        self._clear_fields()
+        self._payload = payload
+
+    payload = property(_get_payload, _set_payload)
+
     def process_fields(self, fields):
         return fields
 
@@ -65,49 +370,113 @@ class Message(object):
 
     def assert_field_present(self, *fields):
         for field in fields:
-            if field not in self.payload:
+            if field not in self:
                 raise MissingMessageField(field)
 
     def assert_field_value(self, field, *values):
         self.assert_field_present(field)
-        if self.payload[field] not in values:
+        if self[field] not in values:
             raise InvalidMessageField(field)
 
     def to_json(self):
-        return to_json(self.payload)
+        return to_json(self._fields_dict())
 
     @classmethod
     def from_json(cls, json_string):
-        return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
+        if cls.DATETIME_FIELDS is None:
+            payload = from_json(json_string)
+        else:
+            payload = from_json_with_dates(json_string, cls.DATETIME_FIELDS)
+        return cls(_process_fields=False, **to_kwargs(payload))
+
+    def to_msgpack(self):
+        return to_msgpack(self._fields_dict())
+
+    @classmethod
+    def from_msgpack(cls, data):
+        payload = from_msgpack_with_dates(data, cls.DATETIME_FIELDS)
+        return cls(_process_fields=False, **to_kwargs(payload))
+
+    def to_wire(self, content_type=None):
+        """
+        Encode the message for AMQP using the wire format for `content_type`.
+        """
+        if content_type in (None, JSON_CONTENT_TYPE):
+            return self.to_json()
+        if content_type == MSGPACK_CONTENT_TYPE:
+            return self.to_msgpack()
+        raise VumiError("Unsupported content type: %r" % (content_type,))
+
+    @classmethod
+    def from_wire(cls, data, content_type=None):
+        """
+        Decode a message from AMQP using the wire format for `content_type`.
+        """
+        if content_type in (None, JSON_CONTENT_TYPE):
+            return cls.from_json(data)
+        if content_type == MSGPACK_CONTENT_TYPE:
+            return cls.from_msgpack(data)
+        raise VumiError("Unsupported content type: %r" % (content_type,))
 
     def __str__(self):
-        return u"<Message payload=\"%s\">" % repr(self.payload)
+        return u"<Message payload=\"%s\">" % repr(self._fields_dict())
 
     def __repr__(self):
         return str(self)
 
+    def __getstate__(self):
+        # Slots hold sentinels (like `_EMPTY_DICT`) that mustn't end up in
+        # copies or pickles, so we only save the payload.
+        return self._fields_dict()
+
+    def __setstate__(self, state):
+        self._payload = None
+        self._extra = None
+        if self._FIELD_SLOTS:
+            self._set_fields(state, self.LAZY_DICT_FIELDS)
+        else:
+            self._payload = state
+
     def __eq__(self, other):
         if isinstance(other, Message):
-            return self.payload == other.payload
+            return self._fields_dict() == other._fields_dict()
         return False
 
     def __contains__(self, key):
-        return key in self.payload
+        if self._payload is not None:
+            return key in self._payload
+        return self._get_field(key, create=False) is not _MISSING
 
     def __getitem__(self, key):
-        return self.payload[key]
+        if self._payload is not None:
+            return self._payload[key]
+        value = self._get_field(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
-        self.payload[key] = value
+        if self._payload is not None:
+            self._payload[key] = value
+        else:
+            self._set_field(key, value)
 
     def get(self, key, default=None):
-        return self.payload.get(key, default)
+        if self._payload is not None:
+            return self._payload.get(key, default)
+        value = self._get_field(key)
+        if value is _MISSING:
+            return default
+        return value
 
     def items(self):
-        return self.payload.items()
+        if self._payload is not None:
+            return self._payload.items()
+        return [(key, self[key]) for key in self._fields_dict()]
 
     def copy(self):
-        return self.from_json(self.to_json())
+        return type(self)(
+            _process_fields=False, **copy_payload(self._fields_dict()))
 
 
 class TransportMessage(Message):
@@ -117,6 +486,16 @@ class TransportMessage(Message):
     MESSAGE_TYPE = None
     MESSAGE_VERSION = '20110921'
     DEFAULT_ENDPOINT_NAME = 'default'
+    DATETIME_FIELDS = ('timestamp',)
+
+    _TRANSPORT_MESSAGE_FIELDS = (
+        'message_version', 'message_type', 'timestamp', 'routing_metadata',
+        'helper_metadata', 'transport_name', 'transport_metadata')
+    __slots__ = _field_slots(_TRANSPORT_MESSAGE_FIELDS)
+    COMPACT_FIELDS = _TRANSPORT_MESSAGE_FIELDS
+    _FIELD_SLOTS = _field_slot_map(COMPACT_FIELDS)
+    LAZY_DICT_FIELDS = (
+        'routing_metadata', 'helper_metadata', 'transport_metadata')
 
     @staticmethod
     def generate_id():
@@ -141,7 +520,8 @@ class TransportMessage(Message):
         self.assert_field_value('message_version', self.MESSAGE_VERSION)
         # We might get older event messages without the `helper_metadata`
         # field.
-        self.payload.setdefault('helper_metadata', {})
+        if 'helper_metadata' not in self:
+            self['helper_metadata'] = {}
         self.assert_field_present(
             'message_type',
             'timestamp',
@@ -152,7 +532,9 @@ class TransportMessage(Message):
 
     @property
     def routing_metadata(self):
-        return self.payload.setdefault('routing_metadata', {})
+        if 'routing_metadata' not in self:
+            self['routing_metadata'] = {}
+        return self['routing_metadata']
 
     @classmethod
     def check_routing_endpoint(cls, endpoint_name):
@@ -180,6 +562,13 @@ class TransportUserMessage(TransportMessage):
 
     MESSAGE_TYPE = 'user_message'
 
+    _USER_MESSAGE_FIELDS = (
+        'message_id', 'to_addr', 'from_addr', 'in_reply_to', 'session_event',
+        'content', 'transport_type', 'group')
+    __slots__ = _field_slots(_USER_MESSAGE_FIELDS)
+    COMPACT_FIELDS = TransportMessage.COMPACT_FIELDS + _USER_MESSAGE_FIELDS
+    _FIELD_SLOTS = _field_slot_map(COMPACT_FIELDS)
+
     # session event constants
     #
     # SESSION_NONE, SESSION_NEW, SESSION_RESUME, and SESSION_CLOSE
@@ -223,7 +612,8 @@ class TransportUserMessage(TransportMessage):
     def validate_fields(self):
         super(TransportUserMessage, self).validate_fields()
         # We might get older message versions without the `group` field.
-        self.payload.setdefault('group', None)
+        if 'group' not in self:
+            self['group'] = None
         self.assert_field_present(
             'message_id',
             'to_addr',
@@ -338,6 +728,13 @@ class TransportEvent(TransportMessage):
     """
     MESSAGE_TYPE = 'event'
 
+    _EVENT_FIELDS = (
+        'event_id', 'event_type', 'user_message_id', 'sent_message_id',
+        'delivery_status', 'nack_reason')
+    __slots__ = _field_slots(_EVENT_FIELDS)
+    COMPACT_FIELDS = TransportMessage.COMPACT_FIELDS + _EVENT_FIELDS
+    _FIELD_SLOTS = _field_slot_map(COMPACT_FIELDS)
+
     # list of valid delivery statuses
     DELIVERY_STATUSES = frozenset(('pending', 'failed', 'delivered'))
 
@@ -364,10 +761,138 @@ class TransportEvent(TransportMessage):
             'event_id',
             'event_type',
             )
-        event_type = self.payload['event_type']
+        event_type = self['event_type']
         if event_type not in self.EVENT_TYPES:
             raise InvalidMessageField("Unknown event_type %r" % (event_type,))
         for extra_field, check in self.EVENT_TYPES[event_type].items():
             self.assert_field_present(extra_field)
             if not check(self[extra_field]):
                 raise InvalidMessageField(extra_field)
+
+
+# Slots for the undecoded JSON and the decoded envelope of lazy messages.
+_LAZY_SLOTS = ('_json', '_envelope_span', '_routing_metadata')
+
+
+class LazyTransportMessageMixin(object):
+    """
+    Mixin for transport messages that only decode their routing envelope.
+
+    Routing-only workers (such as dispatchers) usually only need a message's
+    `routing_metadata`. Messages built with :meth:`from_json` keep the
+    original JSON and decode only the top-level `routing_metadata` object.
+    The rest of the message is decoded the first time it is used.
+
+    If the message has not been decoded, :meth:`to_json` reuses the original
+    JSON and only re-encodes `routing_metadata`. Once the message has been
+    decoded it may have been changed, so the whole message is encoded as
+    usual.
+
+    Classes using this mixin must add :data:`_LAZY_SLOTS` to their
+    `__slots__`. The mixin has no slots of its own, because it can't share
+    an instance layout with the message classes it is mixed into.
+    """
+
+    __slots__ = ()
+
+    _ENVELOPE_KEY = '"routing_metadata": '
+
+    def __init__(self, *args, **kw):
+        # Messages built from fields (rather than JSON) start out decoded.
+        self._json = None
+        super(LazyTransportMessageMixin, self).__init__(*args, **kw)
+
+    @classmethod
+    def from_json(cls, json_string):
+        key = cls._ENVELOPE_KEY
+        key_start = json_string.find(key)
+        # A key can't appear inside a JSON string because its quotes would
+        # be escaped, but it can appear in a nested object. If there is more
+        # than one we can't tell which is ours, and if the only one is nested
+        # it isn't ours, so we decode everything.
+        if (key_start == -1 or
+                json_string.find(key, key_start + 1) != -1 or
+                _json_depth(json_string, key_start) != 1):
+            return super(LazyTransportMessageMixin, cls).from_json(
+                json_string)
+        start = key_start + len(key)
+        routing_metadata, end = _json_decoder.raw_decode(
+            json_string, idx=start)
+        if not isinstance(routing_metadata, dict):
+            return super(LazyTransportMessageMixin, cls).from_json(
+                json_string)
+        msg = cls.__new__(cls)
+        msg._payload = None
+        msg._extra = None
+        msg._json = json_string
+        msg._envelope_span = (start, end)
+        msg._routing_metadata = routing_metadata
+        return msg
+
+    def __setstate__(self, state):
+        # Copies and pickles are made from the decoded payload.
+        self._json = None
+        super(LazyTransportMessageMixin, self).__setstate__(state)
+
+    @property
+    def is_decoded(self):
+        return self._json is None
+
+    def _decode(self):
+        fields = to_kwargs(
+            from_json_with_dates(self._json, self.DATETIME_FIELDS))
+        self._json = None
+        self._set_fields(fields, self.LAZY_DICT_FIELDS)
+        # Keep the envelope object, because it may already have been
+        # modified.
+        self._set_field('routing_metadata', self._routing_metadata)
+        del self._routing_metadata, self._envelope_span
+        self.validate_fields()
+
+    def _get_field(self, key, create=True):
+        if self._json is not None:
+            self._decode()
+        return super(LazyTransportMessageMixin, self)._get_field(key, create)
+
+    def _set_field(self, key, value):
+        if self._json is not None:
+            self._decode()
+        super(LazyTransportMessageMixin, self)._set_field(key, value)
+
+    def _fields_dict(self):
+        if self._json is not None:
+            self._decode()
+        return super(LazyTransportMessageMixin, self)._fields_dict()
+
+    def _clear_fields(self):
+        if self._json is not None:
+            self._json = None
+            del self._routing_metadata, self._envelope_span
+        super(LazyTransportMessageMixin, self)._clear_fields()
+
+    @property
+    def routing_metadata(self):
+        if self._json is not None:
+            return self._routing_metadata
+        return super(LazyTransportMessageMixin, self).routing_metadata
+
+    def to_json(self):
+        if self._json is None:
+            return super(LazyTransportMessageMixin, self).to_json()
+        start, end = self._envelope_span
+        return ''.join([
+            self._json[:start], to_json(self._routing_metadata),
+            self._json[end:]])
+
+
+class LazyTransportUserMessage(
+        LazyTransportMessageMixin, TransportUserMessage):
+    """A :class:`TransportUserMessage` that decodes lazily."""
+
+    __slots__ = _LAZY_SLOTS
+
+
+class LazyTransportEvent(LazyTransportMessageMixin, TransportEvent):
+    """A :class:`TransportEvent` that decodes lazily."""
+
+    __slots__ = _LAZY_SLOTS
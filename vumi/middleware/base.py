@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
@@ -173,32 +174,88 @@ class ApplicationMiddleware(BaseMiddleware):
 
 class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
+
+    For each kind of message, the stack builds a list of the handlers it
+    needs to call the first time it is used. Middlewares that inherit the
+    no-op handlers from :class:`BaseMiddleware` are left out. Handlers are
+    called directly until one of them returns a Deferred, so messages that
+    only pass through synchronous handlers don't need a Deferred per
+    middleware.
     """
 
     def __init__(self, middlewares):
         self.middlewares = middlewares
+        self._chains = {}
+        self._chain_middlewares = None
 
-    @inlineCallbacks
-    def _handle(self, middlewares, handler_name, message, connector_name):
-        method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, connector_name)
-            if message is None:
-                raise MiddlewareError(
-                    'Returned value of %s.%s should never be None' % (
-                        middleware, method_name,))
-        returnValue(message)
+    def _is_noop(self, middleware, handler_name):
+        """
+        Return `True` if `middleware` inherits the no-op handler for
+        `handler_name` from :class:`BaseMiddleware`.
+        """
+        if not isinstance(middleware, BaseMiddleware):
+            return False
+        # handle_consume_inbound calls handle_inbound, etc.
+        for method_name in ['handle_%s' % (handler_name,),
+                            'handle_%s' % (handler_name.split('_', 1)[1],)]:
+            if method_name in vars(middleware):
+                return False
+            method = getattr(type(middleware), method_name)
+            if method.im_func is not getattr(
+                    BaseMiddleware, method_name).im_func:
+                return False
+        return True
+
+    def _get_chain(self, handler_name, reverse):
+        if self._chain_middlewares != self.middlewares:
+            # The middlewares have changed, so we need new chains.
+            self._chains = {}
+            self._chain_middlewares = list(self.middlewares)
+        chain = self._chains.get(handler_name)
+        if chain is None:
+            method_name = 'handle_%s' % (handler_name,)
+            middlewares = self.middlewares
+            if reverse:
+                middlewares = reversed(middlewares)
+            chain = [
+                (getattr(middleware, method_name), middleware, method_name)
+                for middleware in middlewares
+                if not self._is_noop(middleware, handler_name)]
+            self._chains[handler_name] = chain
+        return chain
+
+    def _check_result(self, message, middleware, method_name):
+        if message is None:
+            raise MiddlewareError(
+                'Returned value of %s.%s should never be None' % (
+                    middleware, method_name,))
+        return message
+
+    def _handle(self, message, chain, connector_name, index=0):
+        while index < len(chain):
+            handler, middleware, method_name = chain[index]
+            index += 1
+            try:
+                message = handler(message, connector_name)
+                if isinstance(message, Deferred):
+                    message.addCallback(
+                        self._check_result, middleware, method_name)
+                    return message.addCallback(
+                        self._handle, chain, connector_name, index)
+                self._check_result(message, middleware, method_name)
+            except Exception:
+                return fail()
+        return succeed(message)
 
     def apply_consume(self, handler_name, message, connector_name):
         handler_name = 'consume_%s' % (handler_name,)
         return self._handle(
-            self.middlewares, handler_name, message, connector_name)
+            message, self._get_chain(handler_name, False), connector_name)
 
     def apply_publish(self, handler_name, message, connector_name):
         handler_name = 'publish_%s' % (handler_name,)
         return self._handle(
-            reversed(self.middlewares), handler_name, message, connector_name)
+            message, self._get_chain(handler_name, True), connector_name)
 
     @inlineCallbacks
     def teardown(self):
@@ -38,6 +38,10 @@ class StoringMiddleware(BaseMiddleware):
         ``True`` to store consumed messages as well as published ones,
         ``False`` to store only published messages.
         Default is ``True``.
+    :param float object_cache_ttl:
+        Seconds to keep batches, tag records and outbound messages cached
+        in memory for. Other processes' changes to them are only seen once
+        they expire. Default is ``0``, which disables the cache.
     """
 
     @inlineCallbacks
@@ -46,8 +50,9 @@ class StoringMiddleware(BaseMiddleware):
         r_config = self.config.get('redis_manager', {})
         self.redis = yield TxRedisManager.from_config(r_config)
         manager = TxRiakManager.from_config(self.config.get('riak_manager'))
-        self.store = MessageStore(manager,
-                                  self.redis.sub_manager(store_prefix))
+        self.store = MessageStore(
+            manager, self.redis.sub_manager(store_prefix),
+            object_cache_ttl=self.config.get('object_cache_ttl', 0))
         self.store_on_consume = self.config.get('store_on_consume', True)
 
     @inlineCallbacks
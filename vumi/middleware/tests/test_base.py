@@ -1,9 +1,10 @@
 import yaml
 import itertools
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 
 from vumi.middleware.base import (BaseMiddleware, MiddlewareStack,
+                                  MiddlewareError,
                                   create_middlewares_from_config,
                                   setup_middlewares_from_config)
 from vumi.tests.helpers import VumiTestCase
@@ -72,6 +73,32 @@ class ToyAsymmetricMiddleware(ToyMiddleware):
         return self._handle('publish_failure', message, connector_name)
 
 
+class ToyInboundOnlyMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, connector_name):
+        return message
+
+
+class ToyAsyncMiddleware(ToyMiddleware):
+
+    def handle_inbound(self, message, connector_name):
+        d = Deferred()
+        self.worker.pending.append((d, message))
+        return d
+
+
+class ToyNoneMiddleware(ToyMiddleware):
+
+    def handle_inbound(self, message, connector_name):
+        return None
+
+
+class ToyErrorMiddleware(ToyMiddleware):
+
+    def handle_inbound(self, message, connector_name):
+        raise ValueError("bad message")
+
+
 class TestMiddlewareStack(VumiTestCase):
 
     @inlineCallbacks
@@ -156,6 +183,78 @@ class TestMiddlewareStack(VumiTestCase):
                 ('mw1', 'event', 'dummy_msg.mw3.mw2.mw1', 'end_foo'),
                 ])
 
+    def test_noop_middlewares_skipped(self):
+        noop_mw = BaseMiddleware('noop', {}, self)
+        inbound_mw = ToyInboundOnlyMiddleware('inbound', {}, self)
+        stack = MiddlewareStack([noop_mw, inbound_mw])
+        self.assertEqual(
+            [mw for _, mw, _ in stack._get_chain('consume_inbound', False)],
+            [inbound_mw])
+        self.assertEqual(stack._get_chain('consume_event', False), [])
+        d = stack.apply_consume('event', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg')
+
+    def test_instance_handler_not_skipped(self):
+        mw = BaseMiddleware('mw', {}, self)
+        mw.handle_event = lambda msg, connector_name: '%s.mw' % (msg,)
+        stack = MiddlewareStack([mw])
+        d = stack.apply_consume('event', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw')
+
+    def test_apply_synchronous(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+
+    @inlineCallbacks
+    def test_apply_asynchronous(self):
+        self.pending = []
+        stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyMiddleware)),
+            (yield self.mkmiddleware('mw2', ToyAsyncMiddleware)),
+            (yield self.mkmiddleware('mw3', ToyMiddleware)),
+        ])
+        d = stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertNoResult(d)
+        [(pending_d, msg)] = self.pending
+        self.assertEqual(msg, 'dummy_msg.mw1')
+        pending_d.callback('%s.mw2' % (msg,))
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+
+    @inlineCallbacks
+    def test_apply_asynchronous_none(self):
+        self.pending = []
+        stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyAsyncMiddleware))])
+        d = stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        [(pending_d, msg)] = self.pending
+        pending_d.callback(None)
+        self.failureResultOf(d, MiddlewareError)
+
+    @inlineCallbacks
+    def test_apply_none(self):
+        stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyNoneMiddleware))])
+        d = stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d, MiddlewareError)
+
+    @inlineCallbacks
+    def test_apply_error(self):
+        stack = MiddlewareStack([
+            (yield self.mkmiddleware('mw1', ToyErrorMiddleware))])
+        d = stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d, ValueError)
+
+    @inlineCallbacks
+    def test_middlewares_changed(self):
+        self.stack.middlewares.append(
+            (yield self.mkmiddleware('mw4', ToyMiddleware)))
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(
+            self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3.mw4')
+        self.stack.middlewares.pop(0)
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw2.mw3.mw4')
+
     @inlineCallbacks
     def test_teardown_in_reverse_order(self):
 
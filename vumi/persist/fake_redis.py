@@ -2,6 +2,7 @@
 
 import fnmatch
 from functools import wraps
+from hashlib import sha1
 from itertools import takewhile, dropwhile
 import os
 from zlib import crc32
@@ -26,6 +27,29 @@ def call_to_deferred(deferred, func, *args, **kw):
     execute(func, *args, **kw).chainDeferred(deferred)
 
 
+# Python versions of Lua scripts, keyed by the SHA1 of the script.
+_fake_scripts = {}
+
+
+def register_fake_script(script, func):
+    """
+    Register a Python function to run in place of a Lua script.
+
+    FakeRedis can't run Lua, so :meth:`FakeRedis.evalsha` calls ``func``
+    instead. It is called with a ``call(command, *args, **kw)`` function that
+    runs the FakeRedis command with that name (like ``redis.call()`` in Lua),
+    a list of keys and a list of arguments. It should return what Redis would
+    return for the script.
+    """
+    _fake_scripts[sha1(script).hexdigest()] = func
+
+
+class FakeRedisResponseError(Exception):
+    """
+    An error response from FakeRedis.
+    """
+
+
 class FakeRedis(object):
     """In process and memory implementation of redis-like data store.
 
@@ -47,6 +71,7 @@ class FakeRedis(object):
         self._charset = charset
         self._charset_errors = errors
         self._delayed_calls = []
+        self._scripts = {}
 
     def teardown(self):
         self._clean_up_expires()
@@ -495,6 +520,32 @@ class FakeRedis(object):
             return 1
         return 0
 
+    # Scripting operations
+
+    @maybe_async
+    def script_load(self, script):
+        sha = sha1(script).hexdigest()
+        if sha not in _fake_scripts:
+            raise FakeRedisResponseError(
+                "FakeRedis can't run Lua. Use register_fake_script() to"
+                " provide a Python version of this script.")
+        self._scripts[sha] = _fake_scripts[sha]
+        return sha
+
+    @maybe_async
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        func = self._scripts.get(sha)
+        if func is None:
+            raise FakeRedisResponseError(
+                "NOSCRIPT No matching script. Please use EVAL.")
+
+        def call(command, *args, **kw):
+            return getattr(self, command).sync(self, *args, **kw)
+
+        keys = list(keys_and_args[:numkeys])
+        args = list(keys_and_args[numkeys:])
+        return func(call, keys, args)
+
 
 class Zset(object):
     """A Redis-like ordered set implementation."""
@@ -260,7 +260,15 @@ class Json(Field):
 
 
 class VumiMessageDescriptor(FieldDescriptor):
-    """Property for getting and setting fields."""
+    """Property for getting and setting fields.
+
+    The message is stored as one Riak data key for each payload key. Each
+    model instance remembers which data keys belong to the message and the
+    message decoded from them, until the message is set again or the Riak
+    object's data is replaced. This property returns a copy of the decoded
+    message each time, so changes to it don't affect later reads and aren't
+    stored until the message is set again.
+    """
 
     def setup(self, model_cls):
         super(VumiMessageDescriptor, self).setup(model_cls)
@@ -268,11 +276,28 @@ class VumiMessageDescriptor(FieldDescriptor):
             self.prefix = "%s." % self.key
         else:
             self.prefix = self.field.prefix
+        self.cache_attr = "_%s_field_cache" % (self.key,)
+
+    def _field_cache(self, modelobj):
+        data = modelobj._riak_object._data
+        cache = modelobj.__dict__.get(self.cache_attr)
+        if cache is None or cache['data'] is not data:
+            cache = {
+                'data': data,
+                'keys': set(key for key in data
+                            if key.startswith(self.prefix)),
+                'msg': None,
+            }
+            modelobj.__dict__[self.cache_attr] = cache
+        return cache
 
     def _clear_keys(self, modelobj):
-        for key in modelobj._riak_object._data.keys():
-            if key.startswith(self.prefix):
-                del modelobj._riak_object._data[key]
+        cache = self._field_cache(modelobj)
+        for key in cache['keys']:
+            cache['data'].pop(key, None)
+        cache['keys'] = set()
+        cache['msg'] = None
+        return cache
 
     def _timestamp_to_json(self, dt):
         return dt.strftime(VUMI_DATE_FORMAT)
@@ -282,7 +307,7 @@ class VumiMessageDescriptor(FieldDescriptor):
 
     def set_value(self, modelobj, msg):
         """Set the value associated with this descriptor."""
-        self._clear_keys(modelobj)
+        cache = self._clear_keys(modelobj)
         if msg is None:
             return
         for key, value in msg.payload.iteritems():
@@ -290,21 +315,25 @@ class VumiMessageDescriptor(FieldDescriptor):
             if key == "timestamp":
                 value = self._timestamp_to_json(value)
             full_key = "%s%s" % (self.prefix, key)
-            modelobj._riak_object._data[full_key] = value
+            cache['data'][full_key] = value
+            cache['keys'].add(full_key)
 
     def get_value(self, modelobj):
         """Get the value associated with this descriptor."""
-        payload = {}
-        for key, value in modelobj._riak_object._data.iteritems():
-            if key.startswith(self.prefix):
-                key = key[len(self.prefix):]
+        cache = self._field_cache(modelobj)
+        if cache['msg'] is None and cache['keys']:
+            payload = {}
+            for full_key in cache['keys']:
+                key = full_key[len(self.prefix):]
+                value = cache['data'][full_key]
                 # TODO: timestamp as datetime in payload must die.
                 if key == "timestamp":
                     value = self._timestamp_from_json(value)
                 payload[key] = value
-        if not payload:
+            cache['msg'] = self.field.message_class(**to_kwargs(payload))
+        if cache['msg'] is None:
             return None
-        return self.field.message_class(**to_kwargs(payload))
+        return cache['msg'].copy()
 
 
 class VumiMessage(Field):
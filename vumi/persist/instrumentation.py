@@ -0,0 +1,86 @@
+# -*- test-case-name: vumi.persist.tests.test_instrumentation -*-
+
+"""Metrics for the operations persistence managers send to their stores."""
+
+import re
+import time
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from vumi.blinkenlights.metrics import Count, Timer, AVG, MAX
+
+
+class OperationMetrics(object):
+    """
+    Call counts, error counts and latencies for store operations.
+
+    Each operation is recorded twice: once for the operation name
+    (``<prefix><op>.*``) and once for the key family it was run against
+    (``<prefix>family.<family>.*``). Families are things like redis key
+    prefixes or riak bucket names, so there are only a few of them.
+
+    Metrics are registered with ``metric_manager`` the first time they are
+    needed. Metrics with the same name that are already registered are
+    reused, so several managers may record into the same metrics.
+
+    :param metric_manager:
+        The :class:`vumi.blinkenlights.metrics.MetricManager` to publish
+        through.
+    :param str prefix:
+        Prefix for the metric names, after the metric manager's own prefix.
+    """
+
+    LATENCY_AGGREGATORS = [AVG, MAX]
+
+    def __init__(self, metric_manager, prefix):
+        self.metric_manager = metric_manager
+        self.prefix = prefix
+
+    @staticmethod
+    def family_name(family):
+        """Make ``family`` safe to use as part of a metric name."""
+        if not family:
+            return 'default'
+        return re.sub(r'[^A-Za-z0-9_-]+', '_', family).strip('_')
+
+    def _metric(self, name, metric_class, *args):
+        name = self.prefix + name
+        if name in self.metric_manager:
+            return self.metric_manager[name]
+        return self.metric_manager.register(metric_class(name, *args))
+
+    def record(self, family, op, latency, failed=False):
+        """Record one ``op`` against ``family`` that took ``latency``s."""
+        for name in [op, 'family.%s' % (self.family_name(family),)]:
+            self._metric(name + '.count', Count).inc()
+            if failed:
+                self._metric(name + '.errors', Count).inc()
+            self._metric(
+                name + '.latency', Timer, self.LATENCY_AGGREGATORS).set(
+                latency)
+
+    def time_call(self, family, op, func, *args, **kw):
+        """
+        Call ``func(*args, **kw)`` and record it as ``op`` against
+        ``family``.
+
+        If ``func`` returns a Deferred, the operation ends when the Deferred
+        fires.
+        """
+        start = time.time()
+        try:
+            result = func(*args, **kw)
+        except Exception:
+            self.record(family, op, time.time() - start, failed=True)
+            raise
+
+        if not isinstance(result, Deferred):
+            self.record(family, op, time.time() - start)
+            return result
+
+        def _done(r):
+            self.record(
+                family, op, time.time() - start, isinstance(r, Failure))
+            return r
+        return result.addBoth(_done)
@@ -5,8 +5,12 @@
 from functools import wraps
 import urllib
 
+from twisted.internet.defer import Deferred, returnValue
+
 from vumi.errors import VumiError
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
+from vumi.persist.instrumentation import OperationMetrics
+from vumi.persist.model_cache import ModelCache
 
 
 class ModelMigrationError(VumiError):
@@ -268,13 +272,17 @@ class Model(object):
         return manager.load(cls, key, result=result)
 
     @classmethod
-    def load_all_bunches(cls, manager, keys):
+    def load_all_bunches(cls, manager, keys, concurrency=None, ordered=True):
         """Load batches of objects for the given list of keys.
 
+        See :meth:`Manager.load_all_bunches` for ``concurrency`` and
+        ``ordered``.
+
         :returns:
             An iterator over (possibly deferred) lists of model instances.
         """
-        return manager.load_all_bunches(cls, keys)
+        return manager.load_all_bunches(
+            cls, keys, concurrency=concurrency, ordered=ordered)
 
     @classmethod
     def all_keys(cls, manager):
@@ -299,6 +307,32 @@ class Model(object):
             cls, field_name, value, None)
         return manager.index_keys(cls, index_name, start_value, end_value)
 
+    @classmethod
+    def index_keys_page(cls, manager, field_name, value, max_results=None,
+                        continuation=None):
+        """Find a page of objects by index.
+
+        :returns: A (possibly deferred) :class:`IndexPage`.
+        """
+        index_name, start_value, end_value = index_vals_for_field(
+            cls, field_name, value, None)
+        return manager.index_keys_page(
+            cls, index_name, start_value, end_value, max_results=max_results,
+            continuation=continuation)
+
+    @classmethod
+    def index_keys_pages(cls, manager, field_name, value, page_size=None):
+        """Find objects by index, a page at a time.
+
+        :returns:
+            An iterator over (possibly deferred) lists of keys matching the
+            index param.
+        """
+        index_name, start_value, end_value = index_vals_for_field(
+            cls, field_name, value, None)
+        return manager.index_keys_pages(
+            cls, index_name, start_value, end_value, page_size=page_size)
+
     @classmethod
     def index_lookup(cls, manager, field_name, value):
         """Find objects by index.
@@ -512,20 +546,50 @@ class VumiMapReduce(object):
             self._riak_mapreduce_obj, self._results_to_keys)
 
 
+class IndexPage(object):
+    """A page of keys from a paginated secondary index query.
+
+    :param list keys:
+        The keys on this page.
+    :param continuation:
+        Opaque token for fetching the next page, or ``None`` if this is the
+        last page.
+    """
+
+    def __init__(self, keys, continuation=None):
+        self.keys = keys
+        self.continuation = continuation
+
+    def has_next_page(self):
+        return self.continuation is not None
+
+
 class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
+    DEFAULT_LOAD_BUNCH_CONCURRENCY = 1
+    DEFAULT_STORE_CONCURRENCY = 10
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
+    DEFAULT_INDEX_PAGE_SIZE = 1000
     # This is a temporary measure to give us an easy way to switch back to the
     # old mechanism if the new one causes problems.
     USE_MAPREDUCE_BUNCH_LOADING = False
 
+    # Operations recorded by instrument().
+    INSTRUMENTED_OPERATIONS = (
+        'store', 'load', 'index_keys', 'index_keys_page', 'run_map_reduce')
+
+    _op_metrics = None
+    _object_cache = None
+
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None):
+                 mapreduce_timeout=None, load_bunch_concurrency=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
+        self.load_bunch_concurrency = (load_bunch_concurrency or
+                                       self.DEFAULT_LOAD_BUNCH_CONCURRENCY)
         self.mapreduce_timeout = (mapreduce_timeout or
                                   self.DEFAULT_MAPREDUCE_TIMEOUT)
         self._bucket_cache = {}
@@ -534,7 +598,94 @@ class Manager(object):
         return ModelProxy(self, modelcls)
 
     def sub_manager(self, sub_prefix):
-        return self.__class__(self.client, self.bucket_prefix + sub_prefix)
+        sub_man = self.__class__(self.client, self.bucket_prefix + sub_prefix)
+        if self._op_metrics is not None:
+            sub_man._instrument(self._op_metrics)
+        sub_man._object_cache = self._object_cache
+        return sub_man
+
+    def cache_models(self, model_ttls, max_size=1000, metric_manager=None,
+                     metric_prefix='riak_cache.', clock=None):
+        """
+        Keep recently loaded and stored objects of some model classes in
+        memory, so that loading them again doesn't need to fetch them from
+        Riak.
+
+        See :class:`vumi.persist.model_cache.ModelCache` for the parameters.
+        If this manager already caches objects, the models in
+        ``model_ttls`` are added to its cache and the other parameters are
+        ignored. Sub-managers share their parent's cache.
+
+        :returns: The :class:`vumi.persist.model_cache.ModelCache`.
+        """
+        if self._object_cache is None:
+            self._object_cache = ModelCache(
+                model_ttls, max_size=max_size, metric_manager=metric_manager,
+                metric_prefix=metric_prefix, clock=clock)
+        else:
+            self._object_cache.model_ttls.update(model_ttls)
+        return self._object_cache
+
+    def _reload_riak_object(self, modelcls, key, riak_object):
+        """
+        Reload ``riak_object`` from Riak, or from the object cache if
+        ``modelcls`` objects are cached.
+
+        :returns: A (possibly deferred) riak object.
+        """
+        cache = self._object_cache
+        if cache is None or not cache.caches(modelcls):
+            return riak_object.reload()
+        return self.call_decorator(self._reload_cached_riak_object)(
+            cache, modelcls, key, riak_object)
+
+    def _reload_cached_riak_object(self, cache, modelcls, key, riak_object):
+        cached = cache.lookup(self, modelcls, key)
+        if cached is not None:
+            returnValue(cached)
+        generation = cache.generation
+        yield riak_object.reload()
+        cache.add_loaded(self, modelcls, key, riak_object, generation)
+        returnValue(riak_object)
+
+    def _uncache_object(self, modelobj):
+        if self._object_cache is not None:
+            self._object_cache.invalidate(self, modelobj)
+
+    def _cache_stored_object(self, modelobj):
+        if self._object_cache is not None:
+            self._object_cache.add_stored(self, modelobj)
+        return modelobj
+
+    def instrument(self, metric_manager, prefix='riak.'):
+        """
+        Publish call counts, error counts and latencies for the riak
+        operations this manager and its sub-managers run.
+
+        See :class:`vumi.persist.instrumentation.OperationMetrics` for the
+        metric names. Operations are grouped into families by bucket name.
+        Map/reduce jobs aren't tied to a bucket, so they are grouped by the
+        manager's bucket prefix instead.
+        """
+        self._instrument(OperationMetrics(metric_manager, prefix))
+
+    def _instrument(self, op_metrics):
+        # We wrap the methods on this instance so uninstrumented managers
+        # don't pay anything for this.
+        self._op_metrics = op_metrics
+        for op in self.INSTRUMENTED_OPERATIONS:
+            setattr(self, op, self._instrumented_op(op, getattr(self, op)))
+
+    def _instrumented_op(self, op, func):
+        @wraps(func)
+        def wrapper(modelcls_or_obj, *args, **kw):
+            if op == 'run_map_reduce':
+                family = self.bucket_prefix
+            else:
+                family = self.bucket_name(modelcls_or_obj)
+            return self._op_metrics.time_call(
+                family, op, func, modelcls_or_obj, *args, **kw)
+        return wrapper
 
     def bucket_name(self, modelcls_or_obj):
         return self.bucket_prefix + modelcls_or_obj.bucket
@@ -589,6 +740,28 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .store(...)")
 
+    def store_many(self, modelobjs, concurrency=None):
+        """Store several modelobjs in Riak.
+
+        A failure to store one object doesn't stop the others from being
+        stored.
+
+        :param list modelobjs:
+            The model instances to store.
+        :param int concurrency:
+            The most objects to store at once. Defaults to
+            :attr:`DEFAULT_STORE_CONCURRENCY`. Managers that block while
+            storing store one object at a time.
+
+        :returns:
+            A (possibly deferred) list of ``(success, result)`` tuples, one
+            for each of ``modelobjs``, like the result of a
+            :class:`twisted.internet.defer.DeferredList`. The result is the
+            stored object or a :class:`twisted.python.failure.Failure`.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .store_many(...)")
+
     def delete(self, modelobj):
         """Delete the modelobj from Riak."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -644,9 +817,17 @@ class Manager(object):
         else:
             return self._load_multiple(model, keys)
 
-    def load_all_bunches(self, model, keys):
+    def load_all_bunches(self, model, keys, concurrency=None, ordered=True):
         """Load batches of model instances for a list of keys from Riak.
 
+        :param int concurrency:
+            The number of bunches to load at once. Defaults to
+            :attr:`load_bunch_concurrency`. Managers that block while
+            loading load one bunch at a time.
+        :param bool ordered:
+            If ``True``, bunches are returned in the order of ``keys``.
+            Otherwise they are returned in the order they finish loading.
+
         :returns:
             An iterator over (possibly deferred) lists of model instances.
         """
@@ -670,15 +851,94 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .should_quote_index_values()")
 
-    def index_keys(self, model, index_name, start_value, end_value=None):
-        bucket = self.bucket_for_modelcls(model)
+    def _quote_index_values(self, start_value, end_value):
         if self.should_quote_index_values():
             if start_value is not None:
                 start_value = urllib.quote(start_value)
             if end_value is not None:
                 end_value = urllib.quote(end_value)
+        return start_value, end_value
+
+    def index_keys(self, model, index_name, start_value, end_value=None):
+        bucket = self.bucket_for_modelcls(model)
+        start_value, end_value = self._quote_index_values(
+            start_value, end_value)
         return bucket.get_index(index_name, start_value, end_value)
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        """Fetch a page of keys from a secondary index query.
+
+        :param int max_results:
+            The most keys to return. If ``None``, all the keys are returned.
+            Clients that can't ask Riak for a single page (such as the
+            protocol buffers client) ignore this and return all the keys on
+            one page with no continuation.
+        :param continuation:
+            The continuation from the previous page, or ``None`` for the
+            first page.
+
+        :returns:
+            A (possibly deferred) :class:`IndexPage`.
+        """
+        start_value, end_value = self._quote_index_values(
+            start_value, end_value)
+        return self._index_keys_page(
+            self.bucket_name(model), index_name, start_value, end_value,
+            max_results, continuation)
+
+    def _index_keys_page(self, bucket_name, index_name, start_value,
+                         end_value, max_results, continuation):
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._index_keys_page(...)")
+
+    def _index_page_request(self, bucket_name, index_name, start_value,
+                            end_value, max_results, continuation):
+        """Build the URI and parameters for a paginated HTTP 2i query."""
+        segments = ["buckets", bucket_name, "index", index_name,
+                    str(start_value)]
+        if end_value is not None:
+            segments.append(str(end_value))
+        params = {
+            'max_results': max_results,
+            'continuation': continuation,
+        }
+        return '/%s' % ('/'.join(segments),), params
+
+    def index_keys_pages(self, model, index_name, start_value,
+                         end_value=None, page_size=None):
+        """Fetch the keys from a secondary index query a page at a time.
+
+        Only one page of keys needs to be held in memory at once, however
+        many keys match.
+
+        :returns:
+            An iterator over (possibly deferred) lists of keys. Each page
+            must have arrived before the next one is asked for.
+        """
+        if page_size is None:
+            page_size = self.DEFAULT_INDEX_PAGE_SIZE
+        state = {'continuation': None, 'waiting': False, 'done': False}
+
+        def _next_page(page):
+            state['continuation'] = page.continuation
+            state['waiting'] = False
+            state['done'] = not page.has_next_page()
+            return page.keys
+
+        while not state['done']:
+            if state['waiting']:
+                raise RuntimeError(
+                    "The previous index page hasn't arrived yet.")
+            state['waiting'] = True
+            page = self.index_keys_page(
+                model, index_name, start_value, end_value,
+                max_results=page_size, continuation=state['continuation'])
+            if isinstance(page, Deferred):
+                yield page.addCallback(_next_page)
+            else:
+                yield _next_page(page)
+
     def mr_from_field(self, model, field_name, start_value, end_value=None):
         return VumiMapReduce.from_field(
             self, model, field_name, start_value, end_value)
@@ -733,6 +993,9 @@ class ModelProxy(object):
     def load_all_bunches(self, *args, **kw):
         return self._modelcls.load_all_bunches(self._manager, *args, **kw)
 
+    def store_many(self, modelobjs, concurrency=None):
+        return self._manager.store_many(modelobjs, concurrency=concurrency)
+
     def all_keys(self):
         return self._modelcls.all_keys(self._manager)
 
@@ -740,6 +1003,16 @@ class ModelProxy(object):
         return self._modelcls.index_keys(
             self._manager, field_name, value)
 
+    def index_keys_page(self, field_name, value, max_results=None,
+                        continuation=None):
+        return self._modelcls.index_keys_page(
+            self._manager, field_name, value, max_results=max_results,
+            continuation=continuation)
+
+    def index_keys_pages(self, field_name, value, page_size=None):
+        return self._modelcls.index_keys_pages(
+            self._manager, field_name, value, page_size=page_size)
+
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
 
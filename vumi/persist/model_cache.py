@@ -0,0 +1,156 @@
+# -*- test-case-name: vumi.persist.tests.test_model_cache -*-
+
+"""An in-process cache of model objects loaded from and stored to riak."""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from vumi.blinkenlights.metrics import Count
+
+
+class ModelCache(object):
+    """
+    Remembers the riak data for recently loaded and stored model objects.
+
+    Entries are keyed by bucket and key and hold a copy of the object's
+    data, indexes and vclock, so each hit gets a fresh riak object that can
+    be changed and stored without affecting the cache. Storing an object
+    through a manager that uses this cache replaces its entry with the data
+    and vclock riak returned, and deleting an object drops its entry. Loads
+    that were in flight while an object was stored or deleted aren't
+    cached, so they can't replace newer data.
+
+    Changes made by other processes are only seen once entries expire. Only
+    cache models that change rarely or that only this process writes to.
+
+    :param dict model_ttls:
+        Maps model classes to the number of seconds to keep their objects
+        for. Objects of other model classes aren't cached.
+    :param int max_size:
+        Maximum number of objects to keep. The least recently used are
+        dropped first.
+    :param metric_manager:
+        Optional :class:`vumi.blinkenlights.metrics.MetricManager` to count
+        hits and misses with. The metrics are called ``<prefix>hits`` and
+        ``<prefix>misses``.
+    :param str metric_prefix:
+        Prefix for the metric names.
+    :param clock:
+        Clock to expire objects with. Defaults to the reactor.
+    """
+
+    def __init__(self, model_ttls, max_size=1000, metric_manager=None,
+                 metric_prefix='riak_cache.', clock=None):
+        self.model_ttls = dict(model_ttls)
+        self.max_size = max_size
+        self.clock = clock if clock is not None else reactor
+        self._entries = OrderedDict()  # (bucket, key) -> (expiry, snapshot)
+        self.generation = 0
+        self._hits = self._misses = None
+        if metric_manager is not None:
+            self._hits = self._get_count(
+                metric_manager, metric_prefix + 'hits')
+            self._misses = self._get_count(
+                metric_manager, metric_prefix + 'misses')
+
+    @staticmethod
+    def _get_count(metric_manager, name):
+        if name in metric_manager:
+            return metric_manager[name]
+        return metric_manager.register(Count(name))
+
+    def caches(self, modelcls):
+        """Return ``True`` if objects of ``modelcls`` are cached."""
+        return modelcls in self.model_ttls
+
+    def _entry_key(self, manager, modelcls, key):
+        return (manager.bucket_name(modelcls), key)
+
+    @staticmethod
+    def _snapshot(riak_object):
+        return {
+            'vclock': riak_object.vclock(),
+            'content_type': riak_object.get_content_type(),
+            'indexes': [(entry.get_field(), entry.get_value())
+                        for entry in riak_object.get_indexes()],
+            'data': riak_object.get_encoded_data(),
+        }
+
+    @staticmethod
+    def _restore(manager, modelcls, key, snapshot):
+        riak_object = manager.riak_object(modelcls, key)
+        riak_object.set_content_type(snapshot['content_type'])
+        riak_object.set_indexes(snapshot['indexes'])
+        riak_object.set_encoded_data(snapshot['data'])
+        # Neither riak client lets us set the vclock, but we need it so
+        # that storing the object doesn't create siblings. Both keep it in
+        # _vclock, which the tests check against each client's RiakObject.
+        riak_object._vclock = snapshot['vclock']
+        return riak_object
+
+    def lookup(self, manager, modelcls, key):
+        """
+        Return a new riak object with the cached data for ``key``, or
+        ``None`` if it isn't cached.
+        """
+        if not self.caches(modelcls):
+            return None
+        entry_key = self._entry_key(manager, modelcls, key)
+        cached = self._entries.get(entry_key)
+        if cached is not None and cached[0] <= self.clock.seconds():
+            del self._entries[entry_key]
+            cached = None
+        if cached is None:
+            if self._misses is not None:
+                self._misses.inc()
+            return None
+
+        if self._hits is not None:
+            self._hits.inc()
+        # Move the entry to the end so it's the last to be dropped.
+        del self._entries[entry_key]
+        self._entries[entry_key] = cached
+        return self._restore(manager, modelcls, key, cached[1])
+
+    def _add(self, manager, modelcls, key, riak_object):
+        entry_key = self._entry_key(manager, modelcls, key)
+        self._entries.pop(entry_key, None)
+        if riak_object.vclock() is None or riak_object.get_data() is None:
+            # Missing objects and objects stored without getting a vclock
+            # back can't be cached safely.
+            return
+        expiry = self.clock.seconds() + self.model_ttls[modelcls]
+        self._entries[entry_key] = (expiry, self._snapshot(riak_object))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def add_loaded(self, manager, modelcls, key, riak_object, generation):
+        """
+        Cache a riak object loaded from riak.
+
+        :param int generation:
+            The value of :attr:`generation` when the load started. The
+            object isn't cached if anything was stored or deleted since.
+        """
+        if self.caches(modelcls) and generation == self.generation:
+            self._add(manager, modelcls, key, riak_object)
+
+    def add_stored(self, manager, modelobj):
+        """Cache the riak object of a model object that was just stored."""
+        modelcls = type(modelobj)
+        if self.caches(modelcls):
+            self._add(manager, modelcls, modelobj.key, modelobj._riak_object)
+
+    def invalidate(self, manager, modelobj):
+        """Forget the cached data for a model object that's changing."""
+        modelcls = type(modelobj)
+        if self.caches(modelcls):
+            self.generation += 1
+            self._entries.pop(
+                self._entry_key(manager, modelcls, modelobj.key), None)
+
+    def clear(self):
+        """Forget all cached objects."""
+        self.generation += 1
+        self._entries.clear()
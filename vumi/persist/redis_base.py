@@ -2,9 +2,13 @@
 
 import os
 from functools import wraps
+from hashlib import sha1
+
+from twisted.internet.defer import returnValue
 
 from vumi.persist.ast_magic import make_function
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, register_fake_script
+from vumi.persist.instrumentation import OperationMetrics
 
 
 def make_callfunc(name, redis_call):
@@ -20,7 +24,13 @@ def make_callfunc(name, redis_call):
         aa = [_f(k, v) for k, v in zip(arg_names, a)]
         kk = dict((k, _f(k, v)) for k, v in kw.items())
 
-        result = self._make_redis_call(name, *aa, **kk)
+        op_metrics = self._op_metrics
+        if op_metrics is None:
+            result = self._make_redis_call(name, *aa, **kk)
+        else:
+            result = op_metrics.time_call(
+                self._key_prefix, name, self._make_redis_call, name,
+                *aa, **kk)
         f_func = redis_call.filter_func
         if f_func:
             if isinstance(f_func, basestring):
@@ -44,21 +54,105 @@ class RedisCall(object):
         self.key_args = key_args
 
 
+class RedisScript(object):
+    """
+    A Lua script to run with :meth:`Manager.run_script`.
+
+    Scripts are called by SHA1 and are only sent to the server when it
+    doesn't have them yet. FakeRedis can't run Lua, so scripts used in tests
+    need a ``fake_func`` that does the same thing in Python. See
+    :func:`vumi.persist.fake_redis.register_fake_script` for its signature.
+    """
+
+    def __init__(self, script, fake_func=None):
+        self.script = script
+        self.sha = sha1(script).hexdigest()
+        if fake_func is not None:
+            register_fake_script(script, fake_func)
+
+
 class CallMakerMetaclass(type):
     def __new__(meta, classname, bases, class_dict):
         new_class_dict = {}
+        redis_calls = {}
+        for base in reversed(bases):
+            redis_calls.update(getattr(base, '_redis_calls', {}))
         for name, attr in class_dict.items():
             if isinstance(attr, RedisCall):
+                redis_calls[name] = attr
                 attr = make_callfunc(name, attr)
 
             new_class_dict[name] = attr
+        new_class_dict['_redis_calls'] = redis_calls
         return type.__new__(meta, classname, bases, new_class_dict)
 
 
+class RedisPipeline(object):
+    """
+    A batch of redis commands that are sent together.
+
+    This has the same command methods as the manager that created it, with
+    the same key prefixing. Each command is queued instead of being sent, and
+    :meth:`execute` sends them all at once and returns their filtered
+    results in the order the commands were queued. The command methods
+    return the pipeline, so they can be chained.
+
+    Commands in a pipeline are not run in a transaction, and commands from
+    other clients may be run between them.
+    """
+
+    # Queued commands aren't sent anywhere, so we only time execute().
+    _op_metrics = None
+
+    # Key prefixing and result filters used by the command methods come from
+    # the manager. Nothing else does, because it wouldn't be queued.
+    _MANAGER_ATTRS = frozenset(['_key', '_unkey', '_unkeys', '_unkeys_scan'])
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._calls = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __getattr__(self, name):
+        if name in self._manager._redis_calls:
+            func = getattr(type(self._manager), name).im_func
+            return func.__get__(self, type(self))
+        if name in self._MANAGER_ATTRS:
+            return getattr(self._manager, name)
+        raise AttributeError(
+            "%r object has no attribute %r" % (type(self).__name__, name))
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append([call, args, kw, None])
+        return self
+
+    def _filter_redis_results(self, func, pipeline):
+        self._calls[-1][3] = func
+        return self
+
+    def execute(self):
+        """
+        Send all the queued commands and return a list of their results.
+
+        For asynchronous managers this returns a Deferred that fires with the
+        list once all the results are in.
+        """
+        calls, self._calls = self._calls, []
+        manager = self._manager
+        if manager._op_metrics is None:
+            return manager._execute_pipeline(calls)
+        return manager._op_metrics.time_call(
+            manager._key_prefix, 'pipeline', manager._execute_pipeline, calls)
+
+
 class Manager(object):
 
     __metaclass__ = CallMakerMetaclass
 
+    _op_metrics = None
+
     def __init__(self, client, config, key_prefix, key_separator=None):
         if key_separator is None:
             key_separator = ':'
@@ -80,8 +174,20 @@ class Manager(object):
         sub_man = self.__class__(self._client, self._config, key_prefix)
         if isinstance(self._client, FakeRedis):
             sub_man._close = self._client.teardown
+        sub_man._op_metrics = self._op_metrics
         return sub_man
 
+    def instrument(self, metric_manager, prefix='redis.'):
+        """
+        Publish call counts, error counts and latencies for the redis
+        commands this manager and its sub-managers send.
+
+        See :class:`vumi.persist.instrumentation.OperationMetrics` for the
+        metric names. Commands are grouped into families by the key prefix
+        of the manager that sent them.
+        """
+        self._op_metrics = OperationMetrics(metric_manager, prefix)
+
     @staticmethod
     def calls_manager(manager_attr):
         """Decorate a method that calls a manager.
@@ -182,6 +288,106 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def _execute_pipeline(self, calls):
+        """Make a batch of redis API calls and return their results.
+
+        :param list calls:
+            A list of ``[call, args, kw, filter_func]`` entries in the order
+            the results should be returned. ``filter_func`` is ``None`` if
+            the result isn't filtered.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._execute_pipeline()")
+
+    def run_script(self, script, keys=(), args=()):
+        """
+        Run a :class:`RedisScript` and return its result.
+
+        :param list keys:
+            The keys the script uses. These are available to the script as
+            ``KEYS`` and have this manager's key prefix added.
+        :param list args:
+            Other arguments for the script. These are available to the script
+            as ``ARGV``.
+        """
+        keys = [self._key(key) for key in keys]
+        run_script = self.call_decorator(self._run_script)
+        if self._op_metrics is None:
+            return run_script(script, keys, list(args))
+        return self._op_metrics.time_call(
+            self._key_prefix, 'run_script', run_script, script, keys,
+            list(args))
+
+    def _run_script(self, script, keys, args):
+        try:
+            result = yield self._make_redis_call(
+                'evalsha', script.sha, len(keys), *(keys + args))
+        except Exception as e:
+            if not self._is_noscript_error(e):
+                raise
+            # The server doesn't have the script (it may have restarted), so
+            # we load it and try again.
+            yield self._make_redis_call('script_load', script.script)
+            result = yield self._make_redis_call(
+                'evalsha', script.sha, len(keys), *(keys + args))
+        returnValue(result)
+
+    def _is_noscript_error(self, err):
+        return str(err).startswith('NOSCRIPT')
+
+    def pipeline(self):
+        """
+        Return a :class:`RedisPipeline` for sending several commands in one
+        round trip.
+        """
+        return RedisPipeline(self)
+
+    def scan_batches(self, match='*', count=None):
+        """
+        Iterate over the keys matching ``match`` a batch at a time using
+        ``SCAN``, which doesn't block the server the way ``KEYS`` does.
+
+        :returns:
+            An iterator over (possibly deferred) lists of keys, with this
+            manager's key prefix removed. Each batch must have arrived
+            before the next one is asked for. Batches may be empty and, as
+            with ``SCAN``, a key may be returned more than once.
+        """
+        state = {'cursor': None, 'waiting': False, 'done': False}
+
+        def _next_batch(scan_results):
+            state['cursor'], keys = scan_results
+            state['waiting'] = False
+            state['done'] = state['cursor'] is None
+            return keys
+
+        while not state['done']:
+            if state['waiting']:
+                raise RuntimeError(
+                    "The previous scan batch hasn't arrived yet.")
+            state['waiting'] = True
+            yield self._filter_redis_results(
+                _next_batch, self.scan(state['cursor'], match, count))
+
+    def _call_keys(self, call, args, kw):
+        """
+        Return the keys (or key patterns) in the arguments of a call to the
+        redis command method ``call``.
+
+        :class:`vumi.persist.redis_sharding.ShardedManager` uses this to pick
+        the shard for a call and
+        :class:`vumi.persist.redis_cache.CachedRedisManager` uses it to find
+        the cached results a write makes stale, so it lives here rather than
+        on either of them.
+        """
+        redis_call = self._redis_calls[call]
+        arg_names = list(redis_call.args)
+        arg_names += [redis_call.vararg] * (len(args) - len(arg_names))
+        keys = [v for k, v in zip(arg_names, args)
+                if k in redis_call.key_args]
+        keys.extend(v for k, v in kw.items() if k in redis_call.key_args)
+        return keys
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
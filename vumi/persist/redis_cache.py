@@ -0,0 +1,273 @@
+# -*- test-case-name: vumi.persist.tests.test_redis_cache -*-
+
+"""An in-process read-through cache in front of a redis manager."""
+
+from collections import OrderedDict
+from copy import copy
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+from vumi.blinkenlights.metrics import Count
+from vumi.persist.redis_base import RedisPipeline
+
+
+class CachedRedisPipeline(RedisPipeline):
+    """
+    A :class:`RedisPipeline` that clears cached results for the keys its
+    commands write to.
+    """
+
+    def __init__(self, cache, manager):
+        super(CachedRedisPipeline, self).__init__(manager)
+        self._cache = cache
+
+    def execute(self):
+        for call, args, kw, _ in self._calls:
+            self._cache._invalidate_call(call, args, kw)
+        return super(CachedRedisPipeline, self).execute()
+
+
+class CachedRedisManager(object):
+    """
+    A redis manager that remembers the results of read commands.
+
+    This has the same command methods as the manager it wraps. Results of
+    the commands in ``cached_calls`` are kept in memory for up to ``ttl``
+    seconds, and the least recently used ones are dropped when there are
+    more than ``max_size``. Any other command sent through this manager
+    (including commands in pipelines and scripts) clears the cached results
+    for the keys it uses.
+
+    Changes made by other processes, or through other managers, are only
+    seen once the cached result expires. Only cache keys that change rarely
+    or that only this process writes to.
+
+    Some calls always go straight to the wrapped manager: ``keys``, ``scan``
+    and ``scan_batches`` are never cached, and other manager methods (such
+    as ``get_key_prefix`` and ``close_manager``) are passed through.
+    :meth:`sub_manager` returns a cached manager that shares this cache, so
+    writes through either one clear the results both have cached. Commands
+    sent through the wrapped manager itself, or its own sub-managers, bypass
+    the cache entirely.
+
+    :param manager:
+        The :class:`vumi.persist.redis_base.Manager` to wrap. This is
+        usually a sub-manager for the keys to cache.
+    :param float ttl:
+        Seconds to keep each result for.
+    :param int max_size:
+        Maximum number of results to keep.
+    :param list cached_calls:
+        Names of the commands to cache results for. These must be commands
+        that don't change anything. Defaults to :attr:`CACHED_CALLS`.
+    :param bool cache_none:
+        If ``False``, ``None`` results (usually missing keys) aren't cached,
+        so keys created by other processes are seen straight away.
+    :param bool follow_key_ttl:
+        If ``True``, the key's remaining TTL in redis is fetched along with
+        each result of a single key command, and the result isn't kept for
+        longer than that. This stops expired keys from being seen.
+    :param metric_manager:
+        Optional :class:`vumi.blinkenlights.metrics.MetricManager` to count
+        hits and misses with. The metrics are called ``<prefix>hits`` and
+        ``<prefix>misses``.
+    :param str metric_prefix:
+        Prefix for the metric names.
+    :param clock:
+        Clock to expire results with. Defaults to the reactor.
+    """
+
+    CACHED_CALLS = frozenset([
+        'exists', 'get', 'hget', 'hgetall', 'hlen', 'hvals', 'hexists',
+        'smembers', 'scard', 'sismember', 'zscore', 'zcard', 'ttl',
+    ])
+
+    # Commands that don't read or write specific keys.
+    UNCACHED_READ_CALLS = frozenset(['keys', 'scan'])
+
+    def __init__(self, manager, ttl, max_size=1000, cached_calls=None,
+                 cache_none=True, follow_key_ttl=False,
+                 metric_manager=None, metric_prefix='redis_cache.',
+                 clock=None):
+        if cached_calls is None:
+            cached_calls = self.CACHED_CALLS
+        self._manager = manager
+        self.cache_ttl = ttl
+        self.max_size = max_size
+        self.cached_calls = frozenset(cached_calls)
+        self.cache_none = cache_none
+        self.follow_key_ttl = follow_key_ttl
+        self.clock = clock if clock is not None else reactor
+        self._results = OrderedDict()  # (call, args) -> (expiry, result)
+        self._key_entries = {}  # key -> set of (call, args)
+        # Sub-managers count writes on the manager they share a cache with.
+        self._root = self
+        self._writes = 0
+        self._hits = self._misses = None
+        if metric_manager is not None:
+            self._hits = self._get_count(
+                metric_manager, metric_prefix + 'hits')
+            self._misses = self._get_count(
+                metric_manager, metric_prefix + 'misses')
+
+        for name in manager._redis_calls:
+            if name in self.cached_calls:
+                setattr(self, name, self._cached_call(name))
+            elif name not in self.UNCACHED_READ_CALLS:
+                setattr(self, name, self._write_call(name))
+
+    def __getattr__(self, name):
+        return getattr(self._manager, name)
+
+    def sub_manager(self, sub_prefix):
+        """
+        Return a cached sub-manager of the wrapped manager that shares this
+        manager's cache and metrics.
+        """
+        sub_cache = type(self)(
+            self._manager.sub_manager(sub_prefix), self.cache_ttl,
+            max_size=self.max_size, cached_calls=self.cached_calls,
+            cache_none=self.cache_none, follow_key_ttl=self.follow_key_ttl,
+            clock=self.clock)
+        sub_cache._root = self._root
+        sub_cache._results = self._results
+        sub_cache._key_entries = self._key_entries
+        sub_cache._hits = self._hits
+        sub_cache._misses = self._misses
+        return sub_cache
+
+    @staticmethod
+    def _get_count(metric_manager, name):
+        if name in metric_manager:
+            return metric_manager[name]
+        return metric_manager.register(Count(name))
+
+    def _prefixed_keys(self, call, args, kw):
+        manager = self._manager
+        return [manager._key(key)
+                for key in manager._call_keys(call, args, kw)]
+
+    def _drop_entry(self, entry):
+        if self._results.pop(entry, None) is None:
+            return
+        for key in entry[2]:
+            entries = self._key_entries.get(key)
+            if entries is not None:
+                entries.discard(entry)
+                if not entries:
+                    del self._key_entries[key]
+
+    def _store(self, entry, result, ttl):
+        self._drop_entry(entry)
+        self._results[entry] = (self.clock.seconds() + ttl, result)
+        for key in entry[2]:
+            self._key_entries.setdefault(key, set()).add(entry)
+        while len(self._results) > self.max_size:
+            self._drop_entry(next(iter(self._results)))
+
+    def _lookup(self, entry):
+        cached = self._results.get(entry)
+        if cached is None:
+            return False, None
+        expiry, result = cached
+        if expiry <= self.clock.seconds():
+            self._drop_entry(entry)
+            return False, None
+        # Move the entry to the end so it's the last to be dropped.
+        del self._results[entry]
+        self._results[entry] = cached
+        return True, result
+
+    def invalidate(self, *keys):
+        """Forget cached results for ``keys``."""
+        self._invalidate_prefixed([self._manager._key(key) for key in keys])
+
+    def _invalidate_prefixed(self, keys):
+        self._root._writes += 1
+        for key in keys:
+            for entry in list(self._key_entries.get(key, ())):
+                self._drop_entry(entry)
+
+    def _invalidate_call(self, call, args, kw):
+        # Pipelined commands already have prefixed keys.
+        if call in self.cached_calls or call in self.UNCACHED_READ_CALLS:
+            return
+        self._invalidate_prefixed(self._manager._call_keys(call, args, kw))
+
+    def clear(self):
+        """Forget all cached results."""
+        self._root._writes += 1
+        self._results.clear()
+        self._key_entries.clear()
+
+    def _cached_call(self, name):
+        method = getattr(self._manager, name)
+
+        def cached_call(*args, **kw):
+            entry = (name, args, tuple(self._prefixed_keys(name, args, kw)),
+                     tuple(sorted(kw.items())))
+            hit, result = self._lookup(entry)
+            if hit:
+                if self._hits is not None:
+                    self._hits.inc()
+                is_deferred, result = result
+                result = copy(result)
+                return succeed(result) if is_deferred else result
+
+            if self._misses is not None:
+                self._misses.inc()
+            writes = self._root._writes
+            result = method(*args, **kw)
+
+            def _cache_result(value, is_deferred, key_ttl=None):
+                ttl = self.cache_ttl
+                if key_ttl is not None and key_ttl >= 0:
+                    # Redis returns -1 for keys that don't expire.
+                    ttl = min(ttl, key_ttl)
+                # Don't cache results that a write may have made stale.
+                if (writes == self._root._writes and ttl > 0
+                        and (value is not None or self.cache_none)):
+                    self._store(entry, (is_deferred, copy(value)), ttl)
+                return value
+
+            keys = entry[2]
+            if not (self.follow_key_ttl and len(keys) == 1):
+                if isinstance(result, Deferred):
+                    return result.addCallback(_cache_result, True)
+                return _cache_result(result, False)
+
+            key = self._manager._call_keys(name, args, kw)[0]
+            if isinstance(result, Deferred):
+                return result.addCallback(
+                    lambda value: self._manager.ttl(key).addCallback(
+                        lambda key_ttl: _cache_result(value, True, key_ttl)))
+            return _cache_result(result, False, self._manager.ttl(key))
+
+        cached_call.__name__ = name
+        return cached_call
+
+    def _write_call(self, name):
+        method = getattr(self._manager, name)
+
+        def write_call(*args, **kw):
+            self._invalidate_prefixed(self._prefixed_keys(name, args, kw))
+            return method(*args, **kw)
+
+        write_call.__name__ = name
+        return write_call
+
+    def pipeline(self):
+        """
+        Return a :class:`CachedRedisPipeline` for sending several commands in
+        one round trip.
+        """
+        return CachedRedisPipeline(self, self._manager)
+
+    def run_script(self, script, keys=(), args=()):
+        """
+        Run a :class:`vumi.persist.redis_base.RedisScript` after clearing
+        cached results for its keys.
+        """
+        self.invalidate(*keys)
+        return self._manager.run_script(script, keys, args)
@@ -4,6 +4,7 @@ import redis
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.redis_sharding import ShardedManager, HashRing
 from vumi.utils import flatten_generator
 
 
@@ -86,3 +87,36 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def _is_noscript_error(self, err):
+        # redis-py strips the NOSCRIPT prefix from the error message when it
+        # raises NoScriptError.
+        if isinstance(err, redis.exceptions.NoScriptError):
+            return True
+        return super(RedisManager, self)._is_noscript_error(err)
+
+    def _execute_pipeline(self, calls):
+        """Make a batch of redis API calls and return their results.
+        """
+        if isinstance(self._client, FakeRedis):
+            results = [self._make_redis_call(call, *args, **kw)
+                       for call, args, kw, _ in calls]
+        else:
+            pipe = self._client.pipeline(transaction=False)
+            for call, args, kw, _ in calls:
+                getattr(pipe, call)(*args, **kw)
+            results = pipe.execute()
+        return [func(result) if func is not None else result
+                for (_, _, _, func), result in zip(calls, results)]
+
+
+class ShardedRedisManager(ShardedManager):
+    """A :class:`ShardedManager` over :class:`RedisManager` shards."""
+
+    call_decorator = staticmethod(flatten_generator)
+
+    SHARD_MANAGER_CLASS = RedisManager
+
+    @classmethod
+    def _manager_from_shards(cls, shards, names, replicas, manager_config):
+        return cls(HashRing(shards, names, replicas), **manager_config)
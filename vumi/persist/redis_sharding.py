@@ -0,0 +1,285 @@
+# -*- test-case-name: vumi.persist.tests.test_redis_sharding -*-
+
+"""Redis managers that spread keys over several redis servers."""
+
+from bisect import bisect
+from hashlib import md5
+
+from twisted.internet.defer import returnValue
+
+from vumi.errors import VumiError
+from vumi.persist.redis_base import Manager
+
+
+class CrossShardError(VumiError):
+    """Raised when a command needs keys that live on different shards."""
+
+
+def hash_tag(key):
+    """
+    Return the part of ``key`` that is hashed to pick a shard.
+
+    As in redis cluster, if the key has a non-empty ``{...}`` section only
+    the text between the first ``{`` and the next ``}`` is hashed. Keys with
+    the same hash tag always end up on the same shard.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing(object):
+    """
+    A consistent hash ring over a list of nodes.
+
+    Each node is placed on the ring ``replicas`` times, at points derived
+    from its name. Adding a node only moves the keys that hash to the new
+    node's points, so most keys stay where they are.
+
+    :param list nodes:
+        The nodes to spread keys over.
+    :param list names:
+        Names for the nodes. These should stay the same when nodes are added
+        or removed. Defaults to the position of each node in ``nodes``.
+    :param int replicas:
+        Number of points each node has on the ring.
+    """
+
+    def __init__(self, nodes, names=None, replicas=160):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node.")
+        if names is None:
+            names = [str(i) for i in range(len(nodes))]
+        if len(set(names)) != len(nodes):
+            raise ValueError("Hash ring node names must be unique.")
+        self.nodes = list(nodes)
+        points = []
+        for index, name in enumerate(names):
+            for replica in range(replicas):
+                points.append((self._hash('%s-%s' % (name, replica)), index))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(md5(value).hexdigest()[:8], 16)
+
+    def node_index(self, key):
+        """Return the index of the node ``key`` belongs on."""
+        pos = bisect(self._points, self._hash(hash_tag(key)))
+        return self._indexes[pos % len(self._points)]
+
+    def get_node(self, key):
+        """Return the node ``key`` belongs on."""
+        return self.nodes[self.node_index(key)]
+
+
+class ShardedManager(Manager):
+    """
+    A redis manager that spreads keys over several shard managers.
+
+    The client for this manager is a :class:`HashRing` of managers, one for
+    each redis server. These have no key prefix of their own. Commands are
+    sent to the shard their (prefixed) key hashes to, so components don't
+    need to know about sharding. Use hash tags (see :func:`hash_tag`) to
+    keep keys that are used together on the same shard.
+
+    Commands that use several keys are sent to the shard the keys share. If
+    the keys are on different shards, ``sunion`` is run on each shard and
+    the results combined, while commands that change data (``smove`` and
+    ``rpoplpush``) raise :class:`CrossShardError` because they can't be
+    done atomically. ``keys`` and ``scan`` run over all the shards. Scripts
+    must only use keys on one shard too.
+
+    This means components that move data between keys need their keys hash
+    tagged. :class:`vumi.components.tagpool.TagpoolManager` and
+    :class:`vumi.components.window_manager.WindowManager` raise
+    :class:`CrossShardError` from ``acquire_tag``,
+    ``acquire_specific_tag``, ``release_tag`` and ``get_next_key`` unless
+    they are created with ``hash_tag_keys=True``.
+
+    Configuration options are those of the shard manager class, plus:
+
+    :param list shards:
+        A list of dicts with config for each shard. These override the other
+        options. A shard may have a ``shard_name`` to keep its place on the
+        hash ring stable if shards are added or removed later.
+    :param int hash_replicas:
+        Number of points each shard has on the hash ring.
+    """
+
+    SHARD_MANAGER_CLASS = None
+    DEFAULT_HASH_REPLICAS = 160
+
+    # Commands run on every shard.
+    ALL_SHARD_CALLS = frozenset(['keys', 'scan'])
+
+    # Commands that can be split into a command on each shard and combined.
+    SPLIT_CALLS = frozenset(['sunion'])
+
+    @classmethod
+    def from_config(cls, config):
+        """Construct a manager from a dictionary of options.
+
+        :param dict config:
+            Dictionary of options for the manager.
+        """
+        common_config = config.copy()
+        manager_config = {
+            'config': config.copy(),
+            'key_prefix': common_config.pop('key_prefix', None),
+            'key_separator': common_config.pop('key_separator', ':'),
+        }
+        shard_configs = common_config.pop('shards', [{}])
+        replicas = common_config.pop(
+            'hash_replicas', cls.DEFAULT_HASH_REPLICAS)
+
+        names = []
+        shards = []
+        for index, shard_config in enumerate(shard_configs):
+            shard_config = dict(common_config, **shard_config)
+            names.append(shard_config.pop('shard_name', str(index)))
+            shards.append(cls.SHARD_MANAGER_CLASS.from_config(shard_config))
+        return cls._manager_from_shards(
+            shards, names, replicas, manager_config)
+
+    @classmethod
+    def _manager_from_shards(cls, shards, names, replicas, manager_config):
+        """Construct a manager from a list of shard managers.
+
+        The shards may be Deferreds if the shard manager class connects
+        asynchronously.
+        """
+        raise NotImplementedError("Sub-classes of ShardedManager should"
+                                  " implement ._manager_from_shards(...)")
+
+    @property
+    def _shards(self):
+        return self._client.nodes
+
+    def _shard_indexes(self, keys):
+        return set(self._client.node_index(key) for key in keys)
+
+    def _shard_for_keys(self, call, keys):
+        """
+        Return the shard all of ``keys`` are on, or raise
+        :class:`CrossShardError` if they are on different shards.
+        """
+        indexes = self._shard_indexes(keys) or set([0])
+        if len(indexes) > 1:
+            raise CrossShardError(
+                "Keys for %r are on different shards: %r" % (call, keys))
+        return self._shards[indexes.pop()]
+
+    def _make_redis_call(self, call, *args, **kw):
+        """Send a redis API call to the shard (or shards) it belongs on.
+        """
+        if call in self.ALL_SHARD_CALLS:
+            return self.call_decorator(
+                getattr(self, '_all_shards_%s' % (call,)))(*args, **kw)
+        keys = self._call_keys(call, args, kw)
+        if call in self.SPLIT_CALLS and len(self._shard_indexes(keys)) > 1:
+            return self.call_decorator(
+                getattr(self, '_split_%s' % (call,)))(*args, **kw)
+        shard = self._shard_for_keys(call, keys)
+        return shard._make_redis_call(call, *args, **kw)
+
+    def _all_shards_keys(self, pattern):
+        keys = []
+        for shard in self._shards:
+            shard_keys = yield shard._make_redis_call('keys', pattern)
+            keys.extend(shard_keys)
+        returnValue(keys)
+
+    def _all_shards_scan(self, cursor, match=None, count=None):
+        # Our cursor is the index of the shard we're scanning followed by
+        # that shard's cursor.
+        index, shard_cursor = 0, None
+        if cursor is not None:
+            index, _, shard_cursor = cursor.partition(':')
+            index = int(index)
+            shard_cursor = shard_cursor or None
+        shard = self._shards[index]
+        shard_cursor, keys = yield shard._make_redis_call(
+            'scan', shard_cursor, match, count)
+        if shard_cursor is not None:
+            cursor = '%d:%s' % (index, shard_cursor)
+        elif index + 1 < len(self._shards):
+            cursor = '%d:' % (index + 1,)
+        else:
+            cursor = None
+        returnValue((cursor, keys))
+
+    def _split_sunion(self, key, *args):
+        shard_keys = {}
+        for rkey in (key,) + args:
+            index = self._client.node_index(rkey)
+            shard_keys.setdefault(index, []).append(rkey)
+        union = set()
+        for index, rkeys in sorted(shard_keys.items()):
+            members = yield self._shards[index]._make_redis_call(
+                'sunion', *rkeys)
+            union.update(members)
+        returnValue(union)
+
+    def _filter_redis_results(self, func, results):
+        """Filter results of a redis call.
+        """
+        return self._shards[0]._filter_redis_results(func, results)
+
+    def _execute_pipeline(self, calls):
+        """Make a batch of redis API calls and return their results.
+
+        The calls are split into a pipeline for each shard, and the results
+        are put back in the order of the calls.
+        """
+        shard_calls = {}
+        for pos, call in enumerate(calls):
+            if call[0] in self.ALL_SHARD_CALLS:
+                raise CrossShardError(
+                    "%r can't be pipelined on a sharded manager." % (
+                        call[0],))
+            keys = self._call_keys(call[0], call[1], call[2])
+            shard = self._shard_for_keys(call[0], keys)
+            shard_calls.setdefault(shard, []).append((pos, call))
+        return self.call_decorator(self._execute_shard_pipelines)(
+            shard_calls, len(calls))
+
+    def _execute_shard_pipelines(self, shard_calls, num_calls):
+        results = [None] * num_calls
+        for shard, pos_calls in shard_calls.items():
+            shard_results = yield shard._execute_pipeline(
+                [call for _, call in pos_calls])
+            for (pos, _), result in zip(pos_calls, shard_results):
+                results[pos] = result
+        returnValue(results)
+
+    def _run_script(self, script, keys, args):
+        shard = self._shard_for_keys('run_script', keys)
+        result = yield shard.call_decorator(shard._run_script)(
+            script, keys, args)
+        returnValue(result)
+
+    def _close(self):
+        return self.call_decorator(self._close_shards)()
+
+    def _close_shards(self):
+        for shard in self._shards:
+            yield shard._close()
+
+    def _purge_all(self):
+        """Delete *ALL* keys whose names start with this manager's key prefix.
+
+        Use only in tests.
+        """
+        return self.call_decorator(self._purge_shards)()
+
+    def _purge_shards(self):
+        for key in (yield self.keys()):
+            yield self.delete(key)
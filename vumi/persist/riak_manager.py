@@ -7,8 +7,9 @@ import json
 from riak import (
     RiakClient, RiakObject, RiakMapReduce, RiakHttpTransport, RiakPbcTransport)
 from twisted.internet.defer import gatherResults
+from twisted.python.failure import Failure
 
-from vumi.persist.model import Manager
+from vumi.persist.model import Manager, IndexPage
 from vumi.utils import flatten_generator
 
 
@@ -25,6 +26,8 @@ class RiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_bunch_concurrency = config.pop('load_bunch_concurrency',
+                                            cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': RiakHttpTransport,
@@ -54,7 +57,8 @@ class RiakManager(Manager):
         client.set_decoder('application/json', json.loads)
         client.set_decoder('text/json', json.loads)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency)
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)
@@ -78,16 +82,27 @@ class RiakManager(Manager):
         return riak_object
 
     def store(self, modelobj):
+        self._uncache_object(modelobj)
         modelobj._riak_object.store()
-        return modelobj
+        return self._cache_stored_object(modelobj)
+
+    def store_many(self, modelobjs, concurrency=None):
+        results = []
+        for modelobj in modelobjs:
+            try:
+                results.append((True, self.store(modelobj)))
+            except Exception:
+                results.append((False, Failure()))
+        return results
 
     def delete(self, modelobj):
+        self._uncache_object(modelobj)
         modelobj._riak_object.delete()
 
     def load(self, modelcls, key, result=None):
         riak_object = self.riak_object(modelcls, key, result)
         if not result:
-            riak_object.reload()
+            riak_object = self._reload_riak_object(modelcls, key, riak_object)
         was_migrated = False
 
         # Run migrators until we have the correct version of the data.
@@ -122,6 +137,25 @@ class RiakManager(Manager):
         bucket = self.client.bucket(bucket_name)
         return bucket.enable_search()
 
+    def _index_keys_page(self, bucket_name, index_name, start_value,
+                         end_value, max_results, continuation):
+        transport = self.client.get_transport()
+        if not isinstance(transport, RiakHttpTransport):
+            # The protocol buffer client can't ask for a single page, so we
+            # return all the keys as one page rather than fetching them all
+            # again for each page.
+            keys = self.client.bucket(bucket_name).get_index(
+                index_name, start_value, end_value)
+            return IndexPage(keys)
+
+        uri, params = self._index_page_request(
+            bucket_name, index_name, start_value, end_value, max_results,
+            continuation)
+        response = transport.get_request(uri, params)
+        transport.check_http_code(response, [200])
+        data = json.loads(response[1])
+        return IndexPage(data[u'keys'], data.get(u'continuation'))
+
     def should_quote_index_values(self):
         return not isinstance(self.client, RiakPbcTransport)
 
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, register_fake_script
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -413,6 +413,29 @@ class TestFakeRedis(VumiTestCase):
             (yield self.redis.scan(None)),
             (None, []))
 
+    @inlineCallbacks
+    def test_evalsha(self):
+        def fake_getset(call, keys, args):
+            old = call('get', keys[0])
+            call('set', keys[0], args[0])
+            return old
+
+        script = "-- fake getset"
+        register_fake_script(script, fake_getset)
+        yield self.redis.set('foo', 'bar')
+        sha = yield self.redis.script_load(script)
+        yield self.assert_redis_op('bar', 'evalsha', sha, 1, 'foo', 'baz')
+        yield self.assert_redis_op('baz', 'get', 'foo')
+
+    @inlineCallbacks
+    def test_evalsha_noscript(self):
+        yield self.assert_error(
+            self.redis.evalsha, '40ef2b1c3e2b3c0e3e40de1b6a5bb5ac4d1fd6b0', 0)
+
+    @inlineCallbacks
+    def test_script_load_unregistered(self):
+        yield self.assert_error(self.redis.script_load, "-- unregistered")
+
 
 class TestFakeRedisCharsetHandling(VumiTestCase):
 
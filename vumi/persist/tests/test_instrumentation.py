@@ -0,0 +1,80 @@
+"""Tests for vumi.persist.instrumentation."""
+
+from twisted.internet.defer import Deferred, succeed
+
+from vumi.blinkenlights.metrics import MetricManager, Count, Timer
+from vumi.persist.instrumentation import OperationMetrics
+from vumi.tests.helpers import VumiTestCase
+
+
+class TestOperationMetrics(VumiTestCase):
+    def setUp(self):
+        self.metric_manager = MetricManager('vumi.test.')
+        self.op_metrics = OperationMetrics(self.metric_manager, 'store.')
+
+    def assert_counts(self, name, count, errors=0):
+        mm = self.metric_manager
+        self.assertEqual(len(mm['store.%s.count' % name].poll()), count)
+        self.assertEqual(len(mm['store.%s.latency' % name].poll()), count)
+        if errors:
+            self.assertEqual(
+                len(mm['store.%s.errors' % name].poll()), errors)
+        else:
+            self.assertFalse(('store.%s.errors' % name) in mm)
+
+    def test_family_name(self):
+        family_name = OperationMetrics.family_name
+        self.assertEqual(family_name(None), 'default')
+        self.assertEqual(family_name('vumi:smpp:seq'), 'vumi_smpp_seq')
+        self.assertEqual(family_name('test.bucket-1'), 'test_bucket-1')
+
+    def test_record(self):
+        self.op_metrics.record('foo', 'get', 0.5)
+        self.op_metrics.record('foo', 'get', 1.5, failed=True)
+        self.assert_counts('get', 2, errors=1)
+        self.assert_counts('family.foo', 2, errors=1)
+        self.assertTrue(isinstance(
+            self.metric_manager['store.get.count'], Count))
+        latency = self.metric_manager['store.get.latency']
+        self.assertTrue(isinstance(latency, Timer))
+        self.assertEqual(latency.aggs, ('avg', 'max'))
+
+    def test_record_reuses_registered_metrics(self):
+        other = OperationMetrics(self.metric_manager, 'store.')
+        self.op_metrics.record('foo', 'get', 0.5)
+        other.record('foo', 'get', 0.5)
+        self.assert_counts('get', 2)
+
+    def test_time_call(self):
+        result = self.op_metrics.time_call('foo', 'get', lambda x: x, 'bar')
+        self.assertEqual(result, 'bar')
+        self.assert_counts('get', 1)
+        self.assert_counts('family.foo', 1)
+
+    def test_time_call_error(self):
+        def fail():
+            raise ValueError("oops")
+        self.assertRaises(
+            ValueError, self.op_metrics.time_call, 'foo', 'get', fail)
+        self.assert_counts('get', 1, errors=1)
+
+    def test_time_call_deferred(self):
+        d = Deferred()
+        result_d = self.op_metrics.time_call('foo', 'get', lambda: d)
+        self.assertFalse('store.get.count' in self.metric_manager)
+        d.callback('bar')
+        self.assertEqual(self.successResultOf(result_d), 'bar')
+        self.assert_counts('get', 1)
+
+    def test_time_call_deferred_error(self):
+        d = Deferred()
+        result_d = self.op_metrics.time_call('foo', 'get', lambda: d)
+        d.errback(ValueError("oops"))
+        self.failureResultOf(result_d, ValueError)
+        self.assert_counts('get', 1, errors=1)
+
+    def test_time_call_deferred_result(self):
+        result_d = self.op_metrics.time_call(
+            'foo', 'get', lambda: succeed('bar'))
+        self.assertEqual(self.successResultOf(result_d), 'bar')
+        self.assert_counts('get', 1)
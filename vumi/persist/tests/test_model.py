@@ -7,10 +7,11 @@ from datetime import datetime
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.persist.model import (
-    Model, Manager, ModelMigrator, ModelMigrationError)
+    Model, Manager, ModelMigrator, ModelMigrationError, IndexPage)
 from vumi.persist.fields import (
     ValidationError, Integer, Unicode, VumiMessage, Dynamic, ListOf,
     ForeignKey, ManyToMany, Timestamp)
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase, import_skip
 
@@ -203,6 +204,31 @@ class TestModelOnTxRiak(VumiTestCase):
             indexes.setdefault(index.get_field(), []).append(index.get_value())
         return indexes
 
+    @Manager.calls_manager
+    def test_instrument(self):
+        metric_manager = MetricManager('vumi.test.')
+        self.manager.instrument(metric_manager)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo", a=1, b=u"bar").save()
+        s = yield simple_model.load("foo")
+        self.assertEqual(s.a, 1)
+        missing = yield simple_model.load("missing")
+        self.assertEqual(missing, None)
+
+        def count(name):
+            return len(metric_manager['riak.%s.count' % name].poll())
+        self.assertEqual(count('store'), 1)
+        self.assertEqual(count('load'), 2)
+        self.assertEqual(count('family.test_simplemodel'), 3)
+        self.assertFalse('riak.load.errors' in metric_manager)
+
+    def test_instrument_sub_manager(self):
+        metric_manager = MetricManager('vumi.test.')
+        self.manager.instrument(metric_manager)
+        sub_manager = self.manager.sub_manager('sub.')
+        self.assertTrue(sub_manager._op_metrics is self.manager._op_metrics)
+        self.assertTrue('store' in vars(sub_manager))
+
     def test_simple_class(self):
         field_names = SimpleModel.field_descriptors.keys()
         self.assertEqual(sorted(field_names), ['a', 'b'])
@@ -339,6 +365,18 @@ class TestModelOnTxRiak(VumiTestCase):
             ["one", "two"], search, 'b:abc OR b:def')
         yield self.assert_mapreduce_results(["three", "two"], search, 'a:2')
 
+    @Manager.calls_manager
+    def test_store_many(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        objs = [simple_model("foo%d" % (i,), a=i, b=u"%d" % (i,))
+                for i in range(5)]
+        results = yield simple_model.store_many(objs, concurrency=2)
+        self.assertEqual(results, [(True, obj) for obj in objs])
+
+        for i in range(5):
+            obj = yield simple_model.load("foo%d" % (i,))
+            self.assertEqual((obj.a, obj.b), (i, u"%d" % (i,)))
+
     @Manager.calls_manager
     def test_load_all_bunches(self):
         self.assertFalse(self.manager.USE_MAPREDUCE_BUNCH_LOADING)
@@ -515,6 +553,40 @@ class TestModelOnTxRiak(VumiTestCase):
         keys = yield indexed_model.index_keys('b', None)
         self.assertEqual(keys, ["foo3"])
 
+    @Manager.calls_manager
+    def test_index_keys_page(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=2, b=u"one").save()
+        yield indexed_model("foo3", a=2, b=u"one").save()
+
+        page = yield indexed_model.index_keys_page('b', u"one", max_results=2)
+        self.assertEqual(len(page.keys), 2)
+        self.assertTrue(page.has_next_page())
+
+        next_page = yield indexed_model.index_keys_page(
+            'b', u"one", max_results=2, continuation=page.continuation)
+        self.assertEqual(len(next_page.keys), 1)
+        self.assertFalse(next_page.has_next_page())
+        self.assertEqual(
+            sorted(page.keys + next_page.keys), ["foo1", "foo2", "foo3"])
+
+    @Manager.calls_manager
+    def test_index_keys_pages(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        for i in range(5):
+            yield indexed_model("foo%d" % (i,), a=1, b=u"one").save()
+        yield indexed_model("bar", a=2, b=u"two").save()
+
+        pages = []
+        for keys_page in indexed_model.index_keys_pages(
+                'b', u"one", page_size=2):
+            keys = yield keys_page
+            pages.append(keys)
+        self.assertEqual([len(keys) for keys in pages], [2, 2, 1])
+        self.assertEqual(
+            sorted(sum(pages, [])), ["foo0", "foo1", "foo2", "foo3", "foo4"])
+
     @Manager.calls_manager
     def test_index_lookup(self):
         indexed_model = self.manager.proxy(IndexedModel)
@@ -569,6 +641,49 @@ class TestModelOnTxRiak(VumiTestCase):
         m1.msg = msg2
         self.assertTrue("extra" not in m1.msg)
 
+    def test_vumimessage_field_decoded_once(self):
+        msg_model = self.manager.proxy(VumiMessageModel)
+        msg = self.mkmsg(extra="bar")
+        m1 = msg_model("foo", msg=msg)
+        self.assertEqual(m1.msg, msg)
+        decoded = m1._msg_field_cache['msg']
+        self.assertEqual(decoded, msg)
+        self.assertEqual(m1.msg, msg)
+        self.assertTrue(m1._msg_field_cache['msg'] is decoded)
+
+        msg2 = self.mkmsg()
+        m1.msg = msg2
+        self.assertEqual(m1.msg, msg2)
+        self.assertFalse(m1._msg_field_cache['msg'] is decoded)
+
+        m1.msg = None
+        self.assertEqual(m1.msg, None)
+        self.assertEqual(
+            [key for key in m1._riak_object.get_data()
+             if key.startswith("msg.")], [])
+
+    def test_vumimessage_field_returns_copies(self):
+        msg_model = self.manager.proxy(VumiMessageModel)
+        msg = self.mkmsg(extra="bar")
+        m1 = msg_model("foo", msg=msg)
+        msg1 = m1.msg
+        self.assertFalse(m1.msg is msg1)
+        msg1["extra"] = "changed"
+        msg1["helper_metadata"]["foo"] = "bar"
+        self.assertEqual(m1.msg, msg)
+        self.assertEqual(m1.msg["extra"], "bar")
+        self.assertEqual(m1.msg["helper_metadata"], {})
+
+    def test_vumimessage_field_new_riak_data(self):
+        msg_model = self.manager.proxy(VumiMessageModel)
+        msg = self.mkmsg(extra="bar")
+        m1 = msg_model("foo", msg=msg)
+        self.assertEqual(m1.msg, msg)
+
+        other = msg_model("bar", msg=self.mkmsg(extra="baz"))
+        m1._riak_object.set_data(other._riak_object.get_data())
+        self.assertEqual(m1.msg["extra"], "baz")
+
     def _create_dynamic_instance(self, dynamic_model):
         d1 = dynamic_model("foo", a=u"ab")
         d1.contact_info['cellphone'] = u"+27123"
@@ -1043,3 +1158,10 @@ class TestModelOnRiak(TestModelOnTxRiak):
 
         self.manager = RiakManager.from_config({'bucket_prefix': 'test.'})
         self.manager.purge_all()
+
+
+class TestIndexPage(VumiTestCase):
+
+    def test_has_next_page(self):
+        self.assertTrue(IndexPage(["a"], "abc").has_next_page())
+        self.assertFalse(IndexPage(["a"]).has_next_page())
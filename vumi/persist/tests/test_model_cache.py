@@ -0,0 +1,229 @@
+"""Tests for vumi.persist.model_cache."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.persist.model import Model
+from vumi.persist.fields import Integer, Unicode
+from vumi.persist.model_cache import ModelCache
+from vumi.tests.helpers import VumiTestCase, import_skip
+
+
+class CachedModel(Model):
+    a = Integer(index=True)
+    b = Unicode(null=True)
+
+
+class UncachedModel(Model):
+    a = Integer()
+
+
+class TestModelCache(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import TxRiakManager
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.manager = TxRiakManager.from_config({'bucket_prefix': 'test.'})
+        self.add_cleanup(self.manager.purge_all)
+        yield self.manager.purge_all()
+        # A second manager without a cache, to change things behind the
+        # cache's back.
+        self.other_manager = TxRiakManager.from_config(
+            {'bucket_prefix': 'test.'})
+        self.clock = Clock()
+        self.metrics = MetricManager('vumi.test.')
+        self.cache = self.manager.cache_models(
+            {CachedModel: 10}, max_size=2, metric_manager=self.metrics,
+            clock=self.clock)
+        self.cached = self.manager.proxy(CachedModel)
+        self.other = self.other_manager.proxy(CachedModel)
+
+    def count(self, name):
+        return len(self.metrics[name].poll())
+
+    @inlineCallbacks
+    def test_load_caches(self):
+        yield self.other("foo", a=1, b=u"one").save()
+        obj = yield self.cached.load("foo")
+        self.assertEqual((obj.a, obj.b), (1, u"one"))
+        yield self.other("foo", a=2, b=u"two").save()
+        obj = yield self.cached.load("foo")
+        self.assertEqual((obj.a, obj.b), (1, u"one"))
+        self.assertEqual(self.count('riak_cache.hits'), 1)
+        self.assertEqual(self.count('riak_cache.misses'), 1)
+
+    @inlineCallbacks
+    def test_hits_are_copies(self):
+        yield self.other("foo", a=1).save()
+        obj = yield self.cached.load("foo")
+        obj.a = 5
+        obj = yield self.cached.load("foo")
+        self.assertEqual(obj.a, 1)
+
+    @inlineCallbacks
+    def test_ttl(self):
+        yield self.other("foo", a=1).save()
+        yield self.cached.load("foo")
+        yield self.other("foo", a=2).save()
+        self.clock.advance(9)
+        self.assertEqual((yield self.cached.load("foo")).a, 1)
+        self.clock.advance(1)
+        self.assertEqual((yield self.cached.load("foo")).a, 2)
+
+    @inlineCallbacks
+    def test_max_size(self):
+        for key in ["a", "b", "c"]:
+            yield self.other(key, a=1).save()
+        yield self.cached.load("a")
+        yield self.cached.load("b")
+        yield self.cached.load("a")
+        yield self.cached.load("c")
+        # "b" was the least recently used object, so it was dropped.
+        for key in ["a", "b", "c"]:
+            yield self.other(key, a=2).save()
+        self.assertEqual((yield self.cached.load("a")).a, 1)
+        self.assertEqual((yield self.cached.load("b")).a, 2)
+
+    @inlineCallbacks
+    def test_store_updates_cache(self):
+        obj = self.cached("foo", a=1)
+        yield obj.save()
+        obj = yield self.cached.load("foo")
+        self.assertEqual(obj.a, 1)
+        self.assertEqual(self.count('riak_cache.hits'), 1)
+        self.assertEqual(self.count('riak_cache.misses'), 0)
+
+    @inlineCallbacks
+    def test_store_keeps_vclock(self):
+        yield self.cached("foo", a=1).save()
+        obj = yield self.cached.load("foo")
+        vclock = obj._riak_object.vclock()
+        self.assertNotEqual(vclock, None)
+        obj.a = 2
+        yield obj.save()
+        self.assertNotEqual(obj._riak_object.vclock(), vclock)
+        obj = yield self.other.load("foo")
+        self.assertEqual(obj.a, 2)
+        # Storing with the cached vclock doesn't leave siblings.
+        self.assertEqual(obj._riak_object.get_sibling_count(), 0)
+
+    @inlineCallbacks
+    def test_store_keeps_indexes(self):
+        yield self.cached("foo", a=1).save()
+        obj = yield self.cached.load("foo")
+        obj.b = u"changed"
+        yield obj.save()
+        keys = yield self.other.index_keys('a', 1)
+        self.assertEqual(keys, ["foo"])
+
+    @inlineCallbacks
+    def test_delete_drops_object(self):
+        obj = self.cached("foo", a=1)
+        yield obj.save()
+        yield obj.delete()
+        self.assertEqual((yield self.cached.load("foo")), None)
+
+    @inlineCallbacks
+    def test_missing_objects_not_cached(self):
+        self.assertEqual((yield self.cached.load("foo")), None)
+        yield self.other("foo", a=1).save()
+        self.assertEqual((yield self.cached.load("foo")).a, 1)
+
+    @inlineCallbacks
+    def test_uncached_model(self):
+        uncached = self.manager.proxy(UncachedModel)
+        yield uncached("foo", a=1).save()
+        yield uncached.load("foo")
+        yield self.other_manager.proxy(UncachedModel)("foo", a=2).save()
+        self.assertEqual((yield uncached.load("foo")).a, 2)
+        self.assertEqual(self.count('riak_cache.hits'), 0)
+        self.assertEqual(self.count('riak_cache.misses'), 0)
+
+    @inlineCallbacks
+    def test_load_during_store_not_cached(self):
+        yield self.other("foo", a=1).save()
+        d = self.cached.load("foo")
+        obj = self.cached("foo", a=2)
+        yield obj.save()
+        yield d
+        self.assertEqual((yield self.cached.load("foo")).a, 2)
+
+    @inlineCallbacks
+    def test_sub_manager_shares_cache(self):
+        sub_manager = self.manager.sub_manager("sub.")
+        self.assertEqual(sub_manager._object_cache, self.cache)
+        self.add_cleanup(sub_manager.purge_all)
+        yield sub_manager.proxy(CachedModel)("foo", a=1).save()
+        self.assertEqual((yield self.cached.load("foo")), None)
+
+    def test_cache_models_extends_cache(self):
+        cache = self.manager.cache_models({UncachedModel: 5})
+        self.assertEqual(cache, self.cache)
+        self.assertTrue(cache.caches(CachedModel))
+        self.assertTrue(cache.caches(UncachedModel))
+
+
+class ModelCacheRestoreMixin(object):
+    """
+    Check that snapshots restore onto the riak client's own objects.
+
+    :meth:`ModelCache._restore` sets the private ``_vclock`` attribute of
+    the riak object, so these run against the real riak object classes
+    without needing a riak server.
+    """
+
+    def get_manager(self):
+        raise NotImplementedError("Sub-classes should implement"
+                                  " .get_manager()")
+
+    def setUp(self):
+        self.manager = self.get_manager()
+
+    def mk_snapshot(self, vclock='a85hYGBgzGDKBVIcypz/fgaUHjmTwZTImMfKkD3z'):
+        return {
+            'vclock': vclock,
+            'content_type': 'application/json',
+            'indexes': [('a_int', '1')],
+            'data': '{"a": 1}',
+        }
+
+    def test_restore(self):
+        snapshot = self.mk_snapshot()
+        riak_object = ModelCache._restore(
+            self.manager, CachedModel, 'foo', snapshot)
+        self.assertEqual(riak_object.get_key(), 'foo')
+        # The riak transports send riak_object.vclock() when storing.
+        self.assertEqual(riak_object.vclock(), snapshot['vclock'])
+        self.assertEqual(riak_object.get_data(), {'a': 1})
+        self.assertEqual(ModelCache._snapshot(riak_object), snapshot)
+
+    def test_restore_makes_new_objects(self):
+        snapshot = self.mk_snapshot()
+        obj1 = ModelCache._restore(self.manager, CachedModel, 'foo', snapshot)
+        obj2 = ModelCache._restore(self.manager, CachedModel, 'foo', snapshot)
+        self.assertFalse(obj1 is obj2)
+        obj1.set_data({'a': 2})
+        obj1.add_index('a_int', '2')
+        self.assertEqual(obj2.get_data()['a'], 1)
+        self.assertEqual(ModelCache._snapshot(obj2), snapshot)
+
+
+class TestModelCacheRestoreRiak(ModelCacheRestoreMixin, VumiTestCase):
+    def get_manager(self):
+        try:
+            from vumi.persist.riak_manager import RiakManager
+        except ImportError, e:
+            import_skip(e, 'riak')
+        return RiakManager.from_config({'bucket_prefix': 'test.'})
+
+
+class TestModelCacheRestoreRiakasaurus(ModelCacheRestoreMixin, VumiTestCase):
+    def get_manager(self):
+        try:
+            from vumi.persist.txriak_manager import TxRiakManager
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        return TxRiakManager.from_config({'bucket_prefix': 'test.'})
@@ -1,5 +1,6 @@
 """Tests for vumi.persist.redis_base."""
 
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.persist.redis_base import Manager
 from vumi.tests.helpers import VumiTestCase
 
@@ -33,3 +34,80 @@ class TestBaseRedisManager(VumiTestCase):
         self.assertEqual(sub_manager._key_prefix, "foo")
         self.assertEqual(sub_manager._client, manager._client)
         self.assertEqual(sub_manager._key_separator, manager._key_separator)
+
+    def test_call_keys(self):
+        manager = self.mk_manager()
+        self.assertEqual(manager._call_keys('get', ('foo',), {}), ['foo'])
+        self.assertEqual(
+            manager._call_keys('smove', ('src', 'dst', 'value'), {}),
+            ['src', 'dst'])
+        self.assertEqual(
+            manager._call_keys('sunion', ('a', 'b', 'c'), {}),
+            ['a', 'b', 'c'])
+        self.assertEqual(
+            manager._call_keys('setex', (), {'key': 'foo', 'seconds': 5,
+                                             'value': 'bar'}),
+            ['foo'])
+        self.assertEqual(manager._call_keys('keys', (), {}), [])
+
+    def test_pipeline_queues_calls(self):
+        manager = self.mk_manager()
+        pipe = manager.pipeline()
+        self.assertEqual(len(pipe), 0)
+        self.assertTrue(pipe.set('foo', 'bar') is pipe)
+        pipe.smove('src', 'dst', 'value').keys()
+        self.assertEqual(len(pipe), 3)
+        self.assertEqual(pipe._calls[:2], [
+            ['set', ('test:foo', 'bar'), {}, None],
+            ['smove', ('test:src', 'test:dst', 'value'), {}, None],
+        ])
+        [call, args, kw, filter_func] = pipe._calls[2]
+        self.assertEqual(
+            (call, args, kw), ('keys', (), {'pattern': 'test:*'}))
+        self.assertEqual(filter_func(['test:foo']), ['foo'])
+
+    def test_pipeline_manager_attrs(self):
+        manager = self.mk_manager()
+        pipe = manager.pipeline()
+        pipe.scan(None)
+        [call, args, kw, filter_func] = pipe._calls[0]
+        self.assertEqual(filter_func(['0', ['test:foo']]), ['0', ['foo']])
+        for name in ['run_script', 'scan_batches', 'pipeline', 'sub_manager',
+                     'get_key_prefix', 'instrument']:
+            self.assertRaises(AttributeError, getattr, pipe, name)
+
+    def test_pipeline_execute(self):
+        manager = self.mk_manager()
+        executed = []
+        manager._execute_pipeline = lambda calls: executed.append(calls)
+        pipe = manager.pipeline()
+        pipe.get('foo')
+        pipe.execute()
+        self.assertEqual(executed, [[['get', ('test:foo',), {}, None]]])
+        self.assertEqual(len(pipe), 0)
+
+    def test_instrument(self):
+        manager = self.mk_manager()
+        manager._make_redis_call = lambda call, *args: (call, args)
+        metric_manager = MetricManager('vumi.test.')
+        manager.instrument(metric_manager)
+        sub_manager = manager.sub_manager('sub')
+        sub_manager._make_redis_call = manager._make_redis_call
+
+        self.assertEqual(manager.get('foo'), ('get', ('test:foo',)))
+        self.assertEqual(sub_manager.get('foo'), ('get', ('test:sub:foo',)))
+        self.assertEqual(len(metric_manager['redis.get.count'].poll()), 2)
+        self.assertEqual(
+            len(metric_manager['redis.family.test.count'].poll()), 1)
+        self.assertEqual(
+            len(metric_manager['redis.family.test_sub.count'].poll()), 1)
+
+    def test_instrument_pipeline(self):
+        manager = self.mk_manager()
+        manager._execute_pipeline = lambda calls: len(calls)
+        metric_manager = MetricManager('vumi.test.')
+        manager.instrument(metric_manager)
+        self.assertEqual(manager.pipeline().get('foo').get('bar').execute(), 2)
+        self.assertFalse('redis.get.count' in metric_manager)
+        self.assertEqual(
+            len(metric_manager['redis.pipeline.count'].poll()), 1)
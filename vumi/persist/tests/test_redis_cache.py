@@ -0,0 +1,216 @@
+"""Tests for vumi.persist.redis_cache."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.persist.redis_base import RedisScript
+from vumi.persist.redis_cache import CachedRedisManager
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.tests.helpers import VumiTestCase, import_skip
+
+
+class TestCachedRedisManager(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.manager = yield TxRedisManager.from_config(
+            {'FAKE_REDIS': 'yes',
+             'key_prefix': 'redistest'})
+        self.add_cleanup(self.manager._close)
+        self.clock = Clock()
+
+    def mk_cache(self, ttl=10, **kw):
+        return CachedRedisManager(self.manager, ttl, clock=self.clock, **kw)
+
+    @inlineCallbacks
+    def test_read_through(self):
+        cache = self.mk_cache()
+        yield self.manager.set('foo', 'bar')
+        self.assertEqual((yield cache.get('foo')), 'bar')
+        yield self.manager.set('foo', 'baz')
+        self.assertEqual((yield cache.get('foo')), 'bar')
+
+    @inlineCallbacks
+    def test_ttl(self):
+        cache = self.mk_cache(ttl=10)
+        yield self.manager.set('foo', 'bar')
+        yield cache.get('foo')
+        yield self.manager.set('foo', 'baz')
+        self.clock.advance(9)
+        self.assertEqual((yield cache.get('foo')), 'bar')
+        self.clock.advance(1)
+        self.assertEqual((yield cache.get('foo')), 'baz')
+
+    @inlineCallbacks
+    def test_cache_none(self):
+        cache = self.mk_cache()
+        self.assertEqual((yield cache.get('foo')), None)
+        yield self.manager.set('foo', 'bar')
+        self.assertEqual((yield cache.get('foo')), None)
+
+    @inlineCallbacks
+    def test_cache_none_disabled(self):
+        cache = self.mk_cache(cache_none=False)
+        self.assertEqual((yield cache.get('foo')), None)
+        yield self.manager.set('foo', 'bar')
+        self.assertEqual((yield cache.get('foo')), 'bar')
+
+    @inlineCallbacks
+    def test_follow_key_ttl(self):
+        # The cache and the fake redis need to share a clock.
+        clock = self.manager._client.clock
+        cache = CachedRedisManager(
+            self.manager, 10, follow_key_ttl=True, clock=clock)
+        yield self.manager.setex('foo', 5, 'bar')
+        yield self.manager.set('baz', 'quux')
+        self.assertEqual((yield cache.get('foo')), 'bar')
+        self.assertEqual((yield cache.get('baz')), 'quux')
+        yield self.manager.set('baz', 'changed')
+        clock.advance(5)
+        self.assertEqual((yield cache.get('foo')), None)
+        self.assertEqual((yield cache.get('baz')), 'quux')
+        clock.advance(5)
+        self.assertEqual((yield cache.get('baz')), 'changed')
+
+    @inlineCallbacks
+    def test_max_size(self):
+        cache = self.mk_cache(max_size=2)
+        for key in ['a', 'b', 'c']:
+            yield self.manager.set(key, '1')
+        yield cache.get('a')
+        yield cache.get('b')
+        yield cache.get('a')
+        yield cache.get('c')
+        # 'b' was the least recently used result, so it was dropped.
+        for key in ['a', 'b', 'c']:
+            yield self.manager.set(key, '2')
+        self.assertEqual((yield cache.get('a')), '1')
+        self.assertEqual((yield cache.get('b')), '2')
+
+    @inlineCallbacks
+    def test_write_invalidates(self):
+        cache = self.mk_cache()
+        yield cache.hmset('foo', {'a': '1'})
+        self.assertEqual((yield cache.hgetall('foo')), {'a': '1'})
+        self.assertEqual((yield cache.hget('foo', 'a')), '1')
+        yield cache.hset('foo', 'a', '2')
+        self.assertEqual((yield cache.hgetall('foo')), {'a': '2'})
+        self.assertEqual((yield cache.hget('foo', 'a')), '2')
+        yield cache.delete('foo')
+        self.assertEqual((yield cache.hgetall('foo')), {})
+
+    @inlineCallbacks
+    def test_pipeline_invalidates(self):
+        cache = self.mk_cache()
+        yield self.manager.set('foo', 'bar')
+        yield cache.get('foo')
+        yield cache.pipeline().set('foo', 'baz').execute()
+        self.assertEqual((yield cache.get('foo')), 'baz')
+
+    @inlineCallbacks
+    def test_run_script_invalidates(self):
+        script = RedisScript("-- cached set test", fake_func=(
+            lambda call, keys, args: call('set', keys[0], args[0])))
+        cache = self.mk_cache()
+        yield self.manager.set('foo', 'bar')
+        yield cache.get('foo')
+        yield cache.run_script(script, ['foo'], ['baz'])
+        self.assertEqual((yield cache.get('foo')), 'baz')
+
+    @inlineCallbacks
+    def test_invalidate_and_clear(self):
+        cache = self.mk_cache()
+        yield self.manager.set('foo', 'bar')
+        yield self.manager.set('baz', 'quux')
+        yield cache.get('foo')
+        yield cache.get('baz')
+        yield self.manager.set('foo', 'bar2')
+        yield self.manager.set('baz', 'quux2')
+        cache.invalidate('foo')
+        self.assertEqual((yield cache.get('foo')), 'bar2')
+        self.assertEqual((yield cache.get('baz')), 'quux')
+        cache.clear()
+        self.assertEqual((yield cache.get('baz')), 'quux2')
+
+    @inlineCallbacks
+    def test_write_during_read_not_cached(self):
+        cache = self.mk_cache()
+        yield self.manager.set('foo', 'bar')
+        read_d = cache.get('foo')
+        write_d = cache.set('foo', 'baz')
+        self.assertEqual((yield read_d), 'bar')
+        yield write_d
+        self.assertEqual((yield cache.get('foo')), 'baz')
+
+    @inlineCallbacks
+    def test_cached_results_are_copies(self):
+        cache = self.mk_cache()
+        yield self.manager.hset('foo', 'a', '1')
+        (yield cache.hgetall('foo'))['b'] = '2'
+        self.assertEqual((yield cache.hgetall('foo')), {'a': '1'})
+
+    @inlineCallbacks
+    def test_cached_calls(self):
+        cache = self.mk_cache(cached_calls=['hgetall'])
+        yield self.manager.set('foo', 'bar')
+        yield cache.get('foo')
+        yield self.manager.set('foo', 'baz')
+        self.assertEqual((yield cache.get('foo')), 'baz')
+
+    @inlineCallbacks
+    def test_uncached_calls_pass_through(self):
+        cache = self.mk_cache()
+        yield cache.set('foo', 'bar')
+        self.assertEqual((yield cache.keys()), ['foo'])
+        self.assertEqual(cache.get_key_prefix(), 'redistest')
+
+    @inlineCallbacks
+    def test_sub_manager_shares_cache(self):
+        cache = self.mk_cache()
+        sub_cache = cache.sub_manager('sub')
+        self.assertTrue(isinstance(sub_cache, CachedRedisManager))
+        self.assertEqual(sub_cache.get_key_prefix(), 'redistest:sub')
+        yield self.manager.set('sub:foo', 'bar')
+        self.assertEqual((yield cache.get('sub:foo')), 'bar')
+        self.assertEqual((yield sub_cache.get('foo')), 'bar')
+        yield self.manager.set('sub:foo', 'baz')
+        self.assertEqual((yield sub_cache.get('foo')), 'bar')
+        yield sub_cache.set('foo', 'quux')
+        self.assertEqual((yield cache.get('sub:foo')), 'quux')
+        yield cache.delete('sub:foo')
+        self.assertEqual((yield sub_cache.get('foo')), None)
+
+    @inlineCallbacks
+    def test_metrics(self):
+        metric_manager = MetricManager('vumi.test.')
+        cache = self.mk_cache(metric_manager=metric_manager)
+        yield cache.get('foo')
+        yield cache.get('foo')
+        yield cache.get('foo')
+        self.assertEqual(
+            len(metric_manager['redis_cache.hits'].poll()), 2)
+        self.assertEqual(
+            len(metric_manager['redis_cache.misses'].poll()), 1)
+        # A second cache can share the metrics.
+        self.mk_cache(metric_manager=metric_manager)
+
+
+class TestCachedSyncRedisManager(VumiTestCase):
+    def setUp(self):
+        try:
+            from vumi.persist.redis_manager import RedisManager
+        except ImportError, e:
+            import_skip(e, 'redis')
+        self.manager = RedisManager.from_config(
+            {'FAKE_REDIS': 'yes',
+             'key_prefix': 'redistest'})
+        self.add_cleanup(self.manager._close)
+
+    def test_read_through(self):
+        cache = CachedRedisManager(self.manager, 10, clock=Clock())
+        self.manager.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.manager.set('foo', 'baz')
+        self.assertEqual(cache.get('foo'), 'bar')
+        cache.set('foo', 'quux')
+        self.assertEqual(cache.get('foo'), 'quux')
@@ -1,5 +1,6 @@
 """Tests for vumi.persist.redis_manager."""
 
+from vumi.persist.redis_base import RedisScript
 from vumi.tests.helpers import VumiTestCase, import_skip
 
 
@@ -60,3 +61,85 @@ class TestRedisManager(VumiTestCase):
         self.assertEqual(cursor, None)
         self.assertEqual(all_keys, set(
             'key%d' % i for i in range(10)))
+
+    def test_scan_batches(self):
+        for i in range(25):
+            self.manager.set('key%d' % i, 'value')
+        self.manager.set('other', 'value')
+        batches = list(self.manager.scan_batches('key*', count=10))
+        self.assertTrue(len(batches) > 1)
+        self.assertEqual(
+            sorted(sum(batches, [])), sorted('key%d' % i for i in range(25)))
+
+    def test_pipeline(self):
+        self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.get('foo').set('baz', 'quux').keys()
+        pipe.get('baz')
+        [foo, _, keys, baz] = pipe.execute()
+        self.assertEqual(foo, 'bar')
+        self.assertEqual(sorted(keys), ['baz', 'foo'])
+        self.assertEqual(baz, 'quux')
+        self.assertEqual(pipe.execute(), [])
+
+    def test_run_script(self):
+        script = RedisScript("-- incr test", fake_func=(
+            lambda call, keys, args: call('incr', keys[0], int(args[0]))))
+        self.assertEqual(self.manager.run_script(script, ['foo'], [2]), 2)
+        self.assertEqual(self.manager.get('foo'), '2')
+        # The script is only loaded once.
+        load_calls = []
+        self.manager._client.script_load = load_calls.append
+        self.assertEqual(self.manager.run_script(script, ['foo'], [2]), 4)
+        self.assertEqual(load_calls, [])
+
+    def test_run_script_reloads(self):
+        script = RedisScript("-- reload test", fake_func=(
+            lambda call, keys, args: call('get', keys[0])))
+        self.manager.set('foo', 'bar')
+        self.assertEqual(self.manager.run_script(script, ['foo']), 'bar')
+        # The server forgets its scripts when it restarts.
+        self.manager._client._scripts.clear()
+        self.assertEqual(self.manager.run_script(script, ['foo']), 'bar')
+
+
+class TestShardedRedisManager(VumiTestCase):
+    def setUp(self):
+        try:
+            from vumi.persist.redis_manager import ShardedRedisManager
+        except ImportError, e:
+            import_skip(e, 'redis')
+
+        self.manager = ShardedRedisManager.from_config({
+            'FAKE_REDIS': 'yes',
+            'key_prefix': 'redistest',
+            'shards': [{}, {}],
+        })
+        self.add_cleanup(self.manager.close_manager)
+
+    def test_keys_spread_over_shards(self):
+        keys = ['key%d' % i for i in range(20)]
+        for key in keys:
+            self.manager.set(key, key.upper())
+        self.assertEqual(
+            [self.manager.get(key) for key in keys],
+            [key.upper() for key in keys])
+        self.assertEqual(sorted(self.manager.keys()), sorted(keys))
+        shard_data = [shard._client._data for shard in self.manager._shards]
+        self.assertTrue(all(shard_data))
+
+    def test_pipeline(self):
+        keys = ['key%d' % i for i in range(10)]
+        pipe = self.manager.pipeline()
+        for key in keys:
+            pipe.set(key, key.upper())
+        pipe.execute()
+        for key in keys:
+            pipe.get(key)
+        self.assertEqual(pipe.execute(), [key.upper() for key in keys])
+
+    def test_purge_all(self):
+        self.manager.set('foo', 'bar')
+        self.manager.sub_manager('sub').set('foo', 'bar')
+        self.manager._purge_all()
+        self.assertEqual(self.manager.keys(), [])
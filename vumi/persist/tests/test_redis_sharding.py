@@ -0,0 +1,63 @@
+"""Tests for vumi.persist.redis_sharding."""
+
+from vumi.persist.redis_sharding import HashRing, hash_tag
+from vumi.tests.helpers import VumiTestCase
+
+
+class TestHashTag(VumiTestCase):
+    def test_no_tag(self):
+        self.assertEqual(hash_tag('foo:bar'), 'foo:bar')
+
+    def test_tag(self):
+        self.assertEqual(hash_tag('foo:{user1}:bar'), 'user1')
+        self.assertEqual(hash_tag('{user1}:bar:{baz}'), 'user1')
+
+    def test_empty_or_unclosed_tag(self):
+        self.assertEqual(hash_tag('foo:{}:bar'), 'foo:{}:bar')
+        self.assertEqual(hash_tag('foo:{bar'), 'foo:{bar')
+
+
+class TestHashRing(VumiTestCase):
+    def keys(self, count=1000):
+        return ['key%d' % i for i in range(count)]
+
+    def test_no_nodes(self):
+        self.assertRaises(ValueError, HashRing, [])
+
+    def test_duplicate_names(self):
+        self.assertRaises(ValueError, HashRing, ['a', 'b'], ['x', 'x'])
+
+    def test_single_node(self):
+        ring = HashRing(['a'])
+        self.assertEqual(set(ring.get_node(k) for k in self.keys()), set('a'))
+
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {}
+        for key in self.keys():
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        for count in counts.values():
+            self.assertTrue(200 < count < 470, counts)
+
+    def test_hash_tags_share_node(self):
+        ring = HashRing(['a', 'b', 'c'])
+        nodes = set(ring.get_node('{user1}:%s' % k) for k in self.keys(50))
+        self.assertEqual(len(nodes), 1)
+
+    def test_adding_node_moves_few_keys(self):
+        ring = HashRing(['a', 'b', 'c'], ['a', 'b', 'c'])
+        bigger_ring = HashRing(['a', 'b', 'c', 'd'], ['a', 'b', 'c', 'd'])
+        moved = [k for k in self.keys()
+                 if ring.get_node(k) != bigger_ring.get_node(k)]
+        # Only keys that move to the new node should move.
+        self.assertEqual(
+            set(bigger_ring.get_node(k) for k in moved), set(['d']))
+        self.assertTrue(len(moved) < 400, len(moved))
+
+    def test_names_fix_positions(self):
+        ring = HashRing(['a', 'b'], ['x', 'y'])
+        swapped = HashRing(['b', 'a'], ['y', 'x'])
+        for key in self.keys(100):
+            self.assertEqual(ring.get_node(key), swapped.get_node(key))
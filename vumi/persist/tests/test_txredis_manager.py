@@ -1,8 +1,12 @@
 """Tests for vumi.persist.txredis_manager."""
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
 
-from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.redis_base import RedisScript
+from vumi.persist.redis_sharding import CrossShardError
+from vumi.errors import ConfigError
+from vumi.persist.txredis_manager import (
+    TxRedisManager, VumiRedisPool, ShardedTxRedisManager)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -62,3 +66,261 @@ class TestTxRedisManager(VumiTestCase):
         self.assertEqual(cursor, None)
         self.assertEqual(all_keys, set(
             'key%d' % i for i in range(10)))
+
+    @inlineCallbacks
+    def test_scan_batches(self):
+        for i in range(25):
+            yield self.manager.set('key%d' % i, 'value')
+        yield self.manager.set('other', 'value')
+        batches = []
+        for keys_d in self.manager.scan_batches('key*', count=10):
+            batches.append((yield keys_d))
+        self.assertTrue(len(batches) > 1)
+        self.assertEqual(
+            sorted(sum(batches, [])), sorted('key%d' % i for i in range(25)))
+
+    def test_scan_batches_waits_for_batch(self):
+        batches = self.manager.scan_batches()
+        batches.next()
+        self.assertRaises(RuntimeError, batches.next)
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.get('foo').set('baz', 'quux').keys()
+        pipe.get('baz')
+        [foo, _, keys, baz] = yield pipe.execute()
+        self.assertEqual(foo, 'bar')
+        self.assertEqual(sorted(keys), ['baz', 'foo'])
+        self.assertEqual(baz, 'quux')
+        self.assertEqual((yield pipe.execute()), [])
+
+    @inlineCallbacks
+    def test_pipeline_error(self):
+        yield self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.get('foo')
+        pipe.incr('foo')
+        d = pipe.execute()
+        yield self.assertFailure(d, ValueError)
+
+    @inlineCallbacks
+    def test_run_script(self):
+        script = RedisScript("-- incr test", fake_func=(
+            lambda call, keys, args: call('incr', keys[0], int(args[0]))))
+        self.assertEqual(
+            (yield self.manager.run_script(script, ['foo'], [2])), 2)
+        self.assertEqual((yield self.manager.get('foo')), '2')
+        self.assertEqual(
+            (yield self.manager.run_script(script, ['foo'], [2])), 4)
+
+    @inlineCallbacks
+    def test_run_script_reloads(self):
+        script = RedisScript("-- reload test", fake_func=(
+            lambda call, keys, args: call('get', keys[0])))
+        yield self.manager.set('foo', 'bar')
+        self.assertEqual(
+            (yield self.manager.run_script(script, ['foo'])), 'bar')
+        # The server forgets its scripts when it restarts.
+        self.manager._client._scripts.clear()
+        self.assertEqual(
+            (yield self.manager.run_script(script, ['foo'])), 'bar')
+
+
+class StubFactory(object):
+    def __init__(self):
+        self.deferred = Deferred()
+
+    def reconnect(self, client):
+        prev_d, self.deferred = self.deferred, Deferred()
+        prev_d.callback(client)
+
+
+class StubClient(object):
+    def __init__(self, name, factory=None):
+        self.name = name
+        self.factory = factory or StubFactory()
+        self.connected_d = succeed(self)
+        self.replies = []
+        self.shutdown = False
+
+    def get(self, key):
+        d = Deferred()
+        self.replies.append(d)
+        return d
+
+    def keys(self, pattern):
+        return succeed([])
+
+    def _client_shutdown(self):
+        self.shutdown = True
+        return succeed(None)
+
+
+class TestVumiRedisPool(VumiTestCase):
+    def mk_pool(self, count, slow=False, dispatch='round-robin'):
+        clients = [StubClient(str(i)) for i in range(count)]
+        slow_client = StubClient('slow') if slow else None
+        return VumiRedisPool(clients, slow_client, dispatch), clients
+
+    def test_round_robin(self):
+        pool, [c0, c1] = self.mk_pool(2)
+        for _ in range(3):
+            pool.make_call('get', 'foo')
+        self.assertEqual(len(c0.replies), 1)
+        self.assertEqual(len(c1.replies), 2)
+
+    def test_least_pending(self):
+        pool, [c0, c1] = self.mk_pool(2, dispatch='least-pending')
+        pool.make_call('get', 'foo')
+        pool.make_call('get', 'foo')
+        self.assertEqual([len(c0.replies), len(c1.replies)], [1, 1])
+        c0.replies[0].callback('bar')
+        pool.make_call('get', 'foo')
+        self.assertEqual([len(c0.replies), len(c1.replies)], [2, 1])
+
+    def test_unknown_dispatch(self):
+        self.assertRaises(ConfigError, self.mk_pool, 1, dispatch='random')
+
+    def test_slow_commands(self):
+        pool, [c0] = self.mk_pool(1, slow=True)
+        self.assertTrue(pool.get_client('keys') is pool._slow_client)
+        self.assertTrue(pool.get_client('scan') is pool._slow_client)
+        self.assertTrue(pool.get_client('sunion') is pool._slow_client)
+        self.assertTrue(pool.get_client('get') is c0)
+        self.assertTrue(pool.get_client('smembers') is c0)
+        self.assertTrue(pool.get_client('hgetall') is c0)
+        self.assertTrue(pool.get_client() is c0)
+
+    def test_reconnect(self):
+        pool, [c0, c1] = self.mk_pool(2)
+        new_c0 = StubClient('new0', c0.factory)
+        c0.factory.reconnect(new_c0)
+        self.assertEqual(pool._clients, [new_c0, c1])
+        self.assertTrue(c0 not in pool._pending)
+        # The next reconnect is handled too.
+        newer_c0 = StubClient('newer0', c0.factory)
+        c0.factory.reconnect(newer_c0)
+        self.assertEqual(pool._clients, [newer_c0, c1])
+
+    @inlineCallbacks
+    def test_client_shutdown(self):
+        pool, clients = self.mk_pool(2, slow=True)
+        yield pool._client_shutdown()
+        self.assertEqual(
+            [c.shutdown for c in clients + [pool._slow_client]],
+            [True, True, True])
+
+
+class TestShardedTxRedisManager(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.manager = yield ShardedTxRedisManager.from_config({
+            'FAKE_REDIS': 'yes',
+            'key_prefix': 'redistest',
+            'shards': [{}, {}, {'shard_name': 'extra'}],
+        })
+        self.add_cleanup(self.manager.close_manager)
+
+    def shard_data(self):
+        return [shard._client._data for shard in self.manager._shards]
+
+    def keys_on_different_shards(self):
+        ring = self.manager._client
+        first = 'key0'
+        for i in range(1, 100):
+            other = 'key%d' % i
+            if (ring.node_index(self.manager._key(first)) !=
+                    ring.node_index(self.manager._key(other))):
+                return first, other
+
+    def test_shards(self):
+        self.assertEqual(len(self.manager._shards), 3)
+        for shard in self.manager._shards:
+            self.assertTrue(isinstance(shard, TxRedisManager))
+            self.assertEqual(shard._key_prefix, None)
+
+    @inlineCallbacks
+    def test_keys_spread_over_shards(self):
+        keys = ['key%d' % i for i in range(30)]
+        for key in keys:
+            yield self.manager.set(key, key.upper())
+        for key in keys:
+            self.assertEqual((yield self.manager.get(key)), key.upper())
+        shard_data = self.shard_data()
+        self.assertTrue(all(shard_data))
+        self.assertEqual(sum(len(data) for data in shard_data), 30)
+        for key in keys:
+            shard = self.manager._client.get_node(self.manager._key(key))
+            self.assertTrue(self.manager._key(key) in shard._client._data)
+
+    @inlineCallbacks
+    def test_keys_and_scan(self):
+        keys = ['key%d' % i for i in range(30)]
+        for key in keys:
+            yield self.manager.set(key, '1')
+        self.assertEqual(sorted((yield self.manager.keys())), sorted(keys))
+        scanned = []
+        cursor = None
+        while True:
+            cursor, scan_keys = yield self.manager.scan(cursor, count=7)
+            scanned.extend(scan_keys)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(scanned), sorted(keys))
+
+    @inlineCallbacks
+    def test_hash_tags(self):
+        yield self.manager.sadd('{user1}:src', 'a', 'b')
+        yield self.manager.smove('{user1}:src', '{user1}:dst', 'a')
+        self.assertEqual((yield self.manager.smembers('{user1}:dst')),
+                         set(['a']))
+        self.assertEqual(
+            len([data for data in self.shard_data() if data]), 1)
+
+    def test_cross_shard_smove(self):
+        src, dst = self.keys_on_different_shards()
+        self.assertRaises(
+            CrossShardError, self.manager.smove, src, dst, 'a')
+        self.assertRaises(
+            CrossShardError, self.manager.rpoplpush, src, dst)
+
+    @inlineCallbacks
+    def test_cross_shard_sunion(self):
+        key1, key2 = self.keys_on_different_shards()
+        yield self.manager.sadd(key1, 'a', 'b')
+        yield self.manager.sadd(key2, 'b', 'c')
+        self.assertEqual((yield self.manager.sunion(key1, key2)),
+                         set(['a', 'b', 'c']))
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        key1, key2 = self.keys_on_different_shards()
+        results = yield (self.manager.pipeline()
+                         .set(key1, 'a').set(key2, 'b')
+                         .get(key2).get(key1).execute())
+        self.assertEqual(results, [None, None, 'b', 'a'])
+
+    def test_pipeline_all_shard_calls(self):
+        pipe = self.manager.pipeline().keys()
+        self.assertRaises(CrossShardError, pipe.execute)
+
+    @inlineCallbacks
+    def test_run_script(self):
+        script = RedisScript("-- sharded copy test", fake_func=(
+            lambda call, keys, args: call(
+                'set', keys[1], call('get', keys[0]))))
+        yield self.manager.set('{a}:src', 'foo')
+        yield self.manager.run_script(script, ['{a}:src', '{a}:dst'])
+        self.assertEqual((yield self.manager.get('{a}:dst')), 'foo')
+        key1, key2 = self.keys_on_different_shards()
+        yield self.assertFailure(
+            self.manager.run_script(script, [key1, key2]), CrossShardError)
+
+    @inlineCallbacks
+    def test_sub_manager(self):
+        sub_manager = self.manager.sub_manager('sub')
+        self.assertTrue(sub_manager._client is self.manager._client)
+        yield sub_manager.set('foo', 'bar')
+        self.assertEqual((yield self.manager.get('sub:foo')), 'bar')
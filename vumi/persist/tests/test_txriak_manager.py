@@ -57,6 +57,8 @@ class CommonRiakManagerTests(object):
                          manager.DEFAULT_LOAD_BUNCH_SIZE)
         self.assertEqual(manager.mapreduce_timeout,
                          manager.DEFAULT_MAPREDUCE_TIMEOUT)
+        self.assertEqual(manager.load_bunch_concurrency,
+                         manager.DEFAULT_LOAD_BUNCH_CONCURRENCY)
 
     def test_from_config_with_bunch_size(self):
         manager_cls = self.manager.__class__
@@ -65,6 +67,13 @@ class CommonRiakManagerTests(object):
                                            })
         self.assertEqual(manager.load_bunch_size, 10)
 
+    def test_from_config_with_load_bunch_concurrency(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'load_bunch_concurrency': 4,
+                                           })
+        self.assertEqual(manager.load_bunch_concurrency, 4)
+
     def test_from_config_with_mapreduce_timeout(self):
         manager_cls = self.manager.__class__
         manager = manager_cls.from_config({'bucket_prefix': 'test.',
@@ -123,6 +132,23 @@ class CommonRiakManagerTests(object):
         dummy3 = yield self.manager.load(DummyModel, "foo")
         self.assertEqual(dummy3, None)
 
+    @Manager.calls_manager
+    def test_store_many(self):
+        dummies = [self.mkdummy(str(i), {"a": i}) for i in range(3)]
+        # This has no riak object, so storing it fails.
+        broken = DummyModel(self.manager, "broken")
+        results = yield self.manager.store_many(
+            dummies[:2] + [broken] + dummies[2:], concurrency=2)
+        self.assertEqual(
+            [success for success, _ in results], [True, True, False, True])
+        self.assertEqual(
+            [result for _, result in results[:2] + results[3:]], dummies)
+        results[2][1].trap(AttributeError)
+
+        for i in range(3):
+            dummy = yield self.manager.load(DummyModel, str(i))
+            self.assertEqual(dummy.get_data(), {"a": i})
+
     @Manager.calls_manager
     def test_load_missing(self):
         dummy = self.mkdummy("unknown")
@@ -146,6 +172,37 @@ class CommonRiakManagerTests(object):
         result_data.sort(key=lambda d: d["a"])
         self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
 
+    @Manager.calls_manager
+    def test_load_all_bunches_concurrently(self):
+        for i in range(5):
+            yield self.manager.store(self.mkdummy(str(i), {"a": i}))
+        self.manager.load_bunch_size = 2
+
+        keys = [str(i) for i in range(5)] + ["unknown"]
+
+        bunches = []
+        for result_bunch in self.manager.load_all_bunches(
+                DummyModel, keys, concurrency=2):
+            bunch = yield result_bunch
+            bunches.append(sorted(result.get_data()["a"] for result in bunch))
+        self.assertEqual(bunches, [[0, 1], [2, 3], [4]])
+
+    @Manager.calls_manager
+    def test_load_all_bunches_unordered(self):
+        for i in range(5):
+            yield self.manager.store(self.mkdummy(str(i), {"a": i}))
+        self.manager.load_bunch_size = 2
+
+        keys = [str(i) for i in range(5)] + ["unknown"]
+
+        result_data = []
+        for result_bunch in self.manager.load_all_bunches(
+                DummyModel, keys, concurrency=2, ordered=False):
+            bunch = yield result_bunch
+            self.assertTrue(len(bunch) <= 2)
+            result_data.extend(result.get_data()["a"] for result in bunch)
+        self.assertEqual(sorted(result_data), [0, 1, 2, 3, 4])
+
     @Manager.calls_manager
     def test_run_riak_map_reduce(self):
         dummies = [self.mkdummy(str(i), {"a": i}) for i in range(4)]
@@ -11,12 +11,17 @@ except ImportError:
     import txredis.protocol as txrp
     txr = txrp
 
+from functools import partial
+
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, DeferredList, succeed, Deferred)
+    inlineCallbacks, DeferredList, succeed, Deferred, gatherResults,
+    maybeDeferred, FirstError)
 
+from vumi.errors import ConfigError
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.redis_sharding import ShardedManager, HashRing
 
 
 class VumiRedis(txr.Redis):
@@ -146,6 +151,14 @@ class VumiRedis(txr.Redis):
             lambda r: ((None if r[0] == '0' or r[0] == 0 else r[0]), r[1]))
         return d
 
+    def script_load(self, script):
+        self._send('SCRIPT', 'LOAD', script)
+        return self.getResponse()
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        self._send('EVALSHA', sha, numkeys, *keys_and_args)
+        return self.getResponse()
+
 
 class VumiRedisClientFactory(txr.RedisClientFactory):
     protocol = VumiRedis
@@ -159,6 +172,107 @@ class VumiRedisClientFactory(txr.RedisClientFactory):
         return self.client
 
 
+class VumiRedisPool(object):
+    """A pool of connections to a redis server.
+
+    Commands are sent over the connections in turn (``round-robin``) or over
+    the connection with the fewest replies outstanding (``least-pending``).
+    If there is a slow connection, commands that can take a long time on
+    large data sets are sent over it instead, so they don't hold up the
+    replies to other commands.
+
+    Each connection reconnects by itself and replaces itself in the pool, so
+    managers and sub-managers that share a pool always use the current
+    connections.
+
+    Redis only runs commands in the order they were sent on one connection,
+    so with more than one connection the order commands are run in is lost:
+
+    * Commands sent one after the other without waiting may run out of
+      order. For example, after ``d = r.set(k, v); r.get(k)`` the ``get``
+      may run before the ``set`` and not see the new value. Wait for a
+      command's result before sending a command that depends on it.
+
+    * Commands sent over the slow connection (``keys``, ``scan`` and
+      ``sunion``) may not see writes that are still queued on the other
+      connections.
+
+    A pool with one connection (and no slow connection) keeps the ordering
+    of a plain connection, which is why ``pool_size`` defaults to 1.
+    """
+
+    DISPATCH_MODES = ('round-robin', 'least-pending')
+
+    # Only commands that walk the keyspace or combine several sets. Reads of
+    # a single key are usually small, and sending them all over one
+    # connection would make that connection the bottleneck.
+    SLOW_COMMANDS = frozenset(['keys', 'scan', 'sunion'])
+
+    def __init__(self, clients, slow_client=None, dispatch='round-robin'):
+        if dispatch not in self.DISPATCH_MODES:
+            raise ConfigError("Unknown redis pool dispatch mode: %r" % (
+                dispatch,))
+        self._dispatch = dispatch
+        self._clients = list(clients)
+        self._slow_client = slow_client
+        self._pending = {}
+        self._next_index = 0
+        for index, client in enumerate(self._clients):
+            self._watch_client(client, index)
+        if slow_client is not None:
+            self._watch_client(slow_client, None)
+
+    def _watch_client(self, client, index):
+        self._pending[client] = 0
+
+        def reconnect(new_client):
+            new_client.factory.deferred.addCallback(reconnect)
+            return new_client.connected_d.addCallback(
+                self._replace_client, index)
+
+        client.factory.deferred.addCallback(reconnect)
+
+    def _replace_client(self, client, index):
+        if index is None:
+            old_client, self._slow_client = self._slow_client, client
+        else:
+            old_client, self._clients[index] = self._clients[index], client
+        self._pending.pop(old_client, None)
+        self._pending[client] = 0
+        return client
+
+    def get_client(self, call=None):
+        """
+        Return the connection to send ``call`` over, or the next connection
+        for any normal commands if ``call`` is ``None``.
+        """
+        if self._slow_client is not None and call in self.SLOW_COMMANDS:
+            return self._slow_client
+        if self._dispatch == 'least-pending':
+            return min(self._clients, key=self._pending.get)
+        self._next_index = (self._next_index + 1) % len(self._clients)
+        return self._clients[self._next_index]
+
+    def _call_done(self, result, client):
+        if client in self._pending:
+            self._pending[client] -= 1
+        return result
+
+    def make_call(self, call, *args, **kw):
+        return self.call_client(self.get_client(call), call, *args, **kw)
+
+    def call_client(self, client, call, *args, **kw):
+        self._pending[client] += 1
+        d = maybeDeferred(getattr(client, call), *args, **kw)
+        return d.addBoth(self._call_done, client)
+
+    def _client_shutdown(self):
+        clients = list(self._clients)
+        if self._slow_client is not None:
+            clients.append(self._slow_client)
+        return gatherResults([c._client_shutdown() for c in clients])
+
+
 class TxRedisManager(Manager):
 
     call_decorator = staticmethod(inlineCallbacks)
@@ -181,36 +295,48 @@ class TxRedisManager(Manager):
             Dictionary of options for the manager.
         :param str key_prefix:
             Key prefix for namespacing.
+        :param int pool_size:
+            Number of connections to send commands over. The default of 1
+            keeps commands in the order they were sent. With more than one
+            connection, commands that aren't waited for may run out of order
+            (see :class:`VumiRedisPool`).
+        :param str pool_dispatch:
+            How commands are spread over the connections, either
+            ``round-robin`` (the default) or ``least-pending``.
+        :param bool slow_connection:
+            If true, ``keys``, ``scan`` and ``sunion`` are sent over an extra
+            connection of their own. These may not see writes still queued
+            on the other connections.
         """
 
         host = client_config.pop('host', '127.0.0.1')
         port = client_config.pop('port', 6379)
-
-        factory = VumiRedisClientFactory(**client_config)
-        reactor.connectTCP(host, port, factory)
-
-        d = factory.deferred.addCallback(lambda client: client.connected_d)
-        d.addCallback(cls._make_manager, manager_config)
+        pool_size = client_config.pop('pool_size', 1)
+        pool_dispatch = client_config.pop('pool_dispatch', 'round-robin')
+        slow_connection = client_config.pop('slow_connection', False)
+
+        def connect():
+            factory = VumiRedisClientFactory(**client_config)
+            reactor.connectTCP(host, port, factory)
+            return factory.deferred.addCallback(
+                lambda client: client.connected_d)
+
+        ds = [connect() for _ in range(pool_size)]
+        if slow_connection:
+            ds.append(connect())
+        d = gatherResults(ds, consumeErrors=True)
+        d.addCallback(cls._make_manager, pool_size, pool_dispatch,
+                      manager_config)
         return d
 
     @classmethod
-    def _make_manager(cls, client, manager_config):
-        manager = cls(client, **manager_config)
-        cls._attach_reconnector(manager)
-        return manager
-
-    @staticmethod
-    def _attach_reconnector(manager):
-        def set_client(client):
-            manager._client = client
-            return client
-
-        def reconnect(client):
-            client.factory.deferred.addCallback(reconnect)
-            return client.connected_d.addCallback(set_client)
-
-        manager._client.factory.deferred.addCallback(reconnect)
-        return manager
+    def _make_manager(cls, clients, pool_size, pool_dispatch,
+                      manager_config):
+        slow_client = None
+        if len(clients) > pool_size:
+            slow_client = clients.pop()
+        pool = VumiRedisPool(clients, slow_client, pool_dispatch)
+        return cls(pool, **manager_config)
 
     def _close(self):
         """
@@ -241,9 +367,53 @@ class TxRedisManager(Manager):
     def _make_redis_call(self, call, *args, **kw):
         """Make a redis API call using the underlying client library.
         """
-        return getattr(self._client, call)(*args, **kw)
+        if isinstance(self._client, FakeRedis):
+            return getattr(self._client, call)(*args, **kw)
+        return self._client.make_call(call, *args, **kw)
 
     def _filter_redis_results(self, func, results):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+    def _execute_pipeline(self, calls):
+        """Make a batch of redis API calls and return their results.
+
+        txredis writes each command as soon as it is called and matches
+        replies to commands in order, so sending all the commands before
+        waiting for any replies pipelines them on the connection. We use a
+        single connection from the pool so the commands are run in order.
+        """
+        if isinstance(self._client, FakeRedis):
+            make_call = self._make_redis_call
+        else:
+            make_call = partial(
+                self._client.call_client, self._client.get_client())
+        ds = []
+        for call, args, kw, func in calls:
+            d = maybeDeferred(make_call, call, *args, **kw)
+            if func is not None:
+                d.addCallback(func)
+            ds.append(d)
+        d = gatherResults(ds, consumeErrors=True)
+        d.addErrback(self._unwrap_first_error)
+        return d
+
+    def _unwrap_first_error(self, failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+
+
+class ShardedTxRedisManager(ShardedManager):
+    """A :class:`ShardedManager` over :class:`TxRedisManager` shards."""
+
+    call_decorator = staticmethod(inlineCallbacks)
+
+    SHARD_MANAGER_CLASS = TxRedisManager
+
+    @classmethod
+    def _manager_from_shards(cls, shards, names, replicas, manager_config):
+        d = gatherResults(shards, consumeErrors=True)
+        d.addCallback(lambda shards: cls(
+            HashRing(shards, names, replicas), **manager_config))
+        return d
@@ -2,12 +2,15 @@
 
 """A manager implementation on top of txriak."""
 
+from collections import deque
+
 from riakasaurus.riak import RiakClient, RiakObject, RiakMapReduce
 from riakasaurus import transport
 from twisted.internet.defer import (
-    inlineCallbacks, gatherResults, maybeDeferred, succeed)
+    inlineCallbacks, gatherResults, maybeDeferred, succeed, DeferredQueue,
+    DeferredList, DeferredSemaphore)
 
-from vumi.persist.model import Manager
+from vumi.persist.model import Manager, IndexPage
 
 
 class TxRiakManager(Manager):
@@ -23,6 +26,8 @@ class TxRiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_bunch_concurrency = config.pop('load_bunch_concurrency',
+                                            cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': transport.HTTPTransport,
@@ -41,7 +46,8 @@ class TxRiakManager(Manager):
             mapred_prefix=mapred_prefix, client_id=client_id,
             transport=transport_class)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency)
 
     def _encode_indexes(self, iterable, encoding='utf-8'):
         """
@@ -93,16 +99,29 @@ class TxRiakManager(Manager):
         return riak_object
 
     def store(self, modelobj):
+        self._uncache_object(modelobj)
         d = modelobj._riak_object.store()
-        d.addCallback(lambda result: modelobj)
+        d.addCallback(lambda result: self._cache_stored_object(modelobj))
         return d
 
+    def store_many(self, modelobjs, concurrency=None):
+        if concurrency is None:
+            concurrency = self.DEFAULT_STORE_CONCURRENCY
+        semaphore = DeferredSemaphore(concurrency)
+        return DeferredList([
+            semaphore.run(self.store, modelobj) for modelobj in modelobjs],
+            consumeErrors=True)
+
     def delete(self, modelobj):
+        self._uncache_object(modelobj)
         return modelobj._riak_object.delete()
 
     def load(self, modelcls, key, result=None):
         riak_object = self.riak_object(modelcls, key, result)
-        d = succeed(riak_object) if result else riak_object.reload()
+        if result:
+            d = succeed(riak_object)
+        else:
+            d = self._reload_riak_object(modelcls, key, riak_object)
 
         def build_model_object(riak_object, was_migrated):
             if riak_object.get_data() is None:
@@ -126,6 +145,34 @@ class TxRiakManager(Manager):
         d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
         return d
 
+    def load_all_bunches(self, model, keys, concurrency=None, ordered=True):
+        if concurrency is None:
+            concurrency = self.load_bunch_concurrency
+        if concurrency <= 1 or len(keys) <= self.load_bunch_size:
+            return super(TxRiakManager, self).load_all_bunches(model, keys)
+        bunches = [keys[i:i + self.load_bunch_size]
+                   for i in xrange(0, len(keys), self.load_bunch_size)]
+        return self._load_bunches_concurrently(
+            model, bunches, concurrency, ordered)
+
+    def _load_bunches_concurrently(self, model, bunches, concurrency,
+                                   ordered):
+        # We only start loading a bunch when one of the bunches already
+        # loading has been asked for, so there are never more than
+        # `concurrency` bunches loading or waiting to be used.
+        loading = deque()
+        finished = DeferredQueue()
+        started = 0
+        for index in xrange(len(bunches)):
+            while started < min(len(bunches), index + concurrency):
+                d = maybeDeferred(self._load_bunch, model, bunches[started])
+                if ordered:
+                    loading.append(d)
+                else:
+                    d.addBoth(finished.put)
+                started += 1
+            yield loading.popleft() if ordered else finished.get()
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
@@ -148,6 +195,29 @@ class TxRiakManager(Manager):
             mapreduce_done.addCallback(lambda r: reducer_func(self, r))
         return mapreduce_done
 
+    def _index_keys_page(self, bucket_name, index_name, start_value,
+                         end_value, max_results, continuation):
+        riak_transport = self.client.get_transport()
+        if not isinstance(riak_transport, transport.HTTPTransport):
+            # The protocol buffer client can't ask for a single page, so we
+            # return all the keys as one page rather than fetching them all
+            # again for each page.
+            d = self.client.bucket(bucket_name).get_index(
+                index_name, start_value, end_value)
+            return d.addCallback(IndexPage)
+
+        uri, params = self._index_page_request(
+            bucket_name, index_name, start_value, end_value, max_results,
+            continuation)
+
+        def parse_page(response):
+            riak_transport.check_http_code(response, [200])
+            data = riak_transport.decodeJson(response[1])
+            return IndexPage(data[u'keys'], data.get(u'continuation'))
+
+        d = riak_transport.get_request(uri, params)
+        return d.addCallback(parse_page)
+
     def should_quote_index_values(self):
         return not isinstance(self.client, transport.PBCTransport)
 
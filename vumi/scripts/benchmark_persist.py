@@ -49,13 +49,10 @@ class WriteReadBenchmark(object):
                     content="Batch: %d. Msg: %d" % (batch_no, i))
                 for i in range(num_msgs)]
 
-    def write_batch(self, model, msgs):
+    def write_messages(self, model, msgs):
         print "  Writing %d messages." % len(msgs)
-        deferreds = []
-        for msg in msgs:
-            msg_obj = model(key=msg['message_id'], msg=msg)
-            deferreds.append(msg_obj.save())
-        return DeferredList(deferreds)
+        msg_objs = [model(key=msg['message_id'], msg=msg) for msg in msgs]
+        return model.store_many(msg_objs, concurrency=self.concurrent)
 
     def read_batch(self, model, msgs):
         print "  Reading %d messages." % len(msgs)
@@ -74,8 +71,8 @@ class WriteReadBenchmark(object):
 
         start = time.time()
 
-        for batch in msg_batches:
-            yield self.write_batch(model, batch)
+        yield self.write_messages(
+            model, [msg for batch in msg_batches for msg in batch])
 
         write_done = time.time()
         write_time = write_done - start
@@ -1,19 +1,24 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
 import json
+from collections import deque
 from copy import deepcopy
 
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredSemaphore, DeferredLock,
+    maybeDeferred, succeed, gatherResults)
 from twisted.internet import protocol, reactor
+from twisted.internet.task import LoopingCall
 import txamqp
 from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
-from vumi.errors import VumiError
+from vumi.errors import (
+    VumiError, PublisherNackError, PublisherConfirmLostError)
 from vumi.message import Message
 from vumi.utils import load_class_by_string, vumi_resource_path, build_web_site
 
@@ -40,7 +45,7 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
-        self.delegate = TwistedDelegate()
+        self.delegate = VumiDelegate()
         self.worker = worker
         self.amqp_client = None
 
@@ -72,7 +77,60 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class VumiDelegate(TwistedDelegate):
+    """
+    AMQP delegate that hands publisher confirms to the publisher that owns the
+    channel they arrive on, and tells it when the channel or connection
+    closes so it can fail the messages that will never be confirmed.
+    """
+
+    def _handle_confirm(self, ch, msg, acked):
+        listener = getattr(ch, 'confirm_listener', None)
+        if listener is None:
+            log.msg("Ignoring publisher confirm for delivery tag %r on %r,"
+                    " which has no publisher waiting for confirms." % (
+                        msg.delivery_tag, ch))
+            return
+        listener.handle_confirm(msg.delivery_tag, msg.multiple, acked)
+
+    def _fail_unconfirmed(self, ch, reason):
+        listener = getattr(ch, 'confirm_listener', None)
+        if listener is not None:
+            listener.fail_unconfirmed(reason)
+
+    def basic_ack(self, ch, msg):
+        self._handle_confirm(ch, msg, True)
+
+    def basic_nack(self, ch, msg):
+        self._handle_confirm(ch, msg, False)
+
+    def channel_close(self, ch, msg):
+        TwistedDelegate.channel_close(self, ch, msg)
+        self._fail_unconfirmed(ch, msg)
+
+    def close(self, reason):
+        # This is called when the connection is closed or lost.
+        for ch in self.client.channels.values():
+            self._fail_unconfirmed(ch, reason)
+        TwistedDelegate.close(self, reason)
+
+
 class WorkerAMQClient(AMQClient):
+
+    # The default maximum number of channels shared by publishers. This can be
+    # overridden with the `publisher-channels` vumi option. If it is zero,
+    # every publisher gets its own channel. A channel error closes the channel
+    # for every publisher using it, so sharing is opt-in.
+    DEFAULT_PUBLISHER_CHANNELS = 0
+
+    def __init__(self, *args, **kwargs):
+        AMQClient.__init__(self, *args, **kwargs)
+        self._next_channel_id = 0
+        self._declared_exchanges = set()
+        self._publisher_channels = []
+        self._publisher_channel_index = 0
+        self._publisher_channel_lock = DeferredLock()
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -98,17 +156,59 @@ class WorkerAMQClient(AMQClient):
         """
         AMQClient keeps track of channels in a dictionary. The
         channel ids are the keys, get the highest number and up it
-        or just return zero for the first channel
+        or just return zero for the first channel. We also remember the
+        last id we handed out, because channels that are still being opened
+        may not be in the dictionary yet.
+        """
+        channel_id = (max(self.channels) + 1) if self.channels else 0
+        channel_id = max(channel_id, self._next_channel_id)
+        self._next_channel_id = channel_id + 1
+        return channel_id
+
+    def get_publisher_channel_count(self):
+        return self.vumi_options.get(
+            'publisher-channels', self.DEFAULT_PUBLISHER_CHANNELS)
+
+    @inlineCallbacks
+    def get_publisher_channel(self):
         """
-        return (max(self.channels) + 1) if self.channels else 0
+        Return one of the channels shared by publishers.
+
+        New channels are opened until we have as many as the
+        `publisher-channels` vumi option allows, after which the existing
+        channels are handed out in turn.
+        """
+        yield self._publisher_channel_lock.acquire()
+        try:
+            self._publisher_channels = [
+                ch for ch in self._publisher_channels
+                if not getattr(ch, 'closed', False)]
+            channels = self._publisher_channels
+            if len(channels) < self.get_publisher_channel_count():
+                channel = yield self.get_channel()
+                channels.append(channel)
+            else:
+                channel = channels[self._publisher_channel_index % len(
+                    channels)]
+                self._publisher_channel_index += 1
+        finally:
+            self._publisher_channel_lock.release()
+        returnValue(channel)
 
     def _declare_exchange(self, source, channel):
         # get the details for AMQP
         exchange_name = source.exchange_name
         exchange_type = source.exchange_type
         durable = source.durable
-        return channel.exchange_declare(exchange=exchange_name,
-                                        type=exchange_type, durable=durable)
+        # Declaring an exchange again doesn't change anything, so we only do
+        # it once per connection.
+        key = (exchange_name, exchange_type, durable)
+        if key in self._declared_exchanges:
+            return succeed(None)
+        d = maybeDeferred(channel.exchange_declare, exchange=exchange_name,
+                          type=exchange_type, durable=durable)
+        d.addCallback(lambda r: self._declared_exchanges.add(key))
+        return d
 
     @inlineCallbacks
     def start_consumer(self, consumer_class, *args, **kwargs):
@@ -138,13 +238,25 @@ class WorkerAMQClient(AMQClient):
     @inlineCallbacks
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
-        # get a channel
-        channel = yield self.get_channel()
-        # start the publisher
         publisher = publisher_class(*args, **kwargs)
         publisher.vumi_options = self.vumi_options
+        # get a channel. Publisher confirms are tracked per channel, so those
+        # publishers need a channel of their own.
+        if (getattr(publisher, 'publisher_confirms', False)
+                or self.get_publisher_channel_count() <= 0):
+            channel = yield self.get_channel()
+        else:
+            channel = yield self.get_publisher_channel()
         # declare the exchange, doesn't matter if it already exists
         yield self._declare_exchange(publisher, channel)
+        if getattr(publisher, 'publisher_confirms', False):
+            if not hasattr(channel, 'confirm_select'):
+                raise VumiError(
+                    "Publisher confirms require an AMQP spec that includes"
+                    " the RabbitMQ confirm extension, such as"
+                    " amqp-spec-0-9-1.xml.")
+            channel.confirm_listener = publisher
+            yield channel.confirm_select()
         # start!
         yield publisher.start(channel)
         # return the publisher
@@ -195,7 +307,11 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False, prefetch_count=None):
+                message_class=None, paused=False, prefetch_count=None,
+                concurrency=None, ack_batch_size=None, ack_batch_time=None,
+                prefetch_min=None, prefetch_max=None,
+                prefetch_target_latency=None, prefetch_metric=None,
+                consume_slots=None):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -209,7 +325,19 @@ class Worker(MultiService, object):
             'durable': durable,
             'start_paused': paused,
             'prefetch_count': prefetch_count,
+            'concurrency': concurrency,
+            'ack_batch_size': ack_batch_size,
         }
+        if ack_batch_time is not None:
+            kwargs['ack_batch_time'] = ack_batch_time
+        if prefetch_max is not None:
+            kwargs['prefetch_min'] = prefetch_min
+            kwargs['prefetch_max'] = prefetch_max
+            if prefetch_target_latency is not None:
+                kwargs['prefetch_target_latency'] = prefetch_target_latency
+            kwargs['prefetch_metric'] = prefetch_metric
+        if consume_slots is not None:
+            kwargs['consume_slots'] = consume_slots
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
         if message_class is not None:
@@ -221,7 +349,8 @@ class Worker(MultiService, object):
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
-                   delivery_mode=2):
+                   delivery_mode=2, publisher_confirms=False,
+                   content_type=None):
         class_name = self.routing_key_to_class_name(routing_key)
         publisher_class = type("%sDynamicPublisher" % class_name, (Publisher,),
             {
@@ -230,6 +359,8 @@ class Worker(MultiService, object):
                 "exchange_type": exchange_type,
                 "durable": durable,
                 "delivery_mode": delivery_mode,
+                "publisher_confirms": publisher_confirms,
+                "content_type": content_type,
             })
         return self.start_publisher(publisher_class)
 
@@ -242,10 +373,76 @@ class Worker(MultiService, object):
         return reactor.listenTCP(port, site_factory)
 
 
+def get_content_type(content):
+    """
+    Return the content type of some AMQP content, or `None` if it has none.
+    """
+    properties = getattr(content, 'properties', None)
+    if not properties:
+        return None
+    return properties.get('content type')
+
+
 class QueueCloseMarker(object):
     "This is a marker for closing consumer queues."
 
 
+class WeightedConsumeSlots(object):
+    """
+    Message processing slots shared by several consumers.
+
+    Each consumer gets its own lane from :meth:`lane`. When a slot is
+    released and consumers in more than one lane are waiting, smooth weighted
+    round-robin picks the lane that gets it. Busy lanes share the slots in
+    proportion to their weights and a lane gets all of them if it is the only
+    one waiting.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self._lanes = []
+
+    def lane(self, weight=1):
+        lane = _WeightedConsumeSlotsLane(self, weight)
+        self._lanes.append(lane)
+        return lane
+
+    def _acquire(self, lane):
+        d = Deferred()
+        if self.tokens > 0:
+            self.tokens -= 1
+            d.callback(self)
+        else:
+            lane.waiting.append(d)
+        return d
+
+    def release(self):
+        self.tokens += 1
+        waiting = [lane for lane in self._lanes if lane.waiting]
+        if not waiting:
+            return
+        for lane in waiting:
+            lane.current_weight += lane.weight
+        chosen = max(waiting, key=lambda lane: lane.current_weight)
+        chosen.current_weight -= sum(lane.weight for lane in waiting)
+        self.tokens -= 1
+        chosen.waiting.popleft().callback(self)
+
+
+class _WeightedConsumeSlotsLane(object):
+    def __init__(self, slots, weight):
+        self.slots = slots
+        self.weight = weight
+        self.current_weight = 0
+        self.waiting = deque()
+
+    def acquire(self):
+        return self.slots._acquire(self)
+
+    def release(self):
+        self.slots.release()
+
+
 class Consumer(object):
 
     exchange_name = "vumi"
@@ -258,6 +455,36 @@ class Consumer(object):
     message_class = Message
     start_paused = False
     prefetch_count = None
+    # The maximum number of messages processed at the same time. `None` means
+    # one message at a time.
+    concurrency = None
+    # If set, acks are collected and sent when this many are waiting, when
+    # `ack_batch_time` seconds have passed since the first one was collected
+    # or when the consumer is paused. Contiguous acks are sent as a single
+    # `multiple` ack. `None` means each message is acked immediately. When
+    # batching, messages that `consume_message` doesn't ack (by returning
+    # `False`) are rejected and requeued instead of being left unacked,
+    # because a later `multiple` ack would ack them.
+    ack_batch_size = None
+    ack_batch_time = 0.1
+    # If `prefetch_max` is set, the prefetch window starts at
+    # `prefetch_count` and is adjusted every `prefetch_adjust_interval`
+    # seconds, staying between `prefetch_min` (default `concurrency`) and
+    # `prefetch_max`. It shrinks when prefetched messages are expected to
+    # wait longer than `prefetch_target_latency` seconds for a handler and
+    # grows when the whole window is in use. The window is set on
+    # `prefetch_metric` after every adjustment if it has been registered
+    # with a MetricManager.
+    prefetch_min = None
+    prefetch_max = None
+    prefetch_target_latency = 1.0
+    prefetch_adjust_interval = 1.0
+    prefetch_metric = None
+    # If set, this is used instead of a private DeferredSemaphore with
+    # `concurrency` slots. This lets several consumers share slots, usually
+    # through a `WeightedConsumeSlots` lane.
+    consume_slots = None
+    clock = reactor
 
     def __init__(self, channel):
         self.channel = channel
@@ -273,12 +500,97 @@ class Consumer(object):
         self.keep_consuming = True
         self.paused = self.start_paused
         self._unpause_d = None
-        if self.prefetch_count is not None:
+        self._consume_slots = self.consume_slots
+        if self._consume_slots is None:
+            self._consume_slots = DeferredSemaphore(self.concurrency or 1)
+        # Delivery tags in delivery order and their ack state: `None` while
+        # the message is being processed, `True` if it should be acked and
+        # `False` if it should never be acked.
+        self._pending_acks = []
+        self._ack_states = {}
+        self._ready_acks = 0
+        self._ack_flush_call = None
+        self.prefetch_window = None
+        self._prefetch_task = None
+        self._handler_latency = None
+        self._peak_in_flight = 0
+        self._holding_message = False
+        if self.prefetch_max is not None:
+            yield self._start_adaptive_prefetch()
+        elif self.prefetch_count is not None:
             yield self.channel.basic_qos(0, self.prefetch_count, False)
         if not self.paused:
             yield self.unpause()
         returnValue(self)
 
+    def _get_prefetch_min(self):
+        return min(self.prefetch_min or self.concurrency or 1,
+                   self.prefetch_max)
+
+    @inlineCallbacks
+    def _start_adaptive_prefetch(self):
+        window = self.prefetch_count or self.prefetch_max
+        window = max(self._get_prefetch_min(), min(window, self.prefetch_max))
+        # RabbitMQ only applies a new per-consumer prefetch count to consumers
+        # started after it's set, so we use the per-consumer count as an upper
+        # bound and adjust the channel prefetch count instead. Each consumer
+        # has its own channel, so this only affects us.
+        yield self.channel.basic_qos(0, self.prefetch_max, False)
+        yield self.set_prefetch_window(window)
+        self._prefetch_task = LoopingCall(self.adjust_prefetch)
+        self._prefetch_task.clock = self.clock
+        d = self._prefetch_task.start(self.prefetch_adjust_interval, now=False)
+        d.addErrback(log.err)
+
+    def set_prefetch_window(self, window):
+        self.prefetch_window = window
+        return maybeDeferred(self.channel.basic_qos, 0, window, True)
+
+    def _get_backlog(self):
+        """
+        Return the number of prefetched messages waiting for a handler.
+        """
+        return len(getattr(self.queue, 'pending', ()))
+
+    def _get_in_flight(self):
+        """
+        Return the number of delivered messages that haven't been acked yet.
+
+        Messages that were not acked because the handler returned `False`
+        aren't counted.
+        """
+        return (self._get_backlog() + int(self._holding_message)
+                + self._in_progress + self._ready_acks)
+
+    def _record_latency(self, latency):
+        if self._handler_latency is None:
+            self._handler_latency = latency
+        else:
+            self._handler_latency += 0.2 * (latency - self._handler_latency)
+
+    def adjust_prefetch(self):
+        """
+        Adjust the prefetch window based on what happened since the last
+        adjustment.
+        """
+        concurrency = self.concurrency or 1
+        window = self.prefetch_window
+        peak_in_flight = max(self._peak_in_flight, self._get_in_flight())
+        expected_wait = (
+            (self._handler_latency or 0) * self._get_backlog() / concurrency)
+        if expected_wait > self.prefetch_target_latency:
+            window = max(
+                self._get_prefetch_min(), window - max(1, window // 4))
+        elif peak_in_flight >= window:
+            window = min(self.prefetch_max, window + concurrency)
+        self._peak_in_flight = 0
+        metric = self.prefetch_metric
+        if metric is not None and metric.managed:
+            metric.set(window)
+        if window != self.prefetch_window:
+            return self.set_prefetch_window(window)
+        return succeed(None)
+
     @inlineCallbacks
     def _read_messages(self):
         try:
@@ -286,12 +598,25 @@ class Consumer(object):
                 message = yield self.queue.get()
                 if isinstance(message, QueueCloseMarker):
                     break
+                self._holding_message = True
+                if self._prefetch_task is not None:
+                    self._peak_in_flight = max(
+                        self._peak_in_flight, self._get_in_flight())
+                # Wait for a free slot before checking for pause, because a
+                # message that is still in progress may pause us.
+                yield self._consume_slots.acquire()
                 if self.paused:
                     yield self._unpause_d
-                yield self.consume(message)
+                self._holding_message = False
+                d = self.consume(message)
+                d.addErrback(log.err)
+                d.addBoth(self._release_consume_slot)
         except txamqp.queue.Closed as e:
             log.err("Queue has closed", e)
 
+    def _release_consume_slot(self, _result):
+        self._consume_slots.release()
+
     @inlineCallbacks
     def _channel_consume(self):
         if self._consumer_tag is not None:
@@ -325,24 +650,120 @@ class Consumer(object):
 
     def _check_notify(self):
         if self.paused and not self._in_progress:
+            self.flush_acks()
             while self._notify_paused_and_quiet:
                 self._notify_paused_and_quiet.pop(0).callback(None)
 
     @inlineCallbacks
     def consume(self, message):
         self._in_progress += 1
-        result = yield self.consume_message(self.message_class.from_json(
-                                            message.content.body))
-        self._in_progress -= 1
+        if self.ack_batch_size:
+            self._pending_acks.append(message.delivery_tag)
+            self._ack_states[message.delivery_tag] = None
+        start_time = self.clock.seconds()
+        failed = True
+        try:
+            result = yield self.consume_message(self.message_class.from_wire(
+                message.content.body, get_content_type(message.content)))
+            failed = False
+        finally:
+            self._in_progress -= 1
+            if failed:
+                # The error is logged by our caller. We still need to let
+                # anything waiting for us to be quiet know we're done with
+                # this message, and a batched message must be rejected so
+                # that the acks after it can be sent.
+                if self._testing:
+                    self.channel.message_processed()
+                if self.ack_batch_size:
+                    self._ack_states[message.delivery_tag] = False
+                    self._schedule_ack_flush()
+                self._check_notify()
+        if self._prefetch_task is not None:
+            self._record_latency(self.clock.seconds() - start_time)
         if self._testing:
             self.channel.message_processed()
         if result is not False:
-            yield self.channel.basic_ack(message.delivery_tag, False)
+            yield self.ack(message.delivery_tag)
         else:
             log.msg('Received %s as a return value consume_message. '
                     'Not acknowledging AMQ message' % result)
+            if self.ack_batch_size:
+                # This message will be rejected when the acks before it are
+                # flushed, so make sure that happens.
+                self._ack_states[message.delivery_tag] = False
+                self._schedule_ack_flush()
         self._check_notify()
 
+    def ack(self, delivery_tag):
+        """
+        Acknowledge a message, either immediately or as part of a batch.
+        """
+        if not self.ack_batch_size:
+            return self.channel.basic_ack(delivery_tag, False)
+        self._ack_states[delivery_tag] = True
+        self._ready_acks += 1
+        if self._ready_acks >= self.ack_batch_size:
+            return self.flush_acks()
+        self._schedule_ack_flush()
+
+    def _schedule_ack_flush(self):
+        if self._ack_flush_call is None and self.ack_batch_time is not None:
+            self._ack_flush_call = self.clock.callLater(
+                self.ack_batch_time, self.flush_acks)
+
+    def flush_acks(self):
+        """
+        Send all acks that can be sent.
+
+        Acks for the completed messages at the front of the delivery order are
+        sent as a single `multiple` ack. A `multiple` ack would also ack any
+        earlier message that must not be acked, so a message that must not be
+        acked is rejected (and requeued) once every message before it has been
+        dealt with, and batching carries on after it. Completed messages that
+        follow a message still being processed wait for a later flush.
+        """
+        if self._ack_flush_call is not None:
+            if self._ack_flush_call.active():
+                self._ack_flush_call.cancel()
+            self._ack_flush_call = None
+
+        # Each entry is a list of tags to ack with a single `multiple` ack,
+        # optionally followed by a tag to reject.
+        batches = []
+        acked = []
+        done = 0
+        for tag in self._pending_acks:
+            state = self._ack_states[tag]
+            if state is None:
+                break
+            done += 1
+            del self._ack_states[tag]
+            if state is False:
+                batches.append((acked, tag))
+                acked = []
+            else:
+                acked.append(tag)
+        if acked:
+            batches.append((acked, None))
+
+        self._pending_acks = self._pending_acks[done:]
+        self._ready_acks -= sum(len(tags) for tags, _reject in batches)
+        if self._ready_acks:
+            self._schedule_ack_flush()
+
+        ds = []
+        for tags, reject_tag in batches:
+            if tags:
+                ds.append(maybeDeferred(
+                    self.channel.basic_ack, tags[-1], len(tags) > 1))
+            if reject_tag is not None:
+                ds.append(maybeDeferred(
+                    self.channel.basic_reject, reject_tag, True))
+        if not ds:
+            return succeed(None)
+        return gatherResults(ds)
+
     def consume_message(self, message):
         """helper method, override in implementation"""
         log.msg("Received message: %s" % message)
@@ -351,6 +772,10 @@ class Consumer(object):
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
+        if self._prefetch_task is not None:
+            if self._prefetch_task.running:
+                self._prefetch_task.stop()
+            self._prefetch_task = None
         yield self.pause()
         # This actually closes the channel on the server
         yield self.channel.channel_close()
@@ -383,11 +808,21 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    # Ask the broker to confirm each message. The deferred returned from
+    # `publish()` fires when the broker acks the message and fails with
+    # `PublisherNackError` if the broker nacks it or with
+    # `PublisherConfirmLostError` if the channel closes first.
+    publisher_confirms = False
+    # The AMQP content type used for published messages. `None` means JSON
+    # without a content type property, which all consumers understand.
+    content_type = None
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
         self.bound_routing_keys = {}
+        self._unconfirmed = {}
+        self._next_delivery_tag = 1
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
@@ -398,17 +833,71 @@ class Publisher(object):
             raise RoutingKeyError("The routing_key: %s is not all lower case!"
                                   % (routing_key))
 
-    @inlineCallbacks
     def publish(self, message, **kwargs):
         exchange_name = kwargs.get('exchange_name') or self.exchange_name
         routing_key = kwargs.get('routing_key') or self.routing_key
         self.check_routing_key(routing_key)
-        yield self.channel.basic_publish(exchange=exchange_name,
-                                         content=message,
-                                         routing_key=routing_key)
+        if not self.publisher_confirms:
+            return maybeDeferred(
+                self.channel.basic_publish, exchange=exchange_name,
+                content=message, routing_key=routing_key)
+
+        # The broker may confirm the message before basic_publish() returns,
+        # so we need to be waiting for the confirm before we publish.
+        delivery_tag = self._next_delivery_tag
+        self._next_delivery_tag += 1
+        confirm_d = Deferred()
+        self._unconfirmed[delivery_tag] = confirm_d
+
+        def publish_failed(f):
+            self._unconfirmed.pop(delivery_tag, None)
+            return f
+
+        d = maybeDeferred(
+            self.channel.basic_publish, exchange=exchange_name,
+            content=message, routing_key=routing_key)
+        d.addCallbacks(lambda _: confirm_d, publish_failed)
+        return d
+
+    def handle_confirm(self, delivery_tag, multiple, acked):
+        """
+        Handle a publisher confirm (ack or nack) from the broker.
+        """
+        if multiple:
+            delivery_tags = sorted(
+                tag for tag in self._unconfirmed if tag <= delivery_tag)
+        else:
+            delivery_tags = [delivery_tag]
+        for tag in delivery_tags:
+            d = self._unconfirmed.pop(tag, None)
+            if d is None:
+                continue
+            if acked:
+                d.callback(None)
+            else:
+                d.errback(PublisherNackError(
+                    "Message with delivery tag %r nacked by broker." % (tag,)))
+
+    def fail_unconfirmed(self, reason):
+        """
+        Fail every message still waiting for a publisher confirm.
+
+        This is called when the channel or connection closes, because the
+        confirms for those messages will never arrive.
+        """
+        unconfirmed, self._unconfirmed = self._unconfirmed, {}
+        for tag in sorted(unconfirmed):
+            unconfirmed[tag].errback(PublisherConfirmLostError(
+                "Channel closed before message with delivery tag %r was"
+                " confirmed: %s" % (tag, reason)))
 
     def publish_message(self, message, **kwargs):
-        d = self.publish_raw(message.to_json(), **kwargs)
+        if self.content_type is None:
+            data = message.to_json()
+        else:
+            data = message.to_wire(self.content_type)
+            kwargs.setdefault('content_type', self.content_type)
+        d = self.publish_raw(data, **kwargs)
         d.addCallback(lambda r: message)
         return d
 
@@ -420,6 +909,9 @@ class Publisher(object):
         amq_message = Content(data)
         amq_message['delivery mode'] = kwargs.pop('delivery_mode',
                 self.delivery_mode)
+        content_type = kwargs.pop('content_type', None)
+        if content_type is not None:
+            amq_message['content type'] = content_type
         return self.publish(amq_message, **kwargs)
 
 
@@ -52,6 +52,9 @@ class VumiOptions(usage.Options):
         ["vhost", None, None, "AMQP virtual host (*)"],
         ["specfile", None, None, "AMQP spec file (*)"],
         ["sentry", None, None, "Sentry DSN (*)"],
+        ["publisher-channels", None, None,
+         "Maximum number of AMQP channels shared by publishers. Defaults to"
+         " 0, which gives each publisher its own channel (*)", int],
         ["vumi-config", None, None,
          "YAML config file for setting core vumi options (any command-line"
          " parameter marked with an asterisk)"],
@@ -5,10 +5,9 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
+from vumi.service import WorkerAMQClient, VumiDelegate, get_content_type
 from vumi.message import Message as VumiMessage
 
 
@@ -67,14 +66,21 @@ def mkContent(body, children=None, properties=None):
                  properties=properties)
 
 
-def mk_deliver(body, exchange, routing_key, ctag, dtag):
+def mk_deliver(body, exchange, routing_key, ctag, dtag, properties=None):
     return Message(mkMethod('deliver', 60), [
             ('consumer_tag', ctag),
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
+
+
+def mk_confirm(dtag, multiple=False):
+    return Message(mkMethod('ack', 80), [
+            ('delivery_tag', dtag),
+            ('multiple', multiple),
+            ])
 
 
 def mk_get_ok(body, exchange, routing_key, dtag):
@@ -166,6 +172,10 @@ class FakeAMQPBroker(object):
         self._get_queue(queue).ack(delivery_tag)
         return None
 
+    def basic_reject(self, queue, delivery_tag, requeue):
+        self._get_queue(queue).reject(delivery_tag, requeue)
+        return None
+
     def deliver_to_channels(self):
         # Since all delivery goes through kick_delivery(), this can
         # only happen if message_processed() is called too many times.
@@ -185,7 +195,8 @@ class FakeAMQPBroker(object):
                 if dtag is None:
                     break
                 dmsg = mk_deliver(msg['content'], msg['exchange'],
-                                  msg['routing_key'], ctag, dtag)
+                                  msg['routing_key'], ctag, dtag,
+                                  msg.get('properties'))
                 self._delivering['count'] += 1
                 channel.deliver_message(dmsg, ctag)
                 delivered = True
@@ -259,7 +270,8 @@ class FakeAMQPBroker(object):
 
     def get_messages(self, exchange, rkey):
         contents = self.get_dispatched(exchange, rkey)
-        messages = [VumiMessage.from_json(content.body)
+        messages = [VumiMessage.from_wire(
+                    content.body, get_content_type(content))
                     for content in contents]
         return messages
 
@@ -286,10 +298,12 @@ class FakeAMQPChannel(object):
         self.client = client
         self.broker = client.broker
         self.qos_prefetch_count = 0
+        self.global_prefetch_count = 0
         self.consumers = {}
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        self._publish_count = None
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
@@ -307,10 +321,20 @@ class FakeAMQPChannel(object):
     def close(self, _reason):
         pass
 
+    def channel_close_ok(self):
+        pass
+
+    def doClose(self, _reason):
+        self.closed = True
+
     def basic_qos(self, _prefetch_size, prefetch_count, is_global):
+        # Like RabbitMQ, we treat a global prefetch limit as shared by all
+        # consumers on this channel.
         if is_global:
-            raise NotImplementedError("global prefetch limits not supported.")
-        self.qos_prefetch_count = prefetch_count
+            self.global_prefetch_count = prefetch_count
+            self.broker.kick_delivery()
+        else:
+            self.qos_prefetch_count = prefetch_count
 
     def exchange_declare(self, exchange, type, durable=None):
         return self.broker.exchange_declare(exchange, type)
@@ -337,7 +361,15 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
-        return self.broker.basic_publish(exchange, routing_key, content)
+        resp = self.broker.basic_publish(exchange, routing_key, content)
+        if self._publish_count is not None:
+            self._publish_count += 1
+            self.delegate.basic_ack(self, mk_confirm(self._publish_count))
+        return resp
+
+    def confirm_select(self):
+        self._publish_count = 0
+        return Message(mkMethod("select-ok", 11))
 
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
@@ -350,16 +382,24 @@ class FakeAMQPChannel(object):
                 if (dtag == delivery_tag):
                     return resp
 
+    def basic_reject(self, delivery_tag, requeue):
+        for dtag, ctag, queue in self.unacked[:]:
+            if dtag == delivery_tag:
+                self.unacked.remove((dtag, ctag, queue))
+                return self.broker.basic_reject(queue, dtag, requeue)
+        raise AssertionError("Unknown delivery tag: %s" % (delivery_tag,))
+
     def _get_consumer_prefetch(self, consumer_tag):
         return self._consumer_prefetch[consumer_tag]
 
     def deliverable(self, consumer_tag):
         if consumer_tag not in self.consumers:
             return False
-        prefetch = self._get_consumer_prefetch(consumer_tag)
-        if prefetch < 1:
-            return True
-        return len(self.unacked) < prefetch
+        for prefetch in [self._get_consumer_prefetch(consumer_tag),
+                         self.global_prefetch_count]:
+            if prefetch >= 1 and len(self.unacked) >= prefetch:
+                return False
+        return True
 
     def deliver_message(self, msg, consumer_tag):
         self.unacked.append(
@@ -457,11 +497,17 @@ class FakeAMQPQueue(object):
                 'exchange': exchange,
                 'routing_key': routing_key,
                 'content': content.body,
+                'properties': getattr(content, 'properties', None),
                 })
 
     def ack(self, delivery_tag):
         self.unacked_messages.pop(delivery_tag)
 
+    def reject(self, delivery_tag, requeue):
+        msg = self.unacked_messages.pop(delivery_tag)
+        if requeue:
+            self.messages.insert(0, msg)
+
     def get_message(self):
         try:
             msg = self.messages.pop(0)
@@ -474,7 +520,7 @@ class FakeAMQPQueue(object):
 
 class FakeAMQClient(WorkerAMQClient):
     def __init__(self, spec, vumi_options=None, broker=None):
-        WorkerAMQClient.__init__(self, TwistedDelegate(), '', spec)
+        WorkerAMQClient.__init__(self, VumiDelegate(), '', spec)
         if vumi_options is not None:
             self.vumi_options = vumi_options
         if broker is None:
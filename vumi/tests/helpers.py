@@ -13,7 +13,7 @@ from twisted.trial.unittest import TestCase, SkipTest, FailTest
 from zope.interface import Interface, implements
 
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.service import get_spec
+from vumi.service import get_spec, get_content_type
 from vumi.utils import vumi_resource_path, flatten_generator
 from vumi.tests.fake_amqp import FakeAMQPBroker, FakeAMQClient
 
@@ -724,7 +724,8 @@ class WorkerHelper(object):
         """
         msgs = self.broker.get_dispatched(
             'vumi', self._rkey(connector_name, name))
-        return [message_class.from_json(msg.body) for msg in msgs]
+        return [message_class.from_wire(msg.body, get_content_type(msg))
+                for msg in msgs]
 
     def _wait_for_dispatched(self, connector_name, name, amount):
         rkey = self._rkey(connector_name, name)
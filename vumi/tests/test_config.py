@@ -1,4 +1,5 @@
 from twisted.internet.endpoints import TCP4ServerEndpoint, TCP4ClientEndpoint
+from twisted.internet.task import Clock
 
 from confmodel import Config
 from confmodel.errors import ConfigError
@@ -7,7 +8,7 @@ from zope.interface import Interface, implements
 
 from vumi.config import (
     ConfigClassName, ConfigServerEndpoint, ConfigClientEndpoint,
-    ServerEndpointFallback, ClientEndpointFallback)
+    ServerEndpointFallback, ClientEndpointFallback, ConfigCache)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -184,3 +185,66 @@ class ConfigFieldTest(VumiTestCase):
         self.assertRaises(ConfigError, MyConfig, {'myport': 'foo'})
         self.assertRaises(ConfigError, MyConfig, {'myhost': 'example.com'})
         self.assertRaises(ConfigError, MyConfig, {'myport': 80})
+
+
+class ConfigCacheTest(VumiTestCase):
+
+    def test_get_and_set(self):
+        cache = ConfigCache()
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 'config a')
+        self.assertEqual(cache.get('a'), 'config a')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        cache.set('a', 'new config a')
+        self.assertEqual(cache.get('a'), 'new config a')
+        self.assertEqual(len(cache), 1)
+
+    def test_lru_eviction(self):
+        cache = ConfigCache(max_size=2)
+        cache.set('a', 'config a')
+        cache.set('b', 'config b')
+        cache.get('a')
+        cache.set('c', 'config c')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'config a')
+        self.assertEqual(cache.get('c'), 'config c')
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = ConfigCache(ttl=10, clock=clock)
+        cache.set('a', 'config a')
+        clock.advance(9)
+        self.assertEqual(cache.get('a'), 'config a')
+        clock.advance(1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = ConfigCache()
+        cache.set('a', 'config a')
+        cache.set('b', 'config b')
+        cache.invalidate('a')
+        cache.invalidate('missing')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'config b')
+
+    def test_invalidate_none_key(self):
+        cache = ConfigCache()
+        cache.set(None, 'config none')
+        cache.set('a', 'config a')
+        cache.invalidate(None)
+        self.assertEqual(cache.get(None), None)
+        self.assertEqual(cache.get('a'), 'config a')
+        self.assertEqual(len(cache), 1)
+
+    def test_clear(self):
+        cache = ConfigCache()
+        cache.set('a', 'config a')
+        cache.set('b', 'config b')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('b'), None)
+        cache.set('c', 'config c')
+        self.assertEqual(cache.get('c'), 'config c')
@@ -5,7 +5,7 @@ from vumi.connectors import (
     IgnoreMessage)
 from vumi.tests.utils import LogCatcher
 from vumi.worker import BaseWorker
-from vumi.message import TransportUserMessage
+from vumi.message import TransportUserMessage, LazyTransportUserMessage
 from vumi.middleware.tests.utils import RecordingMiddleware
 from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
 
@@ -141,6 +141,23 @@ class TestBaseConnector(BaseConnectorTestCase):
         publisher = yield conn._setup_publisher('outbound')
         self.assertEqual(publisher.routing_key, 'foo.outbound')
 
+    @inlineCallbacks
+    def test_setup_publisher_options(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(
+            worker, 'foo', publisher_confirms=True)
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertEqual(publisher.publisher_confirms, True)
+        self.assertEqual(publisher.content_type, None)
+
+    @inlineCallbacks
+    def test_setup_publisher_content_type(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(
+            worker, 'foo', content_type='application/x-msgpack')
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertEqual(publisher.content_type, 'application/x-msgpack')
+
     @inlineCallbacks
     def test_setup_consumer(self):
         conn, consumer = yield self.mk_consumer(connector_name='foo')
@@ -148,6 +165,120 @@ class TestBaseConnector(BaseConnectorTestCase):
         self.assertEqual(consumer.routing_key, 'foo.inbound')
         self.assertEqual(consumer.message_class, TransportUserMessage)
 
+    @inlineCallbacks
+    def test_setup_consumer_concurrency(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(worker, 'foo', concurrency=5)
+        consumer = yield conn._setup_consumer(
+            'inbound', TransportUserMessage, lambda msg: None)
+        self.assertEqual(consumer.concurrency, 5)
+
+    @inlineCallbacks
+    def test_setup_consumer_lazy_messages(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(worker, 'foo', lazy_messages=True)
+        consumer = yield conn._setup_consumer(
+            'inbound', TransportUserMessage, lambda msg: None)
+        self.assertEqual(consumer.message_class, LazyTransportUserMessage)
+
+    @inlineCallbacks
+    def test_setup_consumer_ack_batching(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(
+            worker, 'foo', ack_batch_size=10, ack_batch_time=0.5)
+        consumer = yield conn._setup_consumer(
+            'inbound', TransportUserMessage, lambda msg: None)
+        self.assertEqual(consumer.ack_batch_size, 10)
+        self.assertEqual(consumer.ack_batch_time, 0.5)
+
+    @inlineCallbacks
+    def test_setup_consumer_adaptive_prefetch(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(
+            worker, 'foo', prefetch_count=10, prefetch_min=2,
+            prefetch_max=30, prefetch_target_latency=0.5)
+        consumer = yield conn._setup_consumer(
+            'inbound', TransportUserMessage, lambda msg: None)
+        self.assertEqual(consumer.prefetch_min, 2)
+        self.assertEqual(consumer.prefetch_max, 30)
+        self.assertEqual(consumer.prefetch_target_latency, 0.5)
+        self.assertEqual(consumer.prefetch_window, 10)
+        metric = conn.prefetch_metrics['inbound']
+        self.assertEqual(metric.name, 'foo.inbound.prefetch_window')
+        self.assertTrue(consumer.prefetch_metric is metric)
+        consumer._prefetch_task.stop()
+
+    @inlineCallbacks
+    def test_setup_consumer_priority_lanes(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(
+            worker, 'foo', concurrency=4, priority_lanes={'fast': 3})
+        consumer = yield conn._setup_consumer(
+            'inbound', TransportUserMessage, lambda msg: None)
+        self.assertEqual(sorted(conn._consumers), ['inbound', 'inbound.fast'])
+        self.assertEqual(consumer.routing_key, 'foo.inbound')
+        lane_consumer = conn._consumers['inbound.fast']
+        self.assertEqual(lane_consumer.routing_key, 'foo.inbound.fast')
+        self.assertEqual(consumer.consume_slots.weight, 1)
+        self.assertEqual(lane_consumer.consume_slots.weight, 3)
+        self.assertTrue(
+            consumer.consume_slots.slots is lane_consumer.consume_slots.slots)
+        self.assertEqual(consumer.consume_slots.slots.tokens, 4)
+
+    @inlineCallbacks
+    def test_consume_priority_lanes(self):
+        msgs = []
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(
+            worker, 'foo', priority_lanes={'fast': 3})
+        yield conn._setup_consumer(
+            'inbound', TransportUserMessage, msgs.append)
+        conn.unpause()
+        msg1 = self.msg_helper.make_inbound("slow")
+        msg2 = self.msg_helper.make_inbound("fast")
+        yield self.worker_helper.dispatch_inbound(msg1, 'foo')
+        yield self.worker_helper.dispatch_raw('foo.inbound.fast', msg2)
+        self.assertEqual(msgs, [msg1, msg2])
+
+    @inlineCallbacks
+    def test_publish_message_priority_lanes(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {})
+        conn = self.connector_class(
+            worker, 'foo', priority_lanes={'fast': 3, 'session': 2},
+            session_priority_lane='session')
+        yield conn._setup_publisher('outbound')
+        self.assertEqual(sorted(conn._publishers), [
+            'outbound', 'outbound.fast', 'outbound.session'])
+
+        msg = self.msg_helper.make_outbound("bulk")
+        fast_msg = self.msg_helper.make_outbound(
+            "fast", helper_metadata={'priority_lane': 'fast'})
+        session_msg = self.msg_helper.make_outbound(
+            "session", session_event=TransportUserMessage.SESSION_RESUME)
+        unknown_msg = self.msg_helper.make_outbound(
+            "unknown", helper_metadata={'priority_lane': 'unknown'})
+        for m in [msg, fast_msg, session_msg, unknown_msg]:
+            yield conn._publish_message('outbound', m, None)
+
+        def get_dispatched(lane):
+            return self.worker_helper.get_dispatched(
+                'foo', lane, TransportUserMessage)
+
+        self.assertEqual(get_dispatched('outbound'), [msg, unknown_msg])
+        self.assertEqual(get_dispatched('outbound.fast'), [fast_msg])
+        self.assertEqual(get_dispatched('outbound.session'), [session_msg])
+
+    def test_get_priority_lane(self):
+        conn = self.connector_class(
+            None, 'foo', priority_lanes={'fast': 3})
+        self.assertEqual(conn.get_priority_lane(
+            self.msg_helper.make_outbound("bulk")), None)
+        self.assertEqual(conn.get_priority_lane(self.msg_helper.make_outbound(
+            "fast", helper_metadata={'priority_lane': 'fast'})), 'fast')
+        # There's no session lane configured.
+        self.assertEqual(conn.get_priority_lane(self.msg_helper.make_outbound(
+            "session", session_event=TransportUserMessage.SESSION_NEW)), None)
+
     @inlineCallbacks
     def test_set_endpoint_handler(self):
         conn, consumer = yield self.mk_consumer(connector_name='foo')
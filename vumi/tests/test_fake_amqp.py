@@ -200,12 +200,25 @@ class TestFakeAMQP(VumiTestCase):
         self.chan1.basic_cancel('tag2')
         self.assertEqual(set(['tag1']), self.q1.consumers)
 
-    def test_basic_qos_global_unsupported(self):
+    def test_basic_qos_global(self):
         """
-        basic_qos() is unsupported with global=True.
+        basic_qos() with global=True applies to all consumers on the channel,
+        including existing ones.
         """
         channel = self.make_channel(0)
-        self.assertRaises(NotImplementedError, channel.basic_qos, 0, 1, True)
+        channel.queue_declare('q1')
+        channel.basic_qos(0, 5, False)
+        channel.basic_consume('q1', 'tag1')
+        self.assertTrue(channel.deliverable('tag1'))
+
+        channel.basic_qos(0, 1, True)
+        self.assertEqual(channel.global_prefetch_count, 1)
+        self.assertEqual(channel._get_consumer_prefetch('tag1'), 5)
+        channel.unacked.append((1, 'tag1', 'q1'))
+        self.assertFalse(channel.deliverable('tag1'))
+
+        channel.basic_qos(0, 2, True)
+        self.assertTrue(channel.deliverable('tag1'))
 
     def test_basic_qos_per_consumer(self):
         """
@@ -288,6 +301,29 @@ class TestFakeAMQP(VumiTestCase):
         channel.message_processed()
         yield channel.broker.wait_delivery()
 
+    def test_confirm_select(self):
+        """
+        Published messages should be confirmed once confirm_select() has been
+        called on the channel.
+        """
+        class ToyDelegate(object):
+            def __init__(self):
+                self.acks = []
+
+            def basic_ack(self, channel, msg):
+                self.acks.append((msg.delivery_tag, msg.multiple))
+
+        delegate = ToyDelegate()
+        channel = self.make_channel(0, delegate)
+        channel.exchange_declare('e1', 'direct')
+        channel.basic_publish('e1', 'rkey', fake_amqp.mkContent('foo'))
+        self.assertEqual(delegate.acks, [])
+
+        channel.confirm_select()
+        channel.basic_publish('e1', 'rkey', fake_amqp.mkContent('foo'))
+        channel.basic_publish('e1', 'rkey', fake_amqp.mkContent('bar'))
+        self.assertEqual(delegate.acks, [(1, False), (2, False)])
+
     @inlineCallbacks
     def test_fake_amqclient(self):
         worker = yield self.get_worker()
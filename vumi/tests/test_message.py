@@ -1,7 +1,22 @@
+import json
+import os
+import pickle
+import time
+from copy import deepcopy
+from datetime import datetime
+
+from twisted.trial.unittest import SkipTest
+
+from vumi import log
 from vumi.tests.utils import RegexMatcher, UTCNearNow
-from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
-from vumi.tests.helpers import VumiTestCase
+from vumi.message import (
+    Message, TransportMessage, TransportEvent, TransportUserMessage,
+    LazyTransportUserMessage, LazyTransportEvent, JSONMessageEncoder,
+    date_time_decoder, parse_vumi_date, to_json, from_json,
+    from_json_with_dates, to_msgpack, from_msgpack_with_dates,
+    JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, _EMPTY_DICT, _json_depth)
+from vumi.errors import VumiError, InvalidMessageField, MissingMessageField
+from vumi.tests.helpers import VumiTestCase, import_skip
 
 
 class MessageTest(VumiTestCase):
@@ -16,6 +31,458 @@ class MessageTest(VumiTestCase):
         self.assertTrue('a' in Message(a=5))
         self.assertFalse('a' in Message(b=5))
 
+    def test_copy(self):
+        dt = datetime(2014, 1, 2, 3, 4, 5, 6)
+        msg = Message(a=5, b={'c': [1, {'d': dt}]}, e=(1, 2), f=None)
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, Message(
+            a=5, b={'c': [1, {'d': dt}]}, e=[1, 2], f=None))
+        self.assertEqual(msg_copy, msg.from_json(msg.to_json()))
+        msg_copy['b']['c'][1]['d'] = 'foo'
+        msg_copy['b']['c'].append(3)
+        self.assertEqual(msg['b'], {'c': [1, {'d': dt}]})
+
+    def test_copy_preserves_class(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', helper_metadata={'foo': {'bar': 'baz'}})
+        msg_copy = msg.copy()
+        self.assertTrue(isinstance(msg_copy, TransportUserMessage))
+        self.assertEqual(msg_copy, msg)
+        msg_copy['helper_metadata']['foo']['bar'] = 'quux'
+        self.assertEqual(msg['helper_metadata'], {'foo': {'bar': 'baz'}})
+
+    def test_from_json_decodes_nested_dates(self):
+        dt = datetime(2014, 1, 2, 3, 4, 5, 6)
+        msg = Message.from_json(to_json({'a': dt, 'b': {'c': dt}}))
+        self.assertEqual(msg.payload, {'a': dt, 'b': {'c': dt}})
+
+
+class JSONCodecTest(VumiTestCase):
+
+    def test_parse_vumi_date(self):
+        self.assertEqual(parse_vumi_date('2014-01-02 03:04:05.000006'),
+                         datetime(2014, 1, 2, 3, 4, 5, 6))
+
+    def test_parse_vumi_date_fallback(self):
+        self.assertEqual(parse_vumi_date('2014-1-2 03:04:05.6'),
+                         datetime(2014, 1, 2, 3, 4, 5, 600000))
+        self.assertRaises(ValueError, parse_vumi_date, 'not a date')
+        self.assertRaises(
+            ValueError, parse_vumi_date, '2014-13-02 03:04:05.000006')
+
+    def test_to_json(self):
+        obj = {
+            'timestamp': datetime(2014, 1, 2, 3, 4, 5, 6),
+            'content': u'hello \u1234',
+            'nested': {'list': [1, 2.5, None, True], 'x': u'y'},
+        }
+        self.assertEqual(
+            to_json(obj), json.dumps(obj, cls=JSONMessageEncoder))
+
+    def test_from_json_with_dates(self):
+        obj = from_json_with_dates(
+            '{"a": "2014-01-02 03:04:05.000006",'
+            ' "b": "2014-01-02 03:04:05.000006",'
+            ' "c": {"d": "2014-01-02 03:04:05.000006", "e": "foo"},'
+            ' "f": [{"g": "2014-01-02 03:04:05.000006"}]}',
+            ('a',))
+        dt = datetime(2014, 1, 2, 3, 4, 5, 6)
+        self.assertEqual(obj, {
+            'a': dt,
+            'b': dt,
+            'c': {'d': dt, 'e': 'foo'},
+            'f': [{'g': dt}],
+        })
+
+    def test_from_json_with_dates_short_dates(self):
+        json_string = (
+            '{"a": "2014-1-2 3:04:05.6", "b": "2014-01-02 03:04:05.6",'
+            ' "c": {"d": "2014-1-2 3:4:5.6"}, "e": "2014-01-02 not a date"}')
+        obj = from_json_with_dates(json_string, ('a',))
+        dt = datetime(2014, 1, 2, 3, 4, 5, 600000)
+        self.assertEqual(obj, {
+            'a': dt,
+            'b': dt,
+            'c': {'d': dt},
+            'e': '2014-01-02 not a date',
+        })
+        self.assertEqual(obj, from_json(json_string))
+
+    def test_from_json_with_dates_bad_date(self):
+        obj = from_json_with_dates(
+            '{"a": "2014-13-02 03:04:05.000006", "b": null}', ('a', 'b'))
+        self.assertEqual(obj, {'a': '2014-13-02 03:04:05.000006', 'b': None})
+
+    def test_transport_message_round_trip(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', content='hello',
+            transport_metadata={'deliver_at': datetime(2014, 1, 2)},
+            helper_metadata={'foo': {'bar': 'baz'}})
+        json_string = msg.to_json()
+        self.assertEqual(TransportUserMessage.from_json(json_string), msg)
+        self.assertEqual(
+            TransportUserMessage.from_json(json_string).payload,
+            Message(_process_fields=False, **from_json(json_string)).payload)
+
+    def test_extra_datetime_field_round_trip(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', content='hello',
+            delivered_at=datetime(2014, 1, 2, 3, 4, 5, 6),
+            expires_at=datetime(2014, 1, 3))
+        msg = TransportUserMessage.from_json(msg.to_json())
+        self.assertEqual(
+            msg['delivered_at'], datetime(2014, 1, 2, 3, 4, 5, 6))
+        self.assertEqual(msg['expires_at'], datetime(2014, 1, 3))
+
+
+class WireFormatTest(VumiTestCase):
+
+    def setUp(self):
+        try:
+            import msgpack
+            msgpack  # To keep pyflakes happy.
+        except ImportError, e:
+            import_skip(e, 'msgpack')
+
+    def mk_msg(self):
+        return TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', content=u'hello \u1234',
+            transport_metadata={'deliver_at': datetime(2014, 1, 2)},
+            helper_metadata={'foo': {'bar': ['baz', 1, 2.5, None]}})
+
+    def test_msgpack_round_trip(self):
+        obj = {
+            'a': datetime(2014, 1, 2, 3, 4, 5, 6),
+            'b': '2014-01-02 03:04:05.000006',
+            'c': {'d': datetime(2014, 1, 2, 3, 4, 5, 6), 'e': 'foo'},
+        }
+        self.assertEqual(
+            from_msgpack_with_dates(to_msgpack(obj), ('a',)),
+            from_json_with_dates(to_json(obj), ('a',)))
+
+    def test_msgpack_extra_datetime_field_round_trip(self):
+        msg = self.mk_msg()
+        msg['delivered_at'] = datetime(2014, 1, 2, 3, 4, 5, 6)
+        msg = TransportUserMessage.from_msgpack(msg.to_msgpack())
+        self.assertEqual(
+            msg['delivered_at'], datetime(2014, 1, 2, 3, 4, 5, 6))
+
+    def test_msgpack_round_trip_all_dates(self):
+        obj = {'a': datetime(2014, 1, 2), 'b': [{'c': datetime(2014, 1, 3)}]}
+        self.assertEqual(from_msgpack_with_dates(to_msgpack(obj), None), obj)
+
+    def test_msgpack_strings_are_unicode(self):
+        obj = from_msgpack_with_dates(to_msgpack({'a': 'foo'}), ())
+        self.assertEqual(obj, {u'a': u'foo'})
+        self.assertTrue(isinstance(obj.keys()[0], unicode))
+        self.assertTrue(isinstance(obj['a'], unicode))
+
+    def test_message_msgpack_round_trip(self):
+        msg = self.mk_msg()
+        self.assertEqual(
+            TransportUserMessage.from_msgpack(msg.to_msgpack()), msg)
+        self.assertEqual(
+            TransportUserMessage.from_msgpack(msg.to_msgpack()).payload,
+            TransportUserMessage.from_json(msg.to_json()).payload)
+
+    def test_to_wire(self):
+        msg = self.mk_msg()
+        self.assertEqual(msg.to_wire(), msg.to_json())
+        self.assertEqual(msg.to_wire(JSON_CONTENT_TYPE), msg.to_json())
+        self.assertEqual(msg.to_wire(MSGPACK_CONTENT_TYPE), msg.to_msgpack())
+        self.assertRaises(VumiError, msg.to_wire, 'text/plain')
+
+    def test_from_wire(self):
+        msg = self.mk_msg()
+        self.assertEqual(TransportUserMessage.from_wire(msg.to_json()), msg)
+        self.assertEqual(
+            TransportUserMessage.from_wire(msg.to_json(), JSON_CONTENT_TYPE),
+            msg)
+        self.assertEqual(
+            TransportUserMessage.from_wire(
+                msg.to_msgpack(), MSGPACK_CONTENT_TYPE),
+            msg)
+        self.assertRaises(
+            VumiError, TransportUserMessage.from_wire, '', 'text/plain')
+
+    def test_lazy_message_from_msgpack(self):
+        msg = self.mk_msg()
+        lazy_msg = LazyTransportUserMessage.from_wire(
+            msg.to_msgpack(), MSGPACK_CONTENT_TYPE)
+        self.assertEqual(lazy_msg, msg)
+        self.assertEqual(
+            TransportUserMessage.from_msgpack(lazy_msg.to_msgpack()), msg)
+
+
+class CompactMessageTest(VumiTestCase):
+
+    def mk_msg(self, **kw):
+        return TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', content='hello', **kw)
+
+    def test_no_payload_dict(self):
+        msg = self.mk_msg()
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertEqual(msg._payload, None)
+        self.assertEqual(msg['content'], 'hello')
+        self.assertEqual(msg.get('group'), None)
+        self.assertTrue('to_addr' in msg)
+        self.assertFalse('foo' in msg)
+        self.assertRaises(KeyError, lambda: msg['foo'])
+        self.assertEqual(msg._payload, None)
+
+    def test_extra_fields(self):
+        msg = self.mk_msg(foo='bar')
+        self.assertEqual(msg._extra, {'foo': 'bar'})
+        self.assertEqual(msg['foo'], 'bar')
+        msg['baz'] = 'quux'
+        self.assertEqual(msg._extra, {'foo': 'bar', 'baz': 'quux'})
+        self.assertEqual(msg.payload['baz'], 'quux')
+
+    def test_lazy_empty_dicts(self):
+        msg = TransportUserMessage.from_json(self.mk_msg().to_json())
+        self.assertTrue(msg._f_helper_metadata is _EMPTY_DICT)
+        self.assertTrue('helper_metadata' in msg)
+        self.assertTrue(msg._f_helper_metadata is _EMPTY_DICT)
+        msg['helper_metadata']['foo'] = 'bar'
+        self.assertEqual(msg['helper_metadata'], {'foo': 'bar'})
+        self.assertTrue('"helper_metadata": {"foo": "bar"}' in msg.to_json())
+
+    def assert_copies(self, msg):
+        for copy_func in [
+                deepcopy,
+                lambda m: pickle.loads(pickle.dumps(m)),
+                lambda m: pickle.loads(pickle.dumps(m, 2))]:
+            msg_copy = copy_func(msg)
+            self.assertEqual(type(msg_copy), type(msg))
+            self.assertEqual(msg_copy, msg)
+            self.assertEqual(msg_copy['helper_metadata'], {})
+            msg_copy['transport_metadata']['foo'] = 'baz'
+            self.assertEqual(msg['transport_metadata'], {'foo': 'bar'})
+
+    def test_deepcopy_and_pickle(self):
+        msg = self.mk_msg(transport_metadata={'foo': 'bar'}, extra='x')
+        self.assert_copies(msg)
+        self.assert_copies(TransportUserMessage.from_json(msg.to_json()))
+        msg.payload
+        self.assert_copies(msg)
+
+    def test_deepcopy_and_pickle_lazy(self):
+        msg = self.mk_msg(transport_metadata={'foo': 'bar'})
+        self.assert_copies(LazyTransportUserMessage.from_json(msg.to_json()))
+
+    def test_given_empty_dicts_are_kept(self):
+        helper_metadata = {}
+        msg = self.mk_msg(helper_metadata=helper_metadata)
+        self.assertTrue(msg['helper_metadata'] is helper_metadata)
+        self.assertTrue(msg._f_routing_metadata is _EMPTY_DICT)
+
+    def test_payload(self):
+        msg = self.mk_msg(foo='bar')
+        payload = msg.payload
+        self.assertEqual(payload['content'], 'hello')
+        self.assertEqual(payload['foo'], 'bar')
+        self.assertEqual(payload['routing_metadata'], {})
+        self.assertEqual(msg._extra, None)
+        self.assertFalse(hasattr(msg, '_f_content'))
+        msg['content'] = 'bye'
+        self.assertEqual(payload['content'], 'bye')
+        payload['group'] = 'group1'
+        self.assertEqual(msg['group'], 'group1')
+        self.assertTrue(msg.payload is payload)
+
+    def test_set_payload(self):
+        msg = self.mk_msg()
+        msg.payload = {'content': 'bye'}
+        self.assertFalse(hasattr(msg, '_f_to_addr'))
+        self.assertEqual(msg['content'], 'bye')
+        self.assertFalse('to_addr' in msg)
+
+    def test_equality(self):
+        msg = self.mk_msg(foo='bar')
+        other = TransportUserMessage.from_json(msg.to_json())
+        self.assertEqual(msg, other)
+        other.payload
+        self.assertEqual(msg, other)
+        msg['foo'] = 'baz'
+        self.assertNotEqual(msg, other)
+
+
+class LazyTransportMessageTest(VumiTestCase):
+
+    def make_json(self, **kw):
+        fields = dict(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', content='hello',
+            transport_metadata={'deliver_at': datetime(2014, 1, 2)})
+        fields.update(kw)
+        msg = TransportUserMessage(**fields)
+        msg.set_routing_endpoint('foo')
+        return msg.to_json()
+
+    def test_from_json_is_lazy(self):
+        json_string = self.make_json()
+        msg = LazyTransportUserMessage.from_json(json_string)
+        self.assertFalse(msg.is_decoded)
+        self.assertEqual(msg.get_routing_endpoint(), 'foo')
+        self.assertFalse(msg.is_decoded)
+        self.assertEqual(msg.to_json(), json_string)
+
+    def test_decode_on_access(self):
+        json_string = self.make_json()
+        msg = LazyTransportUserMessage.from_json(json_string)
+        self.assertEqual(msg['content'], 'hello')
+        self.assertTrue(msg.is_decoded)
+        self.assertEqual(msg, TransportUserMessage.from_json(json_string))
+
+    def test_modified_envelope(self):
+        json_string = self.make_json()
+        msg = LazyTransportUserMessage.from_json(json_string)
+        msg.set_routing_endpoint('bar')
+        self.assertFalse(msg.is_decoded)
+        expected = TransportUserMessage.from_json(json_string)
+        expected.set_routing_endpoint('bar')
+        self.assertEqual(
+            TransportUserMessage.from_json(msg.to_json()), expected)
+        self.assertEqual(msg, expected)
+        self.assertEqual(msg.routing_metadata, {'endpoint_name': 'bar'})
+
+    def test_modified_payload(self):
+        msg = LazyTransportUserMessage.from_json(self.make_json())
+        msg['content'] = 'goodbye'
+        msg.set_routing_endpoint('bar')
+        decoded = TransportUserMessage.from_json(msg.to_json())
+        self.assertEqual(decoded['content'], 'goodbye')
+        self.assertEqual(decoded.get_routing_endpoint(), 'bar')
+
+    def test_nested_routing_metadata(self):
+        json_string = self.make_json(
+            helper_metadata={'routing_metadata': {'endpoint_name': 'bad'}})
+        msg = LazyTransportUserMessage.from_json(json_string)
+        self.assertTrue(msg.is_decoded)
+        self.assertEqual(msg.get_routing_endpoint(), 'foo')
+
+    def test_only_nested_routing_metadata(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', content='hello',
+            helper_metadata={'routing_metadata': {'endpoint_name': 'bad'}})
+        del msg.payload['routing_metadata']
+        msg = LazyTransportUserMessage.from_json(msg.to_json())
+        self.assertTrue(msg.is_decoded)
+        self.assertEqual(msg.routing_metadata, {})
+        self.assertEqual(msg.get_routing_endpoint(), 'default')
+
+    def test_json_depth(self):
+        json_string = '{"a": [{"b": "}]\\"}"}], "c": {"d": '
+        self.assertEqual(_json_depth(json_string, 1), 1)
+        self.assertEqual(_json_depth(json_string, json_string.find('"b"')), 3)
+        self.assertEqual(_json_depth(json_string, json_string.find('"c"')), 1)
+        self.assertEqual(_json_depth(json_string, len(json_string)), 2)
+
+    def test_validation_on_decode(self):
+        msg = LazyTransportUserMessage.from_json(
+            '{"routing_metadata": {}, "message_version": "bad"}')
+        self.assertRaises(InvalidMessageField, lambda: msg['message_version'])
+        msg = LazyTransportUserMessage.from_json('{"routing_metadata": {}}')
+        self.assertRaises(MissingMessageField, lambda: msg['message_version'])
+
+    def test_copy(self):
+        msg = LazyTransportUserMessage.from_json(self.make_json())
+        msg_copy = msg.copy()
+        self.assertTrue(isinstance(msg_copy, LazyTransportUserMessage))
+        self.assertEqual(msg_copy, msg)
+
+    def test_no_instance_dict(self):
+        msg = LazyTransportUserMessage.from_json(self.make_json())
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertEqual(msg['content'], 'hello')
+        self.assertFalse(hasattr(msg, '__dict__'))
+        event = LazyTransportEvent(
+            event_type='ack', user_message_id='abc', sent_message_id='def')
+        self.assertFalse(hasattr(event, '__dict__'))
+        self.assertTrue(event.is_decoded)
+        self.assertEqual(event['event_type'], 'ack')
+
+    def test_lazy_event(self):
+        event = TransportEvent(
+            event_type='ack', user_message_id='abc', sent_message_id='def')
+        event.set_routing_endpoint('foo')
+        lazy_event = LazyTransportEvent.from_json(event.to_json())
+        self.assertEqual(lazy_event.get_routing_endpoint(), 'foo')
+        self.assertFalse(lazy_event.is_decoded)
+        self.assertEqual(lazy_event, event)
+
+
+class JSONCodecBenchmark(VumiTestCase):
+    """
+    Compare the message codec with the generic JSON codec.
+
+    These only run if the ``VUMI_TEST_BENCHMARKS`` environment variable is
+    set, because timing results are too noisy to rely on in a normal test
+    run.
+    """
+
+    ITERATIONS = 5000
+
+    def setUp(self):
+        if not os.environ.get('VUMI_TEST_BENCHMARKS'):
+            raise SkipTest("VUMI_TEST_BENCHMARKS not set.")
+
+    def time_func(self, func, *args):
+        start = time.time()
+        for _ in xrange(self.ITERATIONS):
+            func(*args)
+        return time.time() - start
+
+    def report(self, name, old, new):
+        log.msg("%s: generic %.3fs, message codec %.3fs (%.1fx)" % (
+            name, old, new, old / new))
+
+    def legacy_to_json(self, msg):
+        return json.dumps(msg.payload, cls=JSONMessageEncoder)
+
+    def legacy_from_json(self, msg_class, json_string):
+        return msg_class(_process_fields=False, **dict(
+            (k.encode('utf8'), v) for k, v in json.loads(
+                json_string, object_hook=date_time_decoder).iteritems()))
+
+    def assert_codec_faster(self, msg):
+        msg_class = type(msg)
+        json_string = msg.to_json()
+        self.assertEqual(json_string, self.legacy_to_json(msg))
+        self.assertEqual(msg_class.from_json(json_string),
+                         self.legacy_from_json(msg_class, json_string))
+
+        old_encode = self.time_func(self.legacy_to_json, msg)
+        new_encode = self.time_func(msg.to_json)
+        self.report("%s encode" % (msg_class.__name__,),
+                    old_encode, new_encode)
+        old_decode = self.time_func(
+            self.legacy_from_json, msg_class, json_string)
+        new_decode = self.time_func(msg_class.from_json, json_string)
+        self.report("%s decode" % (msg_class.__name__,),
+                    old_decode, new_decode)
+        self.assertTrue(new_decode < old_decode)
+
+    def test_transport_user_message(self):
+        self.assert_codec_faster(TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345', transport_name='sphex',
+            transport_type='sms', content='hello world',
+            transport_metadata={'foo': 'bar', 'session': {'id': '1234'}},
+            helper_metadata={'tag': {'tag': ['pool', 'tag1']}}))
+
+    def test_transport_event(self):
+        self.assert_codec_faster(TransportEvent(
+            event_type='ack', user_message_id='abc', sent_message_id='def',
+            transport_metadata={'foo': 'bar'},
+            helper_metadata={'tag': {'tag': ['pool', 'tag1']}}))
+
 
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
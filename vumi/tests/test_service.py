@@ -1,11 +1,23 @@
 import json
 from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, gatherResults)
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock, deferLater
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 
-from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
-from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.blinkenlights.metrics import MetricManager, Metric, LAST
+from vumi.errors import PublisherNackError, PublisherConfirmLostError
+from vumi.message import Message, MSGPACK_CONTENT_TYPE
+from vumi.service import (
+    Worker, WorkerCreator, WeightedConsumeSlots, get_spec)
+from vumi.tests.fake_amqp import mk_confirm
+from vumi.tests.helpers import VumiTestCase, WorkerHelper, import_skip
+from vumi.tests.utils import LogCatcher
+from vumi.utils import vumi_resource_path
 
 
 def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
@@ -15,6 +27,10 @@ def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
                       content=Content(body=json.dumps(dictionary)))
 
 
+def wait_tick():
+    return deferLater(reactor, 0, lambda: None)
+
+
 class TestService(VumiTestCase):
     def setUp(self):
         self.worker_helper = self.add_helper(WorkerHelper())
@@ -56,6 +72,413 @@ class TestService(VumiTestCase):
         self.assertEqual(10, consumer.channel._get_consumer_prefetch(
             consumer._consumer_tag))
 
+    @inlineCallbacks
+    def test_consume_one_at_a_time_by_default(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        pending = []
+
+        def handler(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        consumer = yield worker.consume('test.routing.key', handler)
+        self.assertEqual(consumer.concurrency, None)
+        for i in range(3):
+            self.worker_helper.broker.publish_message(
+                'vumi', 'test.routing.key', Message(i=i))
+        yield wait_tick()
+        self.assertEqual([msg['i'] for msg, _d in pending], [0])
+        self.assertEqual(consumer._in_progress, 1)
+
+        pending[0][1].callback(None)
+        self.assertEqual([msg['i'] for msg, _d in pending], [0, 1])
+        pending[1][1].callback(None)
+        self.assertEqual([msg['i'] for msg, _d in pending], [0, 1, 2])
+        pending[2][1].callback(None)
+        self.assertEqual([msg['i'] for msg, _d in pending], [0, 1, 2])
+        self.assertEqual(consumer._in_progress, 0)
+
+    @inlineCallbacks
+    def test_consume_with_concurrency(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        pending = []
+
+        def handler(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        consumer = yield worker.consume(
+            'test.routing.key', handler, concurrency=2)
+        self.assertEqual(consumer.concurrency, 2)
+        for i in range(3):
+            self.worker_helper.broker.publish_message(
+                'vumi', 'test.routing.key', Message(i=i))
+        yield wait_tick()
+        self.assertEqual([msg['i'] for msg, _d in pending], [0, 1])
+        self.assertEqual(consumer._in_progress, 2)
+
+        pending[1][1].callback(None)
+        self.assertEqual([msg['i'] for msg, _d in pending], [0, 1, 2])
+        self.assertEqual(consumer._in_progress, 2)
+
+        pending[0][1].callback(None)
+        pending[2][1].callback(None)
+        self.assertEqual(consumer._in_progress, 0)
+        self.assertEqual(consumer.channel.unacked, [])
+
+    @inlineCallbacks
+    def test_consume_with_concurrency_pause_waits_for_quiet(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        pending = []
+
+        def handler(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        consumer = yield worker.consume(
+            'test.routing.key', handler, concurrency=3)
+        for i in range(2):
+            self.worker_helper.broker.publish_message(
+                'vumi', 'test.routing.key', Message(i=i))
+        yield wait_tick()
+        self.assertEqual(len(pending), 2)
+
+        paused = []
+        consumer.pause().addCallback(paused.append)
+        self.assertEqual(paused, [])
+        pending[0][1].callback(None)
+        self.assertEqual(paused, [])
+        pending[1][1].callback(None)
+        self.assertEqual(paused, [None])
+
+        self.worker_helper.broker.publish_message(
+            'vumi', 'test.routing.key', Message(i=2))
+        yield wait_tick()
+        self.assertEqual(len(pending), 2)
+        consumer.unpause()
+        self.assertEqual(len(pending), 3)
+        pending[2][1].callback(None)
+
+    @inlineCallbacks
+    def start_adaptive_consumer(self, handler, **kw):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        consumer = yield worker.consume('test.routing.key', handler, **kw)
+        # We drive the adjustments ourselves.
+        consumer._prefetch_task.stop()
+        returnValue(consumer)
+
+    @inlineCallbacks
+    def test_consume_adaptive_prefetch_setup(self):
+        consumer = yield self.start_adaptive_consumer(
+            lambda msg: None, prefetch_count=10, prefetch_max=50,
+            concurrency=2)
+        self.assertEqual(consumer.prefetch_window, 10)
+        self.assertEqual(consumer.channel.global_prefetch_count, 10)
+        self.assertEqual(50, consumer.channel._get_consumer_prefetch(
+            consumer._consumer_tag))
+        self.assertEqual(consumer._get_prefetch_min(), 2)
+
+    @inlineCallbacks
+    def test_consume_adaptive_prefetch_grows(self):
+        pending = []
+
+        def handler(msg):
+            d = Deferred()
+            pending.append(d)
+            return d
+
+        consumer = yield self.start_adaptive_consumer(
+            handler, prefetch_count=2, prefetch_max=5, concurrency=2)
+        for i in range(4):
+            self.worker_helper.broker.publish_message(
+                'vumi', 'test.routing.key', Message(i=i))
+        yield wait_tick()
+        self.assertEqual(len(consumer.channel.unacked), 2)
+
+        yield consumer.adjust_prefetch()
+        self.assertEqual(consumer.prefetch_window, 4)
+        self.assertEqual(consumer.channel.global_prefetch_count, 4)
+        yield wait_tick()
+        self.assertEqual(len(consumer.channel.unacked), 4)
+
+        yield consumer.adjust_prefetch()
+        self.assertEqual(consumer.prefetch_window, 5)
+        # Nothing new has arrived, so the window isn't full.
+        yield consumer.adjust_prefetch()
+        self.assertEqual(consumer.prefetch_window, 5)
+        while pending:
+            pending.pop(0).callback(None)
+
+    @inlineCallbacks
+    def test_consume_adaptive_prefetch_shrinks(self):
+        consumer = yield self.start_adaptive_consumer(
+            lambda msg: None, prefetch_count=20, prefetch_max=20,
+            prefetch_min=4, prefetch_target_latency=0.5, concurrency=2)
+        consumer._handler_latency = 0.1
+        self.patch(consumer, '_get_backlog', lambda: 18)
+        yield consumer.adjust_prefetch()
+        self.assertEqual(consumer.prefetch_window, 15)
+        self.assertEqual(consumer.channel.global_prefetch_count, 15)
+        for _ in range(10):
+            yield consumer.adjust_prefetch()
+        self.assertEqual(consumer.prefetch_window, 4)
+
+        self.patch(consumer, '_get_backlog', lambda: 1)
+        yield consumer.adjust_prefetch()
+        self.assertEqual(consumer.prefetch_window, 4)
+
+    @inlineCallbacks
+    def test_consume_adaptive_prefetch_metric(self):
+        metric = Metric('prefetch', [LAST])
+        consumer = yield self.start_adaptive_consumer(
+            lambda msg: None, prefetch_count=10, prefetch_max=20,
+            prefetch_metric=metric)
+        yield consumer.adjust_prefetch()
+        # Unregistered metrics aren't updated.
+        self.assertEqual(metric.poll(), [])
+
+        MetricManager('vumi.test.').register(metric)
+        yield consumer.adjust_prefetch()
+        self.assertEqual([v for _t, v in metric.poll()], [10])
+
+    @inlineCallbacks
+    def test_consume_adaptive_prefetch_stop(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        consumer = yield worker.consume(
+            'test.routing.key', lambda msg: None, prefetch_max=20)
+        task = consumer._prefetch_task
+        self.assertTrue(task.running)
+        yield consumer.stop()
+        self.assertFalse(task.running)
+        self.assertEqual(consumer._prefetch_task, None)
+
+    @inlineCallbacks
+    def test_consume_with_shared_slots(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        slots = WeightedConsumeSlots(1)
+        pending = []
+
+        def handler(msg):
+            d = Deferred()
+            pending.append((msg, d))
+            return d
+
+        for rkey in ['test.slow', 'test.fast']:
+            yield worker.consume(
+                rkey, handler, consume_slots=slots.lane())
+        self.worker_helper.broker.publish_message(
+            'vumi', 'test.slow', Message(i=0))
+        self.worker_helper.broker.publish_message(
+            'vumi', 'test.fast', Message(i=1))
+        yield wait_tick()
+        self.assertEqual([msg['i'] for msg, _d in pending], [0])
+        pending[0][1].callback(None)
+        self.assertEqual([msg['i'] for msg, _d in pending], [0, 1])
+        pending[1][1].callback(None)
+        self.assertEqual(slots.tokens, 1)
+
+    @inlineCallbacks
+    def test_consume_handler_error_then_pause(self):
+        def handler(msg):
+            raise ValueError("Handler failed.")
+
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        consumer = yield worker.consume('test.routing.key', handler)
+        self.worker_helper.broker.publish_message(
+            'vumi', 'test.routing.key', Message(i=0))
+        yield self.worker_helper.kick_delivery()
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(consumer._in_progress, 0)
+        # Pausing waits for messages in progress, so this would never fire
+        # if the failed message was still counted.
+        yield consumer.pause()
+        self.assertEqual(consumer.paused, True)
+
+    @inlineCallbacks
+    def start_ack_batching_consumer(self, handler, **kw):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        consumer = yield worker.consume('test.routing.key', handler, **kw)
+        acks = []
+        basic_ack = consumer.channel.basic_ack
+        basic_reject = consumer.channel.basic_reject
+
+        def record_ack(delivery_tag, multiple):
+            acks.append((delivery_tag, multiple))
+            return basic_ack(delivery_tag, multiple)
+
+        def record_reject(delivery_tag, requeue):
+            acks.append(('reject', delivery_tag, requeue))
+            return basic_reject(delivery_tag, requeue)
+
+        self.patch(consumer.channel, 'basic_ack', record_ack)
+        self.patch(consumer.channel, 'basic_reject', record_reject)
+        returnValue((consumer, acks))
+
+    def publish_msgs(self, count):
+        for i in range(count):
+            self.worker_helper.broker.publish_message(
+                'vumi', 'test.routing.key', Message(i=i))
+        return self.worker_helper.kick_delivery()
+
+    def get_unacked_tags(self, consumer):
+        return [dtag for dtag, _ctag, _queue in consumer.channel.unacked]
+
+    @inlineCallbacks
+    def test_consume_ack_batch_size(self):
+        consumer, acks = yield self.start_ack_batching_consumer(
+            lambda msg: None, ack_batch_size=3, ack_batch_time=None)
+        yield self.publish_msgs(2)
+        tags = self.get_unacked_tags(consumer)
+        self.assertEqual(len(tags), 2)
+        self.assertEqual(acks, [])
+
+        yield self.publish_msgs(1)
+        [(tag, multiple)] = acks
+        self.assertTrue(tag not in tags)
+        self.assertEqual(multiple, True)
+        self.assertEqual(consumer.channel.unacked, [])
+        self.assertEqual(consumer._pending_acks, [])
+        self.assertEqual(consumer._ack_states, {})
+
+    @inlineCallbacks
+    def test_consume_ack_batch_time(self):
+        consumer, acks = yield self.start_ack_batching_consumer(
+            lambda msg: None, ack_batch_size=10, ack_batch_time=0)
+        yield self.publish_msgs(2)
+        [_, tag] = self.get_unacked_tags(consumer)
+        self.assertEqual(acks, [])
+        yield wait_tick()
+        self.assertEqual(acks, [(tag, True)])
+        self.assertEqual(consumer.channel.unacked, [])
+
+    @inlineCallbacks
+    def test_consume_ack_batch_on_pause(self):
+        consumer, acks = yield self.start_ack_batching_consumer(
+            lambda msg: None, ack_batch_size=10, ack_batch_time=None)
+        yield self.publish_msgs(1)
+        [tag] = self.get_unacked_tags(consumer)
+        self.assertEqual(acks, [])
+        yield consumer.pause()
+        self.assertEqual(acks, [(tag, False)])
+        self.assertEqual(consumer.channel.unacked, [])
+
+    @inlineCallbacks
+    def test_consume_ack_batch_not_acked(self):
+        consumer, acks = yield self.start_ack_batching_consumer(
+            lambda msg: False if msg['i'] == 1 else None,
+            ack_batch_size=10, ack_batch_time=None)
+        yield self.publish_msgs(4)
+        [tag0, tag1, tag2, tag3] = self.get_unacked_tags(consumer)
+        yield consumer.flush_acks()
+        self.assertEqual(acks, [
+            (tag0, False), ('reject', tag1, True), (tag3, True)])
+        self.assertEqual(self.get_unacked_tags(consumer), [])
+        self.assertEqual(consumer._pending_acks, [])
+        self.assertEqual(consumer._ack_states, {})
+        # The rejected message was requeued.
+        queue = self.worker_helper.broker.queues['test.routing.key']
+        self.assertEqual(
+            [Message.from_json(msg['content'])['i'] for msg in queue.messages],
+            [1])
+
+    @inlineCallbacks
+    def test_consume_ack_batch_resumes_after_not_acked(self):
+        not_acked = []
+
+        def handler(msg):
+            if not not_acked:
+                not_acked.append(msg)
+                return False
+
+        consumer, acks = yield self.start_ack_batching_consumer(
+            handler, ack_batch_size=2, ack_batch_time=None)
+        yield self.publish_msgs(2)
+        [tag0, tag1] = self.get_unacked_tags(consumer)
+        self.assertEqual(acks, [])
+        yield self.publish_msgs(1)
+        [reject, (tag2, multiple)] = acks
+        self.assertEqual(reject, ('reject', tag0, True))
+        self.assertTrue(tag2 not in [tag0, tag1])
+        self.assertEqual(multiple, True)
+        # The rejected message was requeued and delivered again straight
+        # away, so it's the only one waiting to be acked.
+        [tag3] = self.get_unacked_tags(consumer)
+        self.assertEqual(consumer._pending_acks, [tag3])
+        self.assertEqual(consumer._ack_states, {tag3: True})
+
+        # Its ack is batched with the next one.
+        yield self.publish_msgs(1)
+        [(tag4, multiple)] = acks[2:]
+        self.assertNotEqual(tag4, tag3)
+        self.assertEqual(multiple, True)
+        self.assertEqual(consumer.channel.unacked, [])
+        self.assertEqual(consumer._pending_acks, [])
+        self.assertEqual(consumer._ack_states, {})
+        self.assertEqual(consumer._ready_acks, 0)
+
+    @inlineCallbacks
+    def test_consume_ack_batch_handler_error(self):
+        failed = []
+
+        def handler(msg):
+            if not failed:
+                failed.append(msg)
+                raise ValueError("Handler failed.")
+
+        consumer, acks = yield self.start_ack_batching_consumer(
+            handler, ack_batch_size=2, ack_batch_time=None)
+        consumer.clock = Clock()
+        yield self.publish_msgs(3)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        # The failed message was rejected (and requeued), and the acks after
+        # it weren't held up.
+        [(reject, _tag, requeue), (_tag, multiple)] = acks[:2]
+        self.assertEqual((reject, requeue), ('reject', True))
+        self.assertEqual(multiple, True)
+        consumer.clock.advance(consumer.ack_batch_time)
+        self.assertEqual(consumer._in_progress, 0)
+        yield consumer.pause()
+        self.assertEqual(consumer._pending_acks, [])
+        self.assertEqual(consumer.channel.unacked, [])
+
+    @inlineCallbacks
+    def test_consume_ack_batch_time_uses_clock(self):
+        consumer, acks = yield self.start_ack_batching_consumer(
+            lambda msg: None, ack_batch_size=10, ack_batch_time=5)
+        consumer.clock = Clock()
+        yield self.publish_msgs(2)
+        [_, tag] = self.get_unacked_tags(consumer)
+        consumer.clock.advance(4)
+        self.assertEqual(acks, [])
+        consumer.clock.advance(1)
+        self.assertEqual(acks, [(tag, True)])
+
+    @inlineCallbacks
+    def test_consume_ack_batch_waits_for_in_progress(self):
+        pending = {}
+
+        def handler(msg):
+            if msg['i'] == 1:
+                pending[1] = Deferred()
+                return pending[1]
+
+        consumer, acks = yield self.start_ack_batching_consumer(
+            handler, ack_batch_size=10, ack_batch_time=None, concurrency=2)
+        self.publish_msgs(3)
+        yield wait_tick()
+        [tag0, tag1, tag2] = self.get_unacked_tags(consumer)
+        yield consumer.flush_acks()
+        self.assertEqual(acks, [(tag0, False)])
+        self.assertEqual(consumer._pending_acks, [tag1, tag2])
+
+        pending[1].callback(None)
+        yield consumer.flush_acks()
+        self.assertEqual(acks, [(tag0, False), (tag2, True)])
+        self.assertEqual(consumer.channel.unacked, [])
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -69,6 +492,202 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publisher_content_type(self):
+        try:
+            import msgpack
+        except ImportError, e:
+            import_skip(e, 'msgpack')
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', content_type=MSGPACK_CONTENT_TYPE)
+        publisher.publish_message(Message(key="value"))
+        [published_msg] = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEqual(
+            msgpack.unpackb(published_msg.body, raw=False), {"key": "value"})
+        self.assertEqual(published_msg.properties, {
+            'delivery mode': 2,
+            'content type': MSGPACK_CONTENT_TYPE,
+        })
+
+    @inlineCallbacks
+    def test_consume_content_type(self):
+        try:
+            import msgpack
+            msgpack  # To keep pyflakes happy.
+        except ImportError, e:
+            import_skip(e, 'msgpack')
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to(
+            'test.routing.key', content_type=MSGPACK_CONTENT_TYPE)
+        publisher.publish_message(Message(key="msgpack"))
+        json_publisher = yield worker.publish_to('test.routing.key')
+        json_publisher.publish_message(Message(key="json"))
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEqual(log, [Message(key="msgpack"), Message(key="json")])
+
+    @inlineCallbacks
+    def test_publisher_confirms(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', publisher_confirms=True)
+        self.assertEqual(publisher.channel.confirm_listener, publisher)
+        d = publisher.publish_message(Message(key="value"))
+        self.assertEqual(self.successResultOf(d), Message(key="value"))
+        self.assertEqual(publisher._unconfirmed, {})
+
+    @inlineCallbacks
+    def test_publisher_confirms_pending(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', publisher_confirms=True)
+        # Stop the fake channel from confirming messages itself.
+        publisher.channel._publish_count = None
+        ds = [publisher.publish_message(Message(i=i)) for i in range(3)]
+        for d in ds:
+            self.assertNoResult(d)
+        self.assertEqual(sorted(publisher._unconfirmed), [1, 2, 3])
+
+        publisher.handle_confirm(2, True, True)
+        self.assertEqual(self.successResultOf(ds[0]), Message(i=0))
+        self.assertEqual(self.successResultOf(ds[1]), Message(i=1))
+        self.assertNoResult(ds[2])
+
+        publisher.handle_confirm(3, False, False)
+        self.failureResultOf(ds[2], PublisherNackError)
+        self.assertEqual(publisher._unconfirmed, {})
+
+    @inlineCallbacks
+    def test_publisher_confirms_channel_closed(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', publisher_confirms=True)
+        publisher.channel._publish_count = None
+        ds = [publisher.publish_message(Message(i=i)) for i in range(2)]
+        worker._amqp_client.delegate.channel_close(
+            publisher.channel, "Channel closed by broker.")
+        for d in ds:
+            self.failureResultOf(d, PublisherConfirmLostError)
+        self.assertEqual(publisher._unconfirmed, {})
+
+    @inlineCallbacks
+    def test_publisher_confirms_connection_lost(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', publisher_confirms=True)
+        publisher.channel._publish_count = None
+        d = publisher.publish_message(Message(key="value"))
+        client = worker._amqp_client
+        client.transport = StringTransport()
+        client.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(d, PublisherConfirmLostError)
+        self.assertEqual(publisher._unconfirmed, {})
+
+    @inlineCallbacks
+    def test_confirm_without_publisher_ignored(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to('test.routing.key')
+        with LogCatcher() as lc:
+            worker._amqp_client.delegate.basic_ack(
+                publisher.channel, mk_confirm(1))
+            [log_msg] = lc.messages()
+        self.assertTrue(log_msg.startswith(
+            "Ignoring publisher confirm for delivery tag 1"))
+
+    def test_confirm_spec(self):
+        spec = get_spec(vumi_resource_path("amqp-spec-0-9-1.xml"))
+        self.assertTrue(hasattr(spec.klass, 'confirm_select'))
+        self.assertTrue(hasattr(spec.klass, 'basic_nack'))
+
+    @inlineCallbacks
+    def test_publishers_share_channel(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        worker._amqp_client.vumi_options['publisher-channels'] = 1
+        publisher1 = yield worker.publish_to('test.routing.key1')
+        publisher2 = yield worker.publish_to('test.routing.key2')
+        self.assertTrue(publisher1.channel is publisher2.channel)
+        publisher1.publish_message(Message(key="value1"))
+        publisher2.publish_message(Message(key="value2"))
+        broker = publisher1.channel.broker
+        [msg1] = broker.get_messages('vumi', 'test.routing.key1')
+        [msg2] = broker.get_messages('vumi', 'test.routing.key2')
+        self.assertEqual(msg1, Message(key="value1"))
+        self.assertEqual(msg2, Message(key="value2"))
+
+    @inlineCallbacks
+    def test_publisher_channel_limit(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        worker._amqp_client.vumi_options['publisher-channels'] = 2
+        publishers = yield gatherResults([
+            worker.publish_to('test.routing.key%s' % (i,)) for i in range(5)])
+        channels = [publisher.channel for publisher in publishers]
+        self.assertEqual(len(set(channels)), 2)
+        self.assertEqual(channels, ([channels[0], channels[1]] * 3)[:5])
+
+    @inlineCallbacks
+    def test_publisher_channels_not_shared_by_default(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher1 = yield worker.publish_to('test.routing.key1')
+        publisher2 = yield worker.publish_to('test.routing.key2')
+        self.assertFalse(publisher1.channel is publisher2.channel)
+
+    @inlineCallbacks
+    def test_publisher_channels_disabled(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        worker._amqp_client.vumi_options['publisher-channels'] = 0
+        publisher1 = yield worker.publish_to('test.routing.key1')
+        publisher2 = yield worker.publish_to('test.routing.key2')
+        self.assertFalse(publisher1.channel is publisher2.channel)
+
+    @inlineCallbacks
+    def test_publisher_channel_closed(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        worker._amqp_client.vumi_options['publisher-channels'] = 1
+        publisher1 = yield worker.publish_to('test.routing.key1')
+        publisher1.channel.closed = True
+        publisher2 = yield worker.publish_to('test.routing.key2')
+        self.assertFalse(publisher1.channel is publisher2.channel)
+
+    @inlineCallbacks
+    def test_publisher_confirms_own_channel(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        worker._amqp_client.vumi_options['publisher-channels'] = 1
+        publisher1 = yield worker.publish_to('test.routing.key1')
+        publisher2 = yield worker.publish_to(
+            'test.routing.key2', publisher_confirms=True)
+        publisher3 = yield worker.publish_to('test.routing.key3')
+        self.assertFalse(publisher1.channel is publisher2.channel)
+        self.assertTrue(publisher1.channel is publisher3.channel)
+
+    @inlineCallbacks
+    def test_exchange_declared_once(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        client = worker._amqp_client
+        declares = []
+        exchange_declare = client.broker.exchange_declare
+
+        def record_declare(*args, **kw):
+            declares.append(args)
+            return exchange_declare(*args, **kw)
+
+        self.patch(client.broker, 'exchange_declare', record_declare)
+        yield worker.publish_to('test.routing.key1')
+        yield worker.publish_to('test.routing.key2')
+        yield worker.consume('test.routing.key1', lambda msg: None)
+        yield worker.publish_to('test.routing.key3', exchange_name='other')
+        self.assertEqual(len(declares), 2)
+
+    def test_get_new_channel_id(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        client = worker._amqp_client
+        self.assertEqual(client.get_new_channel_id(), 0)
+        self.assertEqual(client.get_new_channel_id(), 1)
+        client.channels[5] = None
+        self.assertEqual(client.get_new_channel_id(), 6)
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -103,3 +722,41 @@ class TestWorkerCreator(VumiTestCase):
                                   LoadableTestWorker.__name__)
         worker = creator.create_worker(worker_class, {})
         self.assertEquals("poke", worker.poke())
+
+
+class TestWeightedConsumeSlots(VumiTestCase):
+    def acquire_all(self, lane, count, acquired, name):
+        for _ in range(count):
+            lane.acquire().addCallback(lambda _: acquired.append(name))
+
+    def test_acquire_free_slots(self):
+        slots = WeightedConsumeSlots(2)
+        lane = slots.lane()
+        acquired = []
+        self.acquire_all(lane, 3, acquired, 'a')
+        self.assertEqual(acquired, ['a', 'a'])
+        self.assertEqual(slots.tokens, 0)
+        lane.release()
+        self.assertEqual(acquired, ['a', 'a', 'a'])
+        lane.release()
+        lane.release()
+        self.assertEqual(slots.tokens, 2)
+
+    def test_weighted_release(self):
+        slots = WeightedConsumeSlots(1)
+        slow = slots.lane(1)
+        fast = slots.lane(3)
+        acquired = []
+        slow.acquire()
+        self.acquire_all(slow, 4, acquired, 'slow')
+        self.acquire_all(fast, 6, acquired, 'fast')
+        for _ in range(8):
+            slots.release()
+        self.assertEqual(acquired, [
+            'fast', 'slow', 'fast', 'fast', 'fast', 'slow', 'fast', 'fast'])
+        # Only the slow lane is waiting now, so it gets every slot.
+        slots.release()
+        slots.release()
+        self.assertEqual(acquired[8:], ['slow', 'slow'])
+        slots.release()
+        self.assertEqual(slots.tokens, 1)
@@ -1,6 +1,7 @@
 from twisted.internet.defer import inlineCallbacks, succeed, Deferred
 
 from vumi.worker import BaseConfig, BaseWorker
+from vumi.errors import ConfigError
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
 from vumi.tests.utils import LogCatcher
 from vumi.middleware.base import BaseMiddleware
@@ -50,6 +51,30 @@ class TestBaseConfig(VumiTestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_no_amqp_concurrency(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_concurrency, 1)
+
+    def test_amqp_concurrency(self):
+        config = BaseConfig({'amqp_concurrency': 5})
+        self.assertEqual(config.amqp_concurrency, 5)
+
+    def test_adaptive_prefetch_default(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_prefetch_min, None)
+        self.assertEqual(config.amqp_prefetch_max, None)
+        self.assertEqual(config.amqp_prefetch_target_latency, 1.0)
+
+    def test_ack_batching_default(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_ack_batch_size, None)
+        self.assertEqual(config.amqp_ack_batch_time, 0.1)
+
+    def test_publisher_options_default(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_publisher_confirms, False)
+        self.assertEqual(config.amqp_message_format, None)
+
 
 class TestBaseWorker(VumiTestCase):
 
@@ -152,6 +177,40 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertTrue(cfg1 is cfg2)
+        self.worker.invalidate_config_cache()
+        cfg3 = yield self.worker.get_config(msg)
+        self.assertFalse(cfg1 is cfg3)
+
+    def test_get_cached_config(self):
+        calls = []
+
+        def get_config_data():
+            calls.append(None)
+            return {'amqp_prefetch_count': 5}
+
+        cfg1 = self.worker.get_cached_config('foo', get_config_data)
+        cfg2 = self.worker.get_cached_config('foo', get_config_data)
+        self.assertTrue(cfg1 is cfg2)
+        self.assertEqual(cfg1.amqp_prefetch_count, 5)
+        self.assertEqual(len(calls), 1)
+        self.worker.invalidate_config_cache()
+        self.worker.get_cached_config('foo', get_config_data)
+        self.assertEqual(len(calls), 2)
+
+    @inlineCallbacks
+    def test_config_cache_options(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'config_cache_size': 5, 'config_cache_ttl': 60},
+            False)
+        self.assertEqual(worker.config_cache.max_size, 5)
+        self.assertEqual(worker.config_cache.ttl, 60)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
@@ -172,6 +231,24 @@ class TestBaseWorker(VumiTestCase):
         self.assertTrue(isinstance(connector, ReceiveInboundConnector))
         # test setup happened
         self.assertTrue(connector._consumers['inbound'].keep_consuming)
+        self.assertEqual(connector._consumers['inbound'].concurrency, 1)
+
+    @inlineCallbacks
+    def test_setup_connector_message_format(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_message_format': 'msgpack'}, False)
+        connector = yield worker.setup_connector(
+            ReceiveInboundConnector, 'foo')
+        self.assertEqual(
+            connector._content_type, 'application/x-msgpack')
+
+    @inlineCallbacks
+    def test_setup_connector_bad_message_format(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_message_format': 'xml'}, False)
+        self.assertRaises(
+            ConfigError, worker.setup_connector, ReceiveInboundConnector,
+            'foo')
 
     @inlineCallbacks
     def test_teardown_connector(self):
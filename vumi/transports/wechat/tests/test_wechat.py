@@ -512,6 +512,53 @@ class TestWeChatAddrMasking(WeChatTestCase):
             transport.DEFAULT_MASK)
 
 
+class TestWeChatAddrMaskCaching(WeChatTestCase):
+
+    @inlineCallbacks
+    def test_cached_mask(self):
+        transport = yield self.get_transport_with_access_token(
+            'foo', addr_mask_cache_lifetime=60)
+        yield transport.cache_addr_mask('fromUser', 'foo')
+        self.assertEqual((yield transport.get_addr_mask('fromUser')), 'foo')
+        # Masks set by other workers aren't seen while cached.
+        yield transport.redis.set(transport.mask_key('fromUser'), 'bar')
+        self.assertEqual((yield transport.get_addr_mask('fromUser')), 'foo')
+        yield transport.clear_addr_mask('fromUser')
+        self.assertEqual(
+            (yield transport.get_addr_mask('fromUser')),
+            transport.DEFAULT_MASK)
+
+    @inlineCallbacks
+    def test_missing_mask_not_cached(self):
+        transport = yield self.get_transport_with_access_token(
+            'foo', addr_mask_cache_lifetime=60)
+        self.assertEqual(
+            (yield transport.get_addr_mask('fromUser')),
+            transport.DEFAULT_MASK)
+        yield transport.redis.set(transport.mask_key('fromUser'), 'bar')
+        self.assertEqual((yield transport.get_addr_mask('fromUser')), 'bar')
+
+    @inlineCallbacks
+    def test_cached_mask_expires_with_redis_key(self):
+        transport = yield self.get_transport_with_access_token(
+            'foo', addr_mask_cache_lifetime=60, wechat_mask_lifetime=30)
+        clock = transport.redis._client.clock
+        transport.addr_mask_redis.clock = clock
+        yield transport.cache_addr_mask('fromUser', 'foo')
+        self.assertEqual((yield transport.get_addr_mask('fromUser')), 'foo')
+        clock.advance(29)
+        self.assertEqual((yield transport.get_addr_mask('fromUser')), 'foo')
+        clock.advance(1)
+        self.assertEqual(
+            (yield transport.get_addr_mask('fromUser')),
+            transport.DEFAULT_MASK)
+
+    @inlineCallbacks
+    def test_no_caching_by_default(self):
+        transport = yield self.get_transport_with_access_token('foo')
+        self.assertTrue(transport.addr_mask_redis is transport.redis)
+
+
 class TestWeChatMenuCreation(WeChatTestCase):
 
     MENU_TEMPLATE = """
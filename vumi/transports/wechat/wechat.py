@@ -23,6 +23,7 @@ from vumi.transports.wechat.message_types import (
     TextMessage, EventMessage, NewsMessage, WeChatXMLParser)
 from vumi.utils import build_web_site, http_request_full
 from vumi.message import TransportUserMessage
+from vumi.persist.redis_cache import CachedRedisManager
 from vumi.persist.txredis_manager import TxRedisManager
 
 
@@ -77,6 +78,12 @@ class WeChatConfig(Transport.CONFIG_CLASS):
     wechat_mask_lifetime = ConfigInt(
         'How long, in seconds, to maintain an address mask for. '
         '(default 1 hour)', default=60 * 60 * 1, static=True)
+    addr_mask_cache_lifetime = ConfigInt(
+        'How long, in seconds, to cache address masks in memory for. Masks '
+        'changed by other transport workers are only seen once the cached '
+        'mask expires. Masks are never cached for longer than they have '
+        'left in Redis, and missing masks aren\'t cached. (default 0, no '
+        'caching)', default=0, static=True)
     embed_user_profile = ConfigBool(
         'Whether or not to embed the WeChat User Profile info in '
         'messages received.', required=True, default=False, static=True)
@@ -213,6 +220,11 @@ class WeChatTransport(Transport):
         })
 
         self.redis = yield TxRedisManager.from_config(config.redis_manager)
+        self.addr_mask_redis = self.redis
+        if config.addr_mask_cache_lifetime:
+            self.addr_mask_redis = CachedRedisManager(
+                self.redis, config.addr_mask_cache_lifetime,
+                cached_calls=['get'], cache_none=False, follow_key_ttl=True)
         self.server = yield self.endpoint.listen(self.factory)
 
         if config.wechat_menu:
@@ -259,18 +271,18 @@ class WeChatTransport(Transport):
 
     def cache_addr_mask(self, user, mask):
         config = self.get_static_config()
-        d = self.redis.setex(
+        d = self.addr_mask_redis.setex(
             self.mask_key(user), config.wechat_mask_lifetime, mask)
         d.addCallback(lambda *a: mask)
         return d
 
     def get_addr_mask(self, user):
-        d = self.redis.get(self.mask_key(user))
+        d = self.addr_mask_redis.get(self.mask_key(user))
         d.addCallback(lambda mask: mask or self.DEFAULT_MASK)
         return d
 
     def clear_addr_mask(self, user):
-        return self.redis.delete(self.mask_key(user))
+        return self.addr_mask_redis.delete(self.mask_key(user))
 
     def handle_raw_inbound_message(self, request, wc_msg):
         return {
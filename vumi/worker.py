@@ -13,8 +13,11 @@ from twisted.python import log
 from vumi.service import Worker
 from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
-from vumi.config import Config, ConfigInt
-from vumi.errors import DuplicateConnectorError
+from vumi.config import (
+    Config, ConfigInt, ConfigBool, ConfigFloat, ConfigText, ConfigDict,
+    ConfigCache)
+from vumi.errors import DuplicateConnectorError, ConfigError
+from vumi.message import WIRE_FORMAT_CONTENT_TYPES
 from vumi.utils import generate_worker_id
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
@@ -34,6 +37,71 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_concurrency = ConfigInt(
+        "The maximum number of messages from each AMQP queue processed"
+        " concurrently by each worker instance. This should not be larger"
+        " than `amqp_prefetch_count`.",
+        default=1, static=True)
+    amqp_ack_batch_size = ConfigInt(
+        "If set, AMQP acks are sent in batches of up to this many messages"
+        " instead of individually.",
+        default=None, static=True)
+    amqp_ack_batch_time = ConfigFloat(
+        "The maximum number of seconds an ack waits to be sent when"
+        " `amqp_ack_batch_size` is set. This should be short, because unsent"
+        " acks count towards `amqp_prefetch_count`.",
+        default=0.1, static=True)
+    amqp_prefetch_max = ConfigInt(
+        "If set, the prefetch count for each AMQP queue is adjusted between"
+        " `amqp_prefetch_min` and this value based on how long messages take"
+        " to process. `amqp_prefetch_count` is the starting value.",
+        default=None, static=True)
+    amqp_prefetch_min = ConfigInt(
+        "The smallest prefetch count used when `amqp_prefetch_max` is set."
+        " Defaults to `amqp_concurrency`.",
+        default=None, static=True)
+    amqp_prefetch_target_latency = ConfigFloat(
+        "The longest time in seconds a prefetched message should wait to be"
+        " processed when `amqp_prefetch_max` is set. The prefetch count is"
+        " reduced if messages wait longer than this.",
+        default=1.0, static=True)
+    amqp_priority_lanes = ConfigDict(
+        "Extra AMQP queues for each connector queue, mapping lane names to"
+        " weights. Messages are published to the `<queue>.<lane>` queue for"
+        " their lane. Consumers share `amqp_concurrency` between the normal"
+        " queue (with weight 1) and the lanes in proportion to their weights"
+        " when more than one has messages waiting. Workers on both ends of a"
+        " connector need the same lanes.",
+        default={}, static=True)
+    amqp_session_priority_lane = ConfigText(
+        "The priority lane for messages with a `session_event` that don't"
+        " have a `priority_lane` helper metadata field.",
+        default=None, static=True)
+    lazy_message_decoding = ConfigBool(
+        "If set, consumed messages only decode their routing metadata until"
+        " something else in the message is used. Unchanged messages are"
+        " republished without being re-encoded. This is useful for workers"
+        " that only route messages.",
+        default=False, static=True)
+    amqp_message_format = ConfigText(
+        "The wire format for published messages. Either `json` or `msgpack`"
+        " (which requires `msgpack>=0.5.2`, e.g. `pip install vumi[msgpack]`)."
+        " The format is stored in the AMQP content type, so consumers can"
+        " read both formats and workers can switch formats one at a time.",
+        default=None, static=True)
+    amqp_publisher_confirms = ConfigBool(
+        "If set, wait for the AMQP broker to confirm each published message."
+        " This requires an AMQP spec that includes the RabbitMQ confirm"
+        " extension, such as `amqp-spec-0-9-1.xml`.",
+        default=False, static=True)
+    config_cache_size = ConfigInt(
+        "The maximum number of per-message config objects the worker keeps.",
+        default=1000, static=True)
+    config_cache_ttl = ConfigFloat(
+        "The number of seconds the worker keeps per-message config objects"
+        " for. If unset, they are kept until they are evicted or the cache is"
+        " invalidated.",
+        default=None, static=True)
 
 
 class BaseWorker(Worker):
@@ -51,6 +119,8 @@ class BaseWorker(Worker):
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config = None
+        self.config_cache = self.create_config_cache()
         self._hb_pub = None
         self._worker_id = None
 
@@ -152,8 +222,45 @@ class BaseWorker(Worker):
         It deliberately returns a deferred even when this isn't strictly
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
+
+        The config object is only built (and validated) once. Call
+        :meth:`invalidate_config_cache` if the worker's config changes.
+        """
+        if self._config is None:
+            self._config = self.CONFIG_CLASS(self.config)
+        return succeed(self._config)
+
+    def create_config_cache(self):
+        """Create the cache used by :meth:`get_cached_config`.
+
+        Subclasses may override this to use a different cache. It must
+        provide the same `get`, `set`, `invalidate` and `clear` methods as
+        :class:`vumi.config.ConfigCache`.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        static_config = self.get_static_config()
+        return ConfigCache(max_size=static_config.config_cache_size,
+                           ttl=static_config.config_cache_ttl)
+
+    def get_cached_config(self, key, get_config_data):
+        """Return a config object for `key` from the config cache.
+
+        If there isn't one, a new config object is built from the dict
+        returned by `get_config_data()` and cached. This is for workers whose
+        :meth:`get_config` builds config objects from per-message data.
+        """
+        config = self.config_cache.get(key)
+        if config is None:
+            config = self.CONFIG_CLASS(get_config_data())
+            self.config_cache.set(key, config)
+        return config
+
+    def invalidate_config_cache(self):
+        """Drop all cached config objects.
+
+        They will be rebuilt from the current config when they are next used.
+        """
+        self._config = None
+        self.config_cache.clear()
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -177,12 +284,31 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
-
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        content_type = None
+        if static_config.amqp_message_format is not None:
+            content_type = WIRE_FORMAT_CONTENT_TYPES.get(
+                static_config.amqp_message_format)
+            if content_type is None:
+                raise ConfigError("Unknown amqp_message_format: %r" % (
+                    static_config.amqp_message_format,))
+
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=static_config.amqp_prefetch_count,
+            concurrency=static_config.amqp_concurrency,
+            publisher_confirms=static_config.amqp_publisher_confirms,
+            ack_batch_size=static_config.amqp_ack_batch_size,
+            ack_batch_time=static_config.amqp_ack_batch_time,
+            prefetch_min=static_config.amqp_prefetch_min,
+            prefetch_max=static_config.amqp_prefetch_max,
+            prefetch_target_latency=static_config.amqp_prefetch_target_latency,
+            lazy_messages=static_config.lazy_message_decoding,
+            content_type=content_type,
+            priority_lanes=static_config.amqp_priority_lanes,
+            session_priority_lane=static_config.amqp_session_priority_lane,
+            middlewares=middlewares)
         self.connectors[connector_name] = connector
 
         d = connector.setup()